@@ -219,13 +219,10 @@ def main():
         tubes = []
         wafer_to_tube = {}
         wafer_to_FOV_cut = {}
+        hwindex = hw.index()
         for wafer in set(det_data["wafer"]):
             # Determine which tube has this wafer
-            for tube_name, tube_data in hw.data["tubes"].items():
-                if wafer in tube_data["wafers"]:
-                    break
-            else:
-                raise RuntimeError(f"Could not match wafer {wafer} to a tube.")
+            tube_name = hwindex.tube(wafer)
             wafer_to_tube[wafer] = tube_name
             tube_data = hw.data["tubes"][tube_name]
             if "FOV_cut" in tube_data:
@@ -242,15 +239,11 @@ def main():
             det_data["pixel"][idet] = f"{tube}-{wafer}-{pixel}"
 
         # Cut detectors based on FOV_cut
-        cut = np.ones(n_det, dtype=bool)
-        for idet, (wafer, quat) in enumerate(
-                zip(det_data["wafer"], det_data["quat"])
-        ):
-            if wafer in wafer_to_FOV_cut:
-                theta_max = wafer_to_FOV_cut[wafer] / 2
-                theta, phi, _ = qa.to_iso_angles(quat)
-                if theta > theta_max:
-                    cut[idet] = False
+        theta = hardware.boresight_angle(np.array(det_data["quat"]))
+        theta_max = np.array(
+            [wafer_to_FOV_cut.get(wafer, np.inf) / 2 for wafer in det_data["wafer"]]
+        )
+        cut = theta <= theta_max
         print(f"INFO: FOV_cut rejects {(1 - np.sum(cut) / n_det) * 100:.2f} % pixels")
         print(
             f"INFO: FOV_cut: {cut.size:8} - {cut.size - np.sum(cut):8}"
@@ -48,6 +48,8 @@ import s4sim.pipeline_tools as s4_tools
 import numpy as np
 
 import s4sim.hardware
+import s4sim.pairdiff
+from s4sim.manifest import RunManifest
 
 import warnings
 
@@ -92,6 +94,13 @@ def parse_arguments(comm):
     s4_tools.add_hw_args(parser)
     s4_tools.add_s4_noise_args(parser)
     s4_tools.add_pysm_args(parser)
+    s4_tools.add_atm_args(parser)
+    s4_tools.add_observation_args(parser)
+    s4_tools.add_signal_args(parser)
+    s4_tools.add_pointing_args(parser)
+    s4_tools.add_checkpoint_args(parser)
+    s4_tools.add_profile_args(parser)
+    s4_tools.add_precision_args(parser)
     toast_tools.add_debug_args(parser)
 
     parser.add_argument(
@@ -138,6 +147,9 @@ def parse_arguments(comm):
     if args.simulate_atmosphere and args.weather is None:
         raise RuntimeError("Cannot simulate atmosphere without a TOAST weather file")
 
+    s4_tools.check_checkpoint_args(args)
+    s4_tools.check_precision_args(args)
+
     if comm.world_rank == 0:
         log.info("\n")
         log.info("All parameters:")
@@ -162,57 +174,141 @@ def setup_output(args, comm, mc):
     return outpath
 
 
-def outputs_exist(args, comm, outpath):
-    """ Returns True if all of the requested outputs already exist
+def expected_outputs(args, outpath):
+    """ Returns the requested outputs of one realization.
+
+    Each output is a list of alternative file names.
     """
-    there = True
+    if args.checkpoint:
+        return [[s4_tools.checkpoint_map_path(args, outpath)]]
+    outputs = []
+    if not args.skip_madam:
+        if args.write_binmap:
+            outputs.append([os.path.join(
+                outpath, args.mapmaker_prefix + "_telescope_all_time_all_bmap.fits"
+            )])
+        if args.destripe:
+            outputs.append([os.path.join(
+                outpath, args.mapmaker_prefix + "_telescope_all_time_all_map.fits"
+            )])
+    if (
+            args.apply_polyfilter
+            or args.apply_polyfilter2D
+            or args.apply_common_mode_filter
+            or args.apply_groundfilter
+    ):
+        outputs.append([os.path.join(
+            outpath,
+            args.mapmaker_prefix + "_filtered" + "_telescope_all_time_all_bmap.fits",
+        )])
+    if args.filterbin_ground_order or args.filterbin_poly_order:
+        fname = os.path.join(
+            outpath,
+            args.filterbin_prefix + "_telescope_all_time_all_filtered.fits",
+        )
+        outputs.append([fname, fname + ".gz"])
+    return outputs
+
+
+def outputs_exist(args, comm, firstmc, nmc):
+    """ Returns the set of realizations whose requested outputs all exist
+
+    Rank 0 reads the run manifest once, so no files are checked and no
+    collectives are needed for each realization.  A run without a
+    manifest, e.g. one written by an earlier version, is scanned once and
+    its existing outputs recorded.
+    """
+    completed = None
     if comm.world_rank == 0:
-        if not args.skip_madam:
-            if there and args.write_binmap:
-                fname = os.path.join(
-                    outpath, args.mapmaker_prefix + "_telescope_all_time_all_bmap.fits"
-                )
-                there = os.path.isfile(fname)
-                if there:
-                    print(f"{fname} exists", flush=True)
-                else:
-                    print(f"{fname} does not exist", flush=True)
-            if there and args.destripe:
-                fname = os.path.join(
-                    outpath, args.mapmaker_prefix + "_telescope_all_time_all_map.fits"
-                )
-                there = os.path.isfile(fname)
-                if there:
-                    print(f"{fname} exists", flush=True)
-                else:
-                    print(f"{fname} does not exist", flush=True)
-        if there and (
-                args.apply_polyfilter
-                or args.apply_polyfilter2D
-                or args.apply_common_mode_filter
-                or args.apply_groundfilter
-        ):
-            fname = os.path.join(
-                outpath,
-                args.mapmaker_prefix + "_filtered" + "_telescope_all_time_all_bmap.fits",
-            )
-            there = os.path.isfile(fname)
-            if there:
-                print(f"{fname} exists", flush=True)
+        manifest = RunManifest(args.outdir)
+        if not manifest.exists():
+            for mc in range(firstmc, firstmc + nmc):
+                outpath = "{}/{:08}".format(args.outdir, mc)
+                for alternatives in expected_outputs(args, outpath):
+                    for fname in alternatives:
+                        if os.path.isfile(fname):
+                            manifest.record(mc, fname)
+                            break
+        products = manifest.read()
+        completed = set()
+        for mc in range(firstmc, firstmc + nmc):
+            outpath = "{}/{:08}".format(args.outdir, mc)
+            if mc in products and manifest.completed(
+                products[mc], expected_outputs(args, outpath)
+            ):
+                completed.add(mc)
+        print(
+            "{} of {} realizations already completed in {}".format(
+                len(completed), nmc, manifest.path
+            ),
+            flush=True,
+        )
+    completed = comm.comm_world.bcast(completed)
+    return completed
+
+
+def record_outputs(args, comm, mc, outpath):
+    """ Add the outputs of a completed realization to the run manifest
+    """
+    comm.comm_world.barrier()
+    if comm.world_rank == 0:
+        manifest = RunManifest(args.outdir)
+        for alternatives in expected_outputs(args, outpath):
+            for fname in alternatives:
+                if os.path.isfile(fname):
+                    manifest.record(mc, fname)
+                    break
             else:
-                print(f"{fname} does not exist", flush=True)
-        if there and (args.filterbin_ground_order or args.filterbin_poly_order):
-            fname = os.path.join(
-                outpath,
-                args.filterbin_prefix + "_telescope_all_time_all_filtered.fits",
+                print(f"{alternatives[0]} does not exist", flush=True)
+    return
+
+
+def simulate_signal(args, comm, data, mc, totalname, signalname, purge):
+    """ Simulate the total signal of one realization.
+
+    The cached signal under totalname must be empty.
+
+    """
+    s4_tools.allocate_tod(args, data, totalname)
+
+    with s4_tools.profile_stage("atmosphere", mc=mc):
+        toast_tools.simulate_atmosphere(args, comm, data, mc, totalname)
+
+    if args.fused_signal:
+        with s4_tools.profile_stage("assemble_signal", mc=mc):
+            s4_tools.assemble_signal(
+                args, comm, data, mc, totalname, signalname, purge=purge
             )
-            there = os.path.isfile(fname) or os.path.isfile(fname + ".gz")
-            if there:
-                print(f"{fname} exists", flush=True)
-            else:
-                print(f"{fname} does not exist", flush=True)
-    there = comm.comm_world.bcast(there)
-    return there
+
+        memreport("after assembling signal", comm.comm_world)
+    else:
+        with s4_tools.profile_stage("scale_atmosphere", mc=mc):
+            s4_tools.scale_atmosphere_by_bandpass(args, comm, data, totalname, mc)
+
+        memreport("after atmosphere", comm.comm_world)
+
+        # update_atmospheric_noise_weights(args, comm, data, freq, mc)
+
+        with s4_tools.profile_stage("add_signal", mc=mc):
+            toast_tools.add_signal(
+                args, comm, data, totalname, signalname, purge=purge
+            )
+
+        memreport("after adding sky", comm.comm_world)
+
+        with s4_tools.profile_stage("noise", mc=mc):
+            toast_tools.simulate_noise(args, comm, data, mc, totalname)
+
+        memreport("after simulating noise", comm.comm_world)
+
+        with s4_tools.profile_stage("sss", mc=mc):
+            toast_tools.simulate_sss(args, comm, data, mc, totalname)
+
+        memreport("after simulating SSS", comm.comm_world)
+
+        with s4_tools.profile_stage("gains", mc=mc):
+            toast_tools.scramble_gains(args, comm, data, mc, totalname)
+    return
 
 
 def pairdiff(data, args, comm, name, do_pointing):
@@ -222,35 +318,32 @@ def pairdiff(data, args, comm, name, do_pointing):
     if comm.comm_world.rank == 0:
         print("Pair differencing data", flush=True)
 
+    # One work buffer per dtype, shared by all pairs
+    scratch = dict()
     for obs in data.obs:
         tod = obs["tod"]
-        for det in tod.local_dets:
-            signal = tod.local_signal(det, name)
-            if det.endswith("A"):
-                pairdet = det[:-1] + "B"
-                if pairdet not in tod.local_dets:
-                    raise RuntimeError(
-                        "Detector pair not available ({}, {})".format(det, pairdet)
-                    )
-            else:
-                continue
+        # The pairs only depend on the local detectors
+        if "detector_pairs" not in obs:
+            obs["detector_pairs"] = s4sim.pairdiff.pair_indices(tod.local_dets)
+        for det, pairdet in obs["detector_pairs"]:
             # signal
-            pairsignal = tod.local_signal(pairdet, name)
-            signal[:], pairsignal[:] = [
-                0.5 * (signal + pairsignal), 0.5 * (signal - pairsignal)
-            ]
-            if do_pointing:
+            s4sim.pairdiff.sum_difference(
+                tod.local_signal(det, name), tod.local_signal(pairdet, name), scratch
+            )
+            if do_pointing and not obs.get("pairdiff_pointing", False):
                 # flags
-                flags = tod.local_flags(det)
-                pairflags = tod.local_flags(pairdet)
-                flags |= pairflags
-                pairflags[:] = flags
+                s4sim.pairdiff.merge_flags(
+                    tod.local_flags(det), tod.local_flags(pairdet)
+                )
                 # pointing weights
-                weights = tod.cache.reference("weights_" + det)
-                pairweights = tod.cache.reference("weights_" + pairdet)
-                weights[:], pairweights[:] = [
-                    0.5 * (weights + pairweights), 0.5 * (weights - pairweights)
-                ]
+                s4sim.pairdiff.sum_difference(
+                    tod.cache.reference("weights_" + det),
+                    tod.cache.reference("weights_" + pairdet),
+                    scratch,
+                )
+        if do_pointing:
+            # The pointing of each observation is only differenced once
+            obs["pairdiff_pointing"] = True
 
     if comm.comm_world.rank == 0:
         print("Pair differenced in {:.1f} s".format(time() - t1), flush=True)
@@ -269,6 +362,8 @@ def main():
 
     args, comm = parse_arguments(comm)
 
+    s4_tools.setup_profiling(args, comm)
+
     # Initialize madam parameters
 
     madampars = toast_tools.setup_madam(args)
@@ -283,12 +378,14 @@ def main():
 
     # load or simulate the focalplane
 
-    detweights = s4_tools.load_focalplanes(args, comm, schedules)
+    with s4_tools.profile_stage("load_focalplanes"):
+        detweights = s4_tools.load_focalplanes(args, comm, schedules)
 
     # Create the TOAST data object to match the schedule.  This will
     # include simulating the boresight pointing.
 
-    data, telescope_data = s4_tools.create_observations(args, comm, schedules)
+    with s4_tools.profile_stage("create_observations"):
+        data, telescope_data = s4_tools.create_observations(args, comm, schedules)
 
     memreport("after creating observations", comm.comm_world)
 
@@ -305,7 +402,8 @@ def main():
     # Expand boresight quaternions into detector pointing weights and
     # pixel numbers
 
-    toast_tools.expand_pointing(args, comm, data)
+    with s4_tools.profile_stage("expand_pointing"):
+        s4_tools.expand_pointing(args, comm, data)
 
     # Only purge the pointing if we are NOT going to export the
     # data to a TIDAS volume
@@ -331,9 +429,11 @@ def main():
             focalplanes = [s.telescope.focalplane.detector_data for s in schedules]
         else:
             focalplanes = [telescope.focalplane.detector_data]
-        signalname = s4_tools.simulate_sky_signal(args, comm, data, focalplanes)
+        with s4_tools.profile_stage("pysm"):
+            signalname = s4_tools.simulate_sky_signal(args, comm, data, focalplanes)
     else:
-        signalname = toast_tools.scan_sky_signal(args, comm, data)
+        with s4_tools.profile_stage("scan_sky"):
+            signalname = toast_tools.scan_sky_signal(args, comm, data)
 
     memreport("after PySM", comm.comm_world)
 
@@ -342,6 +442,8 @@ def main():
     firstmc = int(args.MC_start)
     nmc = int(args.MC_count)
 
+    completed = outputs_exist(args, comm, firstmc, nmc)
+
     for mc in range(firstmc, firstmc + nmc):
 
         if comm.world_rank == 0:
@@ -350,39 +452,55 @@ def main():
         # Uncomment to run with new TOAST
         #toast_tools.draw_weather(args, comm, data, mc)
 
-        outpath = setup_output(args, comm, mc)
-
-        if outputs_exist(args, comm, outpath):
+        if mc in completed:
             if comm.world_rank == 0:
                 log.info("Outputs already exist, skipping.")
             continue
 
-        toast.tod.OpCacheClear(totalname).exec(data)
-
-        toast_tools.simulate_atmosphere(args, comm, data, mc, totalname)
-
-        s4_tools.scale_atmosphere_by_bandpass(args, comm, data, totalname, mc)
+        outpath = setup_output(args, comm, mc)
 
-        memreport("after atmosphere", comm.comm_world)
+        toast.tod.OpCacheClear(totalname).exec(data)
 
-        # update_atmospheric_noise_weights(args, comm, data, freq, mc)
+        if args.checkpoint:
+            # Process a few observations at a time and bin them
+            checkpoint = s4_tools.MapCheckpoint(args, comm, data, outpath, detweights)
+            for step_data in checkpoint.pending():
+                simulate_signal(
+                    args,
+                    comm,
+                    step_data,
+                    mc,
+                    totalname,
+                    signalname,
+                    purge=(mc == firstmc + nmc - 1),
+                )
+                pairdiff(step_data, args, comm, totalname, True)
+                with s4_tools.profile_stage("filter", mc=mc):
+                    toast_tools.apply_common_mode_filter(
+                        args, comm, step_data, totalname
+                    )
+                    toast_tools.apply_polyfilter2D(args, comm, step_data, totalname)
+                    toast_tools.apply_polyfilter(args, comm, step_data, totalname)
+                    toast_tools.apply_groundfilter(args, comm, step_data, totalname)
+                with s4_tools.profile_stage("bin", mc=mc):
+                    checkpoint.accumulate(step_data, totalname)
+                toast.tod.OpCacheClear(totalname).exec(step_data)
+            with s4_tools.profile_stage("write_maps", mc=mc):
+                checkpoint.finalize()
+            memreport("after checkpointed binning", comm.comm_world)
+            record_outputs(args, comm, mc, outpath)
+            continue
 
-        toast_tools.add_signal(
-            args, comm, data, totalname, signalname, purge=(mc == firstmc + nmc - 1)
+        simulate_signal(
+            args,
+            comm,
+            data,
+            mc,
+            totalname,
+            signalname,
+            purge=(mc == firstmc + nmc - 1),
         )
 
-        memreport("after adding sky", comm.comm_world)
-
-        toast_tools.simulate_noise(args, comm, data, mc, totalname)
-
-        memreport("after simulating noise", comm.comm_world)
-
-        toast_tools.simulate_sss(args, comm, data, mc, totalname)
-
-        memreport("after simulating SSS", comm.comm_world)
-
-        toast_tools.scramble_gains(args, comm, data, mc, totalname)
-
         if mc == firstmc:
             # For the first realization and frequency, optionally
             # export the timestream data.
@@ -395,37 +513,40 @@ def main():
 
         # Bin and destripe maps
 
-        pairdiff(data, args, comm, totalname, mc == firstmc)
+        with s4_tools.profile_stage("pairdiff", mc=mc):
+            pairdiff(data, args, comm, totalname, mc == firstmc)
 
         if not args.skip_madam:
-            toast_tools.apply_madam(
-                args,
-                comm,
-                data,
-                madampars,
-                outpath,
-                detweights,
-                totalname,
-                time_comms=time_comms,
-                telescope_data=telescope_data,
-                first_call=(mc == firstmc),
-            )
+            with s4_tools.profile_stage("madam", mc=mc):
+                toast_tools.apply_madam(
+                    args,
+                    comm,
+                    data,
+                    madampars,
+                    outpath,
+                    detweights,
+                    totalname,
+                    time_comms=time_comms,
+                    telescope_data=telescope_data,
+                    first_call=(mc == firstmc),
+                )
             memreport("after madam", comm.comm_world)
 
         if (
                 args.filterbin_ground_order is not None
                 or args.filterbin_poly_order is not None
         ):
-            toast_tools.apply_filterbin(
-                args,
-                comm,
-                data,
-                outpath,
-                totalname,
-                time_comms=time_comms,
-                telescope_data=telescope_data,
-                first_call=(mc == firstmc),
-            )
+            with s4_tools.profile_stage("filterbin", mc=mc):
+                toast_tools.apply_filterbin(
+                    args,
+                    comm,
+                    data,
+                    outpath,
+                    totalname,
+                    time_comms=time_comms,
+                    telescope_data=telescope_data,
+                    first_call=(mc == firstmc),
+                )
 
         if (
                 args.apply_polyfilter
@@ -436,40 +557,49 @@ def main():
 
             # Filter signal
 
-            toast_tools.apply_common_mode_filter(args, comm, data, totalname)
+            with s4_tools.profile_stage("filter", mc=mc):
+                toast_tools.apply_common_mode_filter(args, comm, data, totalname)
 
-            toast_tools.apply_polyfilter2D(args, comm, data, totalname)
+                toast_tools.apply_polyfilter2D(args, comm, data, totalname)
 
-            toast_tools.apply_polyfilter(args, comm, data, totalname)
+                toast_tools.apply_polyfilter(args, comm, data, totalname)
 
-            toast_tools.apply_groundfilter(args, comm, data, totalname)
+                toast_tools.apply_groundfilter(args, comm, data, totalname)
 
             memreport("after filter", comm.comm_world)
 
             # Bin maps
 
-            toast_tools.apply_madam(
-                args,
-                comm,
-                data,
-                madampars,
-                outpath,
-                detweights,
-                totalname,
-                time_comms=time_comms,
-                telescope_data=telescope_data,
-                first_call=(args.skip_madam and mc == firstmc),
-                extra_prefix="filtered",
-                bin_only=(not args.skip_madam),
-            )
+            with s4_tools.profile_stage("madam_filtered", mc=mc):
+                toast_tools.apply_madam(
+                    args,
+                    comm,
+                    data,
+                    madampars,
+                    outpath,
+                    detweights,
+                    totalname,
+                    time_comms=time_comms,
+                    telescope_data=telescope_data,
+                    first_call=(args.skip_madam and mc == firstmc),
+                    extra_prefix="filtered",
+                    bin_only=(not args.skip_madam),
+                )
 
             memreport("after filter & bin", comm.comm_world)
 
+        record_outputs(args, comm, mc, outpath)
+
     if comm.comm_world is not None:
         comm.comm_world.barrier()
 
     memreport("at the end of the pipeline", comm.comm_world)
 
+    s4_tools.write_profile(args, comm)
+
+    # Release the node-level copies of the hardware (--hardware-shared)
+    s4_tools.free_shared()
+
     gt.stop_all()
     if mpiworld is not None:
         mpiworld.barrier()
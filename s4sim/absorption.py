@@ -0,0 +1,314 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+"""Interpolated atmospheric absorption tables.
+"""
+
+import functools
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+try:
+    from toast.atm import available_utils as atm_available_utils
+
+    if atm_available_utils:
+        from toast.atm import atm_absorption_coefficient_vec
+except ImportError:
+    from toast.todmap import atm_available_utils
+
+    if atm_available_utils:
+        from toast.todmap.atm import atm_absorption_coefficient_vec
+
+
+# Bump this if the layout of the cached nodes changes.
+TABLE_SCHEMA = 1
+
+# Number of samples of a top hat bandpass.
+TOPHAT_SAMPLES = 101
+
+
+@functools.lru_cache(maxsize=None)
+def _load_bandpass_file(path):
+    data = np.loadtxt(path)
+    data.flags.writeable = False
+    return data
+
+
+def load_bandpass(bandpass):
+    """Return the frequencies and weights of a tabulated bandpass.
+
+    Args:
+        bandpass (str or list):  Either the path of a text file with
+            frequency (GHz) and response columns, or a pair of sequences
+            [frequencies, responses].
+
+    Returns:
+        (tuple): The frequency and response arrays.
+
+    """
+    if isinstance(bandpass, str):
+        data = _load_bandpass_file(bandpass)
+        return data[:, 0], data[:, 1]
+    freqs, weights = bandpass
+    return np.asarray(freqs, dtype=np.float64), np.asarray(weights, dtype=np.float64)
+
+
+def band_average(freqs, values, center, width, bandpass=None):
+    """Average a spectrum over a bandpass.
+
+    Without a tabulated bandpass this is the mean over a top hat of the
+    given center and width.
+
+    Args:
+        freqs (array): The frequencies of the spectrum in GHz.
+        values (array): The spectrum.
+        center (float): The band center in GHz.
+        width (float): The band width in GHz.
+        bandpass (str or list, optional):  A tabulated bandpass, see
+            load_bandpass().  Empty strings are ignored.
+
+    Returns:
+        (float): The band average.
+
+    """
+    if bandpass is None or (isinstance(bandpass, str) and bandpass == ""):
+        band_freqs = np.linspace(center - width / 2, center + width / 2, TOPHAT_SAMPLES)
+        return np.mean(np.interp(band_freqs, freqs, values))
+    band_freqs, weights = load_bandpass(bandpass)
+    return np.sum(weights * np.interp(band_freqs, freqs, values)) / np.sum(weights)
+
+
+class AbsorptionTable(object):
+    """Atmospheric absorption spectra interpolated in weather parameters.
+
+    The absorption coefficient returned by libaatm depends only on the
+    altitude, air temperature, surface pressure and PWV.  For one altitude
+    this table stores spectra on a regular (PWV, temperature, pressure)
+    grid and interpolates linearly between the 8 grid nodes surrounding
+    the requested weather.  Nodes are computed with libaatm the first time
+    they are needed and, if a cache directory is given, stored on disk so
+    that later observations, realizations and jobs reuse them.
+
+    With the default steps the interpolation error of band-averaged
+    absorption is below 0.1%.  Use error() to check a given weather.
+
+    Args:
+        altitude (float): The site altitude in meters.
+        cache_dir (str, optional): Directory of the persistent nodes.
+        freqmin (float): The lowest frequency in GHz.
+        freqmax (float): The highest frequency in GHz.
+        nfreq (int): The number of frequencies.
+        pwv_step (float): Grid step in PWV (mm).
+        temperature_step (float): Grid step in air temperature (K).
+        pressure_step (float): Grid step in surface pressure (Pa).
+
+    """
+
+    def __init__(
+        self,
+        altitude,
+        cache_dir=None,
+        freqmin=0,
+        freqmax=1000,
+        nfreq=10001,
+        pwv_step=0.1,
+        temperature_step=2.5,
+        pressure_step=1000.0,
+    ):
+        self.altitude = float(altitude)
+        self.freqmin = float(freqmin)
+        self.freqmax = float(freqmax)
+        self.nfreq = int(nfreq)
+        self.steps = np.array(
+            [pwv_step, temperature_step, pressure_step], dtype=np.float64
+        )
+        self.freqs = np.linspace(self.freqmin, self.freqmax, self.nfreq)
+        self._nodes = dict()
+        self.cache_dir = None
+        if cache_dir is not None:
+            key = {
+                "altitude": self.altitude,
+                "freqs": [self.freqmin, self.freqmax, self.nfreq],
+                "steps": self.steps.tolist(),
+                "schema": TABLE_SCHEMA,
+            }
+            digest = hashlib.sha256(
+                json.dumps(key, sort_keys=True).encode()
+            ).hexdigest()
+            self.cache_dir = os.path.join(
+                cache_dir, "absorption_{:.0f}m_{}".format(self.altitude, digest[:16])
+            )
+
+    def direct(self, air_temperature, surface_pressure, pwv):
+        """Compute an absorption spectrum with libaatm.
+
+        Args:
+            air_temperature (float): The air temperature in K.
+            surface_pressure (float): The surface pressure in Pa.
+            pwv (float): The precipitable water vapor in mm.
+
+        Returns:
+            (array): The absorption coefficient at every frequency.
+
+        """
+        if not atm_available_utils:
+            raise RuntimeError("Atmosphere utilities from libaatm are not available")
+        return np.asarray(
+            atm_absorption_coefficient_vec(
+                self.altitude,
+                air_temperature,
+                surface_pressure,
+                pwv,
+                self.freqmin,
+                self.freqmax,
+                self.nfreq,
+            ),
+            dtype=np.float64,
+        )
+
+    def weights(self, air_temperature, surface_pressure, pwv):
+        """Return the grid nodes and weights of the linear interpolation.
+
+        Args:
+            air_temperature (float): The air temperature in K.
+            surface_pressure (float): The surface pressure in Pa.
+            pwv (float): The precipitable water vapor in mm.
+
+        Returns:
+            (list): (node, weight) tuples, where each node is a tuple of
+                (PWV, temperature, pressure) grid indices.
+
+        """
+        point = np.array([pwv, air_temperature, surface_pressure]) / self.steps
+        lower = np.floor(point).astype(np.int64)
+        frac = point - lower
+        result = list()
+        for corner in np.ndindex(2, 2, 2):
+            corner = np.array(corner)
+            weight = np.prod(np.where(corner == 1, frac, 1 - frac))
+            if weight == 0:
+                continue
+            result.append((tuple((lower + corner).tolist()), weight))
+        return result
+
+    def _node_path(self, node):
+        return os.path.join(self.cache_dir, "node_{}_{}_{}.npy".format(*node))
+
+    def has_node(self, node):
+        """Return True if a grid node is available without libaatm."""
+        if node in self._nodes:
+            return True
+        if self.cache_dir is None or not os.path.isfile(self._node_path(node)):
+            return False
+        self._nodes[node] = np.load(self._node_path(node))
+        return True
+
+    def missing(self, air_temperature, surface_pressure, pwv):
+        """Return the grid nodes that must be computed for a weather.
+
+        Args:
+            air_temperature (float): The air temperature in K.
+            surface_pressure (float): The surface pressure in Pa.
+            pwv (float): The precipitable water vapor in mm.
+
+        Returns:
+            (list): The missing nodes.
+
+        """
+        return [
+            node
+            for node, _ in self.weights(air_temperature, surface_pressure, pwv)
+            if not self.has_node(node)
+        ]
+
+    def compute_node(self, node):
+        """Compute the spectrum of one grid node with libaatm.
+
+        Args:
+            node (tuple): The grid indices.
+
+        Returns:
+            (array): The absorption spectrum.
+
+        """
+        pwv, air_temperature, surface_pressure = (np.array(node) * self.steps).tolist()
+        return self.direct(air_temperature, surface_pressure, pwv)
+
+    def add_node(self, node, absorption, save=True):
+        """Store the spectrum of one grid node.
+
+        The node file is written under a temporary name and then renamed,
+        so that concurrent jobs never read a partial file.
+
+        Args:
+            node (tuple): The grid indices.
+            absorption (array): The absorption spectrum.
+            save (bool): If True and there is a cache directory, write the
+                node to disk.
+
+        Returns:
+            None
+
+        """
+        self._nodes[node] = absorption
+        if save and self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, temp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    np.save(f, absorption)
+                os.replace(temp, self._node_path(node))
+            finally:
+                if os.path.exists(temp):
+                    os.remove(temp)
+        return
+
+    def __call__(self, air_temperature, surface_pressure, pwv):
+        """Return the interpolated absorption spectrum.
+
+        Missing grid nodes are computed serially.
+
+        Args:
+            air_temperature (float): The air temperature in K.
+            surface_pressure (float): The surface pressure in Pa.
+            pwv (float): The precipitable water vapor in mm.
+
+        Returns:
+            (array): The absorption coefficient at every frequency.
+
+        """
+        absorption = np.zeros(self.nfreq)
+        for node, weight in self.weights(air_temperature, surface_pressure, pwv):
+            if not self.has_node(node):
+                self.add_node(node, self.compute_node(node))
+            absorption += weight * self._nodes[node]
+        return absorption
+
+    def error(self, air_temperature, surface_pressure, pwv, bands=None):
+        """Compare the interpolated absorption against libaatm.
+
+        Args:
+            air_temperature (float): The air temperature in K.
+            surface_pressure (float): The surface pressure in Pa.
+            pwv (float): The precipitable water vapor in mm.
+            bands (list, optional): (center, width) tuples in GHz.  If given,
+                the error of the top hat band averages is returned instead
+                of the error of the spectrum.
+
+        Returns:
+            (float): The largest relative error.
+
+        """
+        interp = self(air_temperature, surface_pressure, pwv)
+        direct = self.direct(air_temperature, surface_pressure, pwv)
+        if bands is None:
+            return np.max(np.abs(interp - direct)) / np.max(np.abs(direct))
+        err = 0
+        for center, width in bands:
+            a = band_average(self.freqs, interp, center, width)
+            b = band_average(self.freqs, direct, center, width)
+            err = max(err, abs(a / b - 1))
+        return err
@@ -0,0 +1,190 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+"""Load balancing of detectors and observations.
+"""
+
+import numpy as np
+
+
+def pair_prefixes(names):
+    """Return the name of the detector pair of every detector.
+
+    Detectors whose names differ only in the last character (the A / B
+    polarization) belong to the same pair.
+
+    Args:
+        names (list): The detector names.
+
+    Returns:
+        (array): The pair name of every detector.
+
+    """
+    return np.array([x[:-1] for x in names])
+
+
+def count_detbreaks(names, ndetrank):
+    """Split sorted detectors into groups of at most ndet / ndetrank.
+
+    This is the traditional partition:  detectors are accumulated until the
+    target count is reached and the group is closed at the next pair
+    boundary.
+
+    Args:
+        names (list): The sorted detector names.
+        ndetrank (int): The number of detector ranks.
+
+    Returns:
+        (list): The indices where a new group starts.
+
+    """
+    ndet = len(names)
+    if ndet == 0:
+        return []
+    ndet_target = ndet // ndetrank
+    if ndet_target * ndetrank < ndet:
+        ndet_target += 1
+    prefixes = pair_prefixes(names)
+    # Candidate breaks are the starts of all pairs except the first
+    candidates = np.flatnonzero(prefixes[1:] != prefixes[:-1]) + 1
+    # Every group closes at the first pair boundary that is at least
+    # ndet_target detectors past its start
+    detbreaks = []
+    start = 0
+    while True:
+        i = np.searchsorted(candidates, start + ndet_target)
+        if i == len(candidates):
+            break
+        start = int(candidates[i])
+        detbreaks.append(start)
+    return detbreaks
+
+
+def detector_costs(groups, nsample, overhead=0):
+    """Return the relative cost of every detector in an observation.
+
+    The work and memory of a wafer grow with the number of samples times
+    the number of its detectors, plus an optional fixed overhead per
+    wafer.  A wafer of n detectors costs nsample * (n + overhead), which
+    is shared evenly between its detectors.
+
+    Args:
+        groups (list): The wafer of every detector.
+        nsample (int): The number of samples in the observation.
+        overhead (float): The fixed cost of a wafer, in detectors.
+
+    Returns:
+        (array): The cost of every detector.
+
+    """
+    _, inverse, counts = np.unique(
+        np.asarray(groups), return_inverse=True, return_counts=True
+    )
+    return float(nsample) * (1 + overhead / counts[inverse].astype(np.float64))
+
+
+def balanced_detbreaks(names, ndetrank, costs=None):
+    """Split sorted detectors into groups of equal cost.
+
+    Groups are only split between detector pairs.  Each break is placed at
+    the pair boundary closest to the ideal cumulative cost, so the cost of
+    every group is within one pair of the average.
+
+    Args:
+        names (list): The sorted detector names.
+        ndetrank (int): The number of detector ranks.
+        costs (array, optional): The relative cost of every detector.  The
+            default is a uniform cost.
+
+    Returns:
+        (list): The indices where a new group starts.
+
+    """
+    ndet = len(names)
+    if ndetrank < 2 or ndet == 0:
+        return []
+    if costs is None:
+        costs = np.ones(ndet)
+    costs = np.asarray(costs, dtype=np.float64)
+    prefixes = pair_prefixes(names)
+    # Candidate breaks are the starts of all pairs except the first
+    candidates = np.flatnonzero(prefixes[1:] != prefixes[:-1]) + 1
+    if len(candidates) == 0:
+        return []
+    cumulative = np.cumsum(costs)
+    # Cost of everything before each candidate break
+    before = cumulative[candidates - 1]
+    targets = cumulative[-1] * np.arange(1, ndetrank) / ndetrank
+    right = np.clip(np.searchsorted(before, targets), 0, len(candidates) - 1)
+    left = np.clip(right - 1, 0, len(candidates) - 1)
+    choose_left = np.abs(before[left] - targets) <= np.abs(before[right] - targets)
+    best = np.where(choose_left, left, right)
+    return np.unique(candidates[best]).tolist()
+
+
+def distribute_weighted(weights, ngroups, breaks=None):
+    """Distribute weighted items between groups.
+
+    The items between consecutive breaks form a segment.  Every segment is
+    first given a number of groups proportional to its total weight (at
+    least one), and the items of a segment are then assigned to its groups
+    with the longest processing time (LPT) rule:  from the heaviest to the
+    lightest, each item goes to the group with the smallest total weight.
+    No group receives items from more than one segment.
+
+    Args:
+        weights (array): The weight of every item.
+        ngroups (int): The number of groups.
+        breaks (list, optional): Item indices where a new segment starts.
+
+    Returns:
+        (list): The sorted item indices of every group.
+
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    nitem = len(weights)
+    if breaks is None:
+        breaks = []
+    breaks = np.unique(breaks)
+    breaks = breaks[np.logical_and(breaks > 0, breaks < nitem)].tolist()
+    if len(breaks) > ngroups - 1:
+        raise RuntimeError(
+            "Cannot distribute {} items with {} breaks over {} groups".format(
+                nitem, len(breaks), ngroups
+            )
+        )
+    bounds = [0] + breaks + [nitem]
+
+    # Groups per segment, proportional to the remaining weight
+    groupcounts = list()
+    groupsleft = ngroups
+    weightleft = np.sum(weights)
+    for iseg in range(len(bounds) - 1):
+        if iseg == len(bounds) - 2:
+            groupcounts.append(groupsleft)
+            break
+        segweight = np.sum(weights[bounds[iseg] : bounds[iseg + 1]])
+        if weightleft > 0:
+            count = int(np.round(groupsleft * segweight / weightleft))
+        else:
+            count = 1
+        # Leave at least one group for every remaining segment
+        nlater = len(bounds) - 2 - iseg
+        count = min(max(1, count), groupsleft - nlater)
+        groupcounts.append(count)
+        groupsleft -= count
+        weightleft -= segweight
+
+    dist = list()
+    for iseg, count in enumerate(groupcounts):
+        first, last = bounds[iseg], bounds[iseg + 1]
+        items = [list() for _ in range(count)]
+        loads = np.zeros(count)
+        # Stable sort so that equal weights keep their order
+        for i in first + np.argsort(-weights[first:last], kind="stable"):
+            igroup = np.argmin(loads)
+            items[igroup].append(int(i))
+            loads[igroup] += weights[i]
+        # Keep the groups in time order
+        items.sort(key=lambda x: x[0] if len(x) > 0 else last)
+        dist.extend(sorted(x) for x in items)
+    return dist
@@ -0,0 +1,133 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+"""Two-phase checkpoints of per-process arrays.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+def _atomic_write(path, write):
+    """Call write(f) on a temporary file and rename it to path."""
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(temp, path)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+    return
+
+
+class CheckpointStore(object):
+    """Checkpoints of the arrays of every process of a job.
+
+    A checkpoint is taken in two phases.  First every process writes its
+    arrays with save(), then, once all of them are done, one process
+    writes the manifest with commit().  Every process keeps two
+    generations of files, so a job that dies while writing a checkpoint
+    still finds the previous, committed one.  The manifest records the
+    number of completed steps and the parameters that must match for the
+    checkpoint to be reused.
+
+    Args:
+        path (str): The checkpoint directory.
+        rank (int): The rank of this process.
+
+    """
+
+    def __init__(self, path, rank):
+        self.path = path
+        self.rank = rank
+
+    def _manifest(self):
+        return os.path.join(self.path, "manifest.json")
+
+    def _rank_file(self, step):
+        return os.path.join(self.path, "rank_{:06d}_{}.npz".format(self.rank, step % 2))
+
+    def committed(self, meta=None):
+        """Return the number of steps of the committed checkpoint.
+
+        Args:
+            meta (dict, optional): Parameters which must match the ones
+                given to commit().  If they differ, the checkpoint is
+                ignored.
+
+        Returns:
+            (int): The number of completed steps, zero if there is no
+                usable checkpoint.
+
+        """
+        try:
+            with open(self._manifest(), "r") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        if meta is not None and manifest["meta"] != json.loads(json.dumps(meta)):
+            return 0
+        return manifest["step"]
+
+    def save(self, step, arrays):
+        """Write the arrays of this process after a number of steps.
+
+        Args:
+            step (int): The number of completed steps.
+            arrays (dict): The arrays to save.
+
+        Returns:
+            None
+
+        """
+        os.makedirs(self.path, exist_ok=True)
+        _atomic_write(
+            self._rank_file(step),
+            lambda f: np.savez(f, step=np.array(step), **arrays),
+        )
+        return
+
+    def commit(self, step, meta=None):
+        """Record that all processes saved a number of steps.
+
+        Args:
+            step (int): The number of completed steps.
+            meta (dict, optional): JSON serializable parameters of the job.
+
+        Returns:
+            None
+
+        """
+        os.makedirs(self.path, exist_ok=True)
+        manifest = {"step": step, "meta": meta}
+        _atomic_write(
+            self._manifest(), lambda f: f.write(json.dumps(manifest).encode())
+        )
+        return
+
+    def load(self, step):
+        """Read the arrays of this process saved after a number of steps.
+
+        Args:
+            step (int): The committed number of steps.
+
+        Returns:
+            (dict): The arrays.
+
+        """
+        with np.load(self._rank_file(step)) as npz:
+            arrays = {k: npz[k] for k in npz.files}
+        if int(arrays.pop("step")) != step:
+            raise RuntimeError(
+                "Checkpoint of rank {} does not match step {}".format(self.rank, step)
+            )
+        return arrays
+
+    def clear(self):
+        """Remove the checkpoint directory."""
+        shutil.rmtree(self.path, ignore_errors=True)
+        return
@@ -9,12 +9,22 @@ dumping / loading hardware information to / from disk.
 
 # These are simply namespace imports for convenience.
 
-from .config import Hardware, sim_nominal
+from .config import (
+    Hardware,
+    HardwareIndex,
+    detector_sidecar,
+    is_binary_hardware,
+    sim_nominal,
+)
 
 from .sim import (
+    boresight_angle,
     sim_detectors_toast,
     sim_detectors_physical_optics,
     sim_telescope_detectors,
+    sim_telescope_table,
 )
 
+from .table import DetectorTable
+
 from .vis import plot_detectors, summary_text
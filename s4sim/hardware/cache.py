@@ -0,0 +1,135 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+"""On-disk cache of simulated focalplanes.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+from .config import _json_default
+from .table import DetectorTable
+
+
+# Environment variable holding the default cache directory.
+CACHE_ENV = "S4SIM_CACHE"
+
+# Bump this if the simulated detector properties change without a change
+# of the package version.
+CACHE_SCHEMA = 1
+
+
+def focalplane_cache_dir(cache_dir=None):
+    """Return the focalplane cache directory to use.
+
+    Args:
+        cache_dir (str, optional): An explicit directory.  If None, the
+            S4SIM_CACHE environment variable is used.
+
+    Returns:
+        (str): The directory, or None if caching is disabled.
+
+    """
+    if cache_dir is not None:
+        return cache_dir
+    cache_dir = os.environ.get(CACHE_ENV, "")
+    if cache_dir == "":
+        return None
+    return cache_dir
+
+
+def hardware_hash(hw, tele, tubes):
+    """Compute the content hash of a focalplane simulation.
+
+    The hash covers all hardware metadata except the detectors, the
+    telescope and tube selection and the s4sim version.
+
+    Args:
+        hw (Hardware): The hardware object.
+        tele (str): The telescope name.
+        tubes (list): The tubes being simulated.
+
+    Returns:
+        (str): The hex digest.
+
+    """
+    from .. import __version__
+
+    config = {k: v for k, v in hw.data.items() if k != "detectors"}
+    key = {
+        "config": config,
+        "telescope": tele,
+        "tubes": list(tubes),
+        "version": __version__,
+        "schema": CACHE_SCHEMA,
+    }
+    dstr = json.dumps(key, sort_keys=True, default=_json_default)
+    return hashlib.sha256(dstr.encode()).hexdigest()
+
+
+def cache_path(cache_dir, hw, tele, tubes):
+    """Return the cache file of a focalplane simulation.
+
+    Args:
+        cache_dir (str): The cache directory.
+        hw (Hardware): The hardware object.
+        tele (str): The telescope name.
+        tubes (list): The tubes being simulated.
+
+    Returns:
+        (str): The path of the detector table file.
+
+    """
+    digest = hardware_hash(hw, tele, tubes)
+    return os.path.join(cache_dir, f"focalplane_{tele}_{digest}.npz")
+
+
+def load_cached_detectors(cache_dir, hw, tele, tubes):
+    """Load a previously simulated focalplane.
+
+    Args:
+        cache_dir (str): The cache directory.
+        hw (Hardware): The hardware object.
+        tele (str): The telescope name.
+        tubes (list): The tubes being simulated.
+
+    Returns:
+        (DetectorTable): The memory-mapped detectors, or None if they are
+            not in the cache.
+
+    """
+    path = cache_path(cache_dir, hw, tele, tubes)
+    if not os.path.isfile(path):
+        return None
+    return DetectorTable.load(path)
+
+
+def save_cached_detectors(cache_dir, hw, tele, tubes, dets):
+    """Store a simulated focalplane in the cache.
+
+    The file is written under a temporary name and then renamed, so that
+    concurrent jobs never read a partial file.
+
+    Args:
+        cache_dir (str): The cache directory.
+        hw (Hardware): The hardware object.
+        tele (str): The telescope name.
+        tubes (list): The tubes being simulated.
+        dets (DetectorTable): The simulated detectors.
+
+    Returns:
+        (str): The path of the cache file.
+
+    """
+    path = cache_path(cache_dir, hw, tele, tubes)
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, temp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    os.close(fd)
+    try:
+        dets.save(temp, overwrite=True)
+        os.replace(temp, path)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+    return path
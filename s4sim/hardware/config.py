@@ -6,6 +6,8 @@
 import os
 import re
 import copy
+import json
+import zipfile
 
 from collections import OrderedDict
 
@@ -13,7 +15,179 @@ import gzip
 
 import numpy as np
 
-import toml
+from .table import DetectorTable, load_npz_memmap
+from .tomlio import CHUNK_SIZE, read_toml, write_toml
+
+
+# Format tag of binary hardware files.  Bump the version if the layout of the
+# file changes.
+BINARY_FORMAT = "s4sim-hardware"
+BINARY_VERSION = 1
+
+# Member names of binary hardware files.
+_BIN_FORMAT = "format"
+_BIN_SECTIONS = "sections"
+_BIN_META_PREFIX = "meta."
+_BIN_DET_PREFIX = "detectors."
+
+
+def detector_sidecar(path):
+    """Return the path of the columnar detector file for a hardware file.
+
+    Args:
+        path (str): The TOML hardware file.
+
+    Returns:
+        (str): The sidecar path, with any ".toml" / ".gz" suffix replaced.
+
+    """
+    root = path
+    for ext in [".gz", ".toml"]:
+        if root.endswith(ext):
+            root = root[: -len(ext)]
+    return root + ".detectors.npz"
+
+
+def _json_default(obj):
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    return str(obj)
+
+
+def is_binary_hardware(path):
+    """Return True if a file is in the binary hardware format.
+
+    Args:
+        path (str): The file to check.
+
+    Returns:
+        (bool): True if the file was written by Hardware.dump(binary=True).
+
+    """
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path, "r") as zf:
+        return "{}.npy".format(_BIN_FORMAT) in zf.namelist()
+
+
+class _Match(object):
+    """A compiled detector property matching expression.
+
+    A list of plain strings is matched by set membership.  A list containing
+    regex patterns is matched against the anchored alternation of its
+    entries, and a string is used as a regex.
+
+    Args:
+        expr (str or list): The matching expression.
+
+    """
+
+    def __init__(self, expr):
+        self._values = None
+        self._regex = None
+        if isinstance(expr, list):
+            if all(isinstance(x, str) and re.escape(x) == x for x in expr):
+                self._values = set(expr)
+            else:
+                self._regex = re.compile(r"(^" + "$|^".join(expr) + r"$)")
+        else:
+            self._regex = re.compile(expr)
+        self._memo = dict()
+
+    def test(self, value):
+        """Return True if a single value matches."""
+        try:
+            return self._memo[value]
+        except KeyError:
+            pass
+        if self._values is not None:
+            result = value in self._values
+        else:
+            result = self._regex.match(value) is not None
+        self._memo[value] = result
+        return result
+
+    def __call__(self, values):
+        """Return a boolean array of the matching entries of an array."""
+        if self._values is not None:
+            return np.isin(values, list(self._values))
+        return np.array([self.test(x) for x in values.tolist()], dtype=bool)
+
+
+class HardwareIndex(object):
+    """Reverse lookups through the hardware hierarchy.
+
+    The maps go from each element to its parent:  wafer to tube, tube to
+    telescope, telescope to site (for telescopes which specify one), card
+    to crate, as well as the combined wafer to telescope, card and crate
+    maps.
+
+    Args:
+        data (dict): The hardware data.
+
+    """
+
+    # The sections which define the hierarchy
+    sections = ["telescopes", "tubes", "wafers", "crates"]
+
+    def __init__(self, data):
+        self.tube_telescope = dict()
+        self.telescope_site = dict()
+        for tele, props in data.get("telescopes", dict()).items():
+            for tb in props["tubes"]:
+                self.tube_telescope[tb] = tele
+            if "site" in props:
+                self.telescope_site[tele] = props["site"]
+
+        self.wafer_tube = dict()
+        for tb, props in data.get("tubes", dict()).items():
+            for wf in props["wafers"]:
+                self.wafer_tube[wf] = tb
+
+        self.card_crate = dict()
+        for crate, props in data.get("crates", dict()).items():
+            for card in props["cards"]:
+                self.card_crate[card] = crate
+
+        self.wafer_card = dict()
+        self.wafer_crate = dict()
+        self.wafer_telescope = dict()
+        for wf, props in data.get("wafers", dict()).items():
+            self.wafer_card[wf] = props["card"]
+            if props["card"] in self.card_crate:
+                self.wafer_crate[wf] = self.card_crate[props["card"]]
+            if self.wafer_tube.get(wf, None) in self.tube_telescope:
+                self.wafer_telescope[wf] = self.tube_telescope[self.wafer_tube[wf]]
+
+    def tube(self, wafer):
+        """Return the tube of a wafer.
+
+        Args:
+            wafer (str): The wafer name.
+
+        Returns:
+            (str): The tube name.
+
+        """
+        try:
+            return self.wafer_tube[wafer]
+        except KeyError:
+            raise RuntimeError("Unable to match wafer {} to a tube".format(wafer))
+
+    def telescope(self, tube):
+        """Return the telescope of a tube.
+
+        Args:
+            tube (str): The tube name.
+
+        Returns:
+            (str): The telescope name.
+
+        """
+        try:
+            return self.tube_telescope[tube]
+        except KeyError:
+            raise RuntimeError("Unable to match tube {} to a telescope".format(tube))
 
 
 class Hardware(object):
@@ -22,28 +196,80 @@ class Hardware(object):
     The data is stored in a dictionary, and can be loaded / dumped to disk
     as well as trimmed to include only a subset of detectors.
 
+    The detector properties are either a dictionary of detector dictionaries
+    or, in columnar mode, a DetectorTable which stores each property as a
+    numpy array.  Both support the same dictionary-style access.
+
     Args:
         path (str, optional): If specified, configuration is loaded from this
             file during construction.
+        columnar (bool): If True, store the detectors in a DetectorTable.
 
     """
 
-    def __init__(self, path=None):
+    def __init__(self, path=None, columnar=False):
         self.data = OrderedDict()
+        self._index = None
+        self._index_key = None
         if path is not None:
-            self.load(path)
+            self.load(path, columnar=columnar)
+
+    @property
+    def columnar(self):
+        """(bool): True if the detectors are stored in a DetectorTable."""
+        return isinstance(self.data.get("detectors", None), DetectorTable)
+
+    def to_columnar(self):
+        """Convert the detector properties to a DetectorTable in place.
+
+        Returns:
+            None
+
+        """
+        if "detectors" in self.data and not self.columnar:
+            self.data["detectors"] = DetectorTable.from_dict(self.data["detectors"])
+        return
+
+    def to_dict(self):
+        """Convert the detector properties to a dictionary in place.
+
+        Returns:
+            None
 
-    def dump(self, path, overwrite=False, compress=False):
+        """
+        if self.columnar:
+            self.data["detectors"] = self.data["detectors"].to_dict()
+        return
+
+    def dump(
+        self,
+        path,
+        overwrite=False,
+        compress=False,
+        columnar=False,
+        binary=False,
+        chunk_size=CHUNK_SIZE,
+    ):
         """Write hardware config to a TOML file.
 
         Dump data to a TOML format file, optionally compressing the contents
-        with gzip and optionally overwriting the file.
+        with gzip and optionally overwriting the file.  If columnar is True,
+        the detectors are written to a memory-mappable sidecar file (see
+        detector_sidecar()) and the TOML file contains the other sections.
+
+        The detectors are encoded and written chunk_size detectors at a time,
+        so memory use does not grow with the size of the document.  If binary
+        is True, a single binary file is written instead (see dump_binary())
+        and the compress and columnar options are ignored.
 
         Args:
             path (str): The file to write.
             overwrite (bool): If True, overwrite the file if it exists.
                 If False, then existing files will cause an exception.
             compress (bool): If True, compress the data with gzip on write.
+            columnar (bool): If True, write the detectors to a sidecar file.
+            binary (bool): If True, write the binary format.
+            chunk_size (int): The number of detectors to encode at once.
 
         Returns:
             None
@@ -56,21 +282,79 @@ class Hardware(object):
                 raise RuntimeError(
                     "Dump path {} already exists.  Use overwrite option".format(path)
                 )
+        if binary:
+            self.dump_binary(path)
+            return
+        if columnar and "detectors" in self.data:
+            dets = self.data["detectors"]
+            if not isinstance(dets, DetectorTable):
+                dets = DetectorTable.from_dict(dets)
+            dets.save(detector_sidecar(path), overwrite=overwrite)
+        if columnar:
+            data = OrderedDict(
+                [(k, v) for k, v in self.data.items() if k != "detectors"]
+            )
+        else:
+            data = self.data
         if compress:
-            with gzip.open(path, "wb") as f:
-                dstr = toml.dumps(self.data)
-                f.write(dstr.encode())
+            with gzip.open(path, "wt") as f:
+                write_toml(data, f, chunk_size=chunk_size)
         else:
             with open(path, "w") as f:
-                dstr = toml.dumps(self.data)
-                f.write(dstr)
+                write_toml(data, f, chunk_size=chunk_size)
+        return
+
+    def dump_binary(self, path, overwrite=False):
+        """Write hardware config to a binary file.
+
+        The file is an uncompressed zip archive of .npy members, like the
+        files written by numpy.savez.  Each non-detector section (telescopes,
+        tubes, wafers, cards, crates, bands, ...) is stored as a JSON string
+        and the detectors are stored as the typed columns of a DetectorTable,
+        which load_binary() memory-maps.  No pickled objects are written.
+
+        Args:
+            path (str): The file to write.
+            overwrite (bool): If True, overwrite the file if it exists.
+                If False, then existing files will cause an exception.
+
+        Returns:
+            None
+
+        """
+        if os.path.exists(path):
+            if overwrite:
+                os.remove(path)
+            else:
+                raise RuntimeError(
+                    "Dump path {} already exists.  Use overwrite option".format(path)
+                )
+        arrays = OrderedDict()
+        arrays[_BIN_FORMAT] = np.array(
+            "{} {}".format(BINARY_FORMAT, BINARY_VERSION), dtype=np.str_
+        )
+        arrays[_BIN_SECTIONS] = np.array(list(self.data.keys()), dtype=np.str_)
+        for k, v in self.data.items():
+            if k == "detectors":
+                dets = v
+                if not isinstance(dets, DetectorTable):
+                    dets = DetectorTable.from_dict(dets)
+                arrays.update(dets.to_arrays(prefix=_BIN_DET_PREFIX))
+            else:
+                arrays[_BIN_META_PREFIX + k] = np.array(
+                    json.dumps(v, default=_json_default), dtype=np.str_
+                )
+        # np.savez appends the suffix if it is missing, so use a file object.
+        with open(path, "wb") as f:
+            np.savez(f, **arrays)
         return
 
-    def load(self, path):
-        """Read data from a TOML file.
+    def load_binary(self, path):
+        """Read data from a binary file written by dump_binary().
 
-        The file can either be regular text or a gzipped version of a TOML
-        file.
+        The non-detector sections are decoded immediately.  The detector
+        columns are memory-mapped, so only the pages which are accessed are
+        read from disk.
 
         Args:
             path (str): The file to read.
@@ -79,15 +363,105 @@ class Hardware(object):
             None
 
         """
-        dstr = None
-        try:
-            with gzip.open(path, "rb") as f:
-                dstr = f.read()
-                self.data = toml.loads(dstr.decode())
-        except OSError:
+        arrays = load_npz_memmap(path)
+        fmt = str(arrays[_BIN_FORMAT][()]).split()
+        if fmt[0] != BINARY_FORMAT or int(fmt[1]) > BINARY_VERSION:
+            raise RuntimeError(
+                "{} is not a supported hardware file ({})".format(path, " ".join(fmt))
+            )
+        self.data = OrderedDict()
+        for k in arrays[_BIN_SECTIONS].tolist():
+            if k == "detectors":
+                self.data[k] = DetectorTable.from_arrays(
+                    arrays, prefix=_BIN_DET_PREFIX
+                )
+            else:
+                self.data[k] = json.loads(
+                    str(arrays[_BIN_META_PREFIX + k][()]), object_pairs_hook=OrderedDict
+                )
+        return
+
+    def load(self, path, columnar=False, chunk_size=CHUNK_SIZE):
+        """Read data from a TOML or binary file.
+
+        The file can either be regular text, a gzipped version of a TOML
+        file or a binary file written by dump_binary(), which is detected
+        automatically.  If the TOML file has no detectors and a detector
+        sidecar file exists (see dump()), the detectors are memory-mapped
+        from the sidecar.  Binary files always produce memory-mapped
+        columnar detectors.
+
+        TOML files are decompressed and parsed incrementally, chunk_size
+        tables at a time.
+
+        Args:
+            path (str): The file to read.
+            columnar (bool): If True, convert detectors read from the TOML
+                file into a DetectorTable.
+            chunk_size (int): The number of tables to parse at once.
+
+        Returns:
+            None
+
+        """
+        if is_binary_hardware(path):
+            self.load_binary(path)
+            return
+        with open(path, "rb") as f:
+            compressed = f.read(2) == b"\x1f\x8b"
+        if compressed:
+            with gzip.open(path, "rt") as f:
+                self.data = read_toml(f, columnar=columnar, chunk_size=chunk_size)
+        else:
             with open(path, "r") as f:
-                dstr = f.read()
-                self.data = toml.loads(dstr)
+                self.data = read_toml(f, columnar=columnar, chunk_size=chunk_size)
+        sidecar = detector_sidecar(path)
+        if "detectors" not in self.data and os.path.isfile(sidecar):
+            self.data["detectors"] = DetectorTable.load(sidecar)
+        return
+
+    def index(self):
+        """Return the hierarchy index of the current data.
+
+        The index is cached and rebuilt when any of the telescopes, tubes,
+        wafers or crates sections is replaced (for example by load() or by
+        assigning a new dictionary).  Call invalidate_index() after
+        modifying these sections in place.
+
+        Returns:
+            (HardwareIndex): The index.
+
+        """
+        key = [self.data.get(x, None) for x in HardwareIndex.sections]
+        if self._index is None or any(
+            x is not y for x, y in zip(key, self._index_key)
+        ):
+            self._index = HardwareIndex(self.data)
+            self._index_key = key
+        return self._index
+
+    def invalidate_index(self):
+        """Discard the cached hierarchy index.
+
+        Returns:
+            None
+
+        """
+        self._index = None
+        self._index_key = None
+        return
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_index"] = None
+        state["_index_key"] = None
+        return state
+
+    def __setstate__(self, state):
+        # Objects pickled by older versions have no cached index
+        self.__dict__.update(state)
+        self._index = None
+        self._index_key = None
         return
 
     def wafer_map(self):
@@ -103,30 +477,13 @@ class Hardware(object):
 
         """
         result = OrderedDict()
-
-        tube_to_tele = dict()
-        for tele, props in self.data["telescopes"].items():
-            for tb in props["tubes"]:
-                tube_to_tele[tb] = tele
-
-        wafer_to_tube = dict()
-        for tb, props in self.data["tubes"].items():
-            for wf in props["wafers"]:
-                wafer_to_tube[wf] = tb
-
-        crate_to_card = dict()
-        for crate, props in self.data["crates"].items():
-            for card in props["cards"]:
-                crate_to_card[card] = crate
-
-        result["cards"] = {x: y["card"] for x, y in self.data["wafers"].items()}
-        result["crates"] = {
-            x: crate_to_card[y["card"]] for x, y in self.data["wafers"].items()
-        }
+        index = self.index()
+        result["cards"] = dict(index.wafer_card)
+        result["crates"] = {x: index.wafer_crate[x] for x in self.data["wafers"]}
         result["bands"] = {x: y["bands"] for x, y in self.data["wafers"].items()}
-        result["tubes"] = wafer_to_tube
+        result["tubes"] = dict(index.wafer_tube)
         result["telescopes"] = {
-            x: tube_to_tele[wafer_to_tube[x]] for x in list(self.data["wafers"].keys())
+            x: index.wafer_telescope[x] for x in self.data["wafers"]
         }
         return result
 
@@ -164,6 +521,11 @@ class Hardware(object):
             match (dict): The dictionary of property names and their matching
                 expressions.
 
+        Columnar detectors are selected using the inverted index of each
+        property, so every expression is evaluated once per distinct value.
+        The selected detectors share memory with this instance if they form
+        a contiguous block (for example a selection of whole wafers).
+
         Returns:
             (Hardware): A new Hardware instance with the selected detectors.
 
@@ -186,7 +548,7 @@ class Hardware(object):
 
         dets = self.data["detectors"]
 
-        # Build regex matches for each property
+        # Compile the matching expression for each property
         reg = dict()
         if "wafer" in match:
             # Handle wafer case separately, since we need to merge any
@@ -195,10 +557,7 @@ class Hardware(object):
             v = match[k]
             if wselect is None:
                 # Just the regular behavior
-                if isinstance(v, list):
-                    reg[k] = re.compile(r"(^" + "$|^".join(v) + r"$)")
-                else:
-                    reg[k] = re.compile(v)
+                reg[k] = _Match(v)
             else:
                 # Merge our selection
                 wall = list(wselect)
@@ -206,39 +565,42 @@ class Hardware(object):
                     wall.extend(v)
                 else:
                     wall.append(v)
-                reg[k] = re.compile(r"(^" + "$|^".join(wall) + r"$)")
+                reg[k] = _Match(wall)
         elif wselect is not None:
             # No pattern in the match dictionary, just our list from the
             # telescope / tube selection.
-            if wselect is None:
-                reg["wafer"] = re.compile(r".*")
-            else:
-                reg["wafer"] = re.compile(r"(^" + "$|^".join(wselect) + r"$)")
+            reg["wafer"] = _Match(wselect)
 
         for k, v in match.items():
             if k == "wafer":
                 # Already handled above
                 continue
             else:
-                if isinstance(v, list):
-                    reg[k] = re.compile(r"(^" + "$|^".join(v) + r"$)")
-                else:
-                    reg[k] = re.compile(v)
+                reg[k] = _Match(v)
 
         # Go through all detectors selecting things that match all fields
         newwafers = set()
-        newdets = OrderedDict()
-        for d, props in dets.items():
-            keep = True
+        if isinstance(dets, DetectorTable):
+            # Evaluate each expression on the distinct property values and
+            # intersect the resulting detector masks.
+            keep = np.ones(len(dets), dtype=bool)
             for k, v in reg.items():
-                if k in props:
-                    test = v.match(props[k])
-                    if test is None:
-                        keep = False
-                        break
-            if keep:
-                newwafers.add(props["wafer"])
-                newdets[d] = copy.deepcopy(props)
+                if k in dets.columns:
+                    keep &= dets.match(k, v)
+            newdets = dets.take(keep)
+            newwafers.update(newdets.value_index("wafer")[0].tolist())
+        else:
+            newdets = OrderedDict()
+            for d, props in dets.items():
+                keep = True
+                for k, v in reg.items():
+                    if k in props:
+                        if not v.test(props[k]):
+                            keep = False
+                            break
+                if keep:
+                    newwafers.add(props["wafer"])
+                    newdets[d] = copy.deepcopy(props)
 
         # Now compute the reduced set of auxilliary data needed for these
         # detectors.
@@ -3,8 +3,10 @@
 """Focalplane simulation tools.
 """
 
+import functools
 import re
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 import astropy.units as u
 import numpy as np
@@ -19,11 +21,36 @@ from toast.instrument_sim import (
 )
 import toast.qarray as qa
 
+from .cache import focalplane_cache_dir, load_cached_detectors, save_cached_detectors
+from .config import Hardware
+from .table import DetectorTable
+
 
 XAXIS, YAXIS, ZAXIS = np.eye(3)
 
 
-def sim_detectors_toast(hw, tele, tubes=None):
+def boresight_angle(quats):
+    """Compute the angular distance of detectors from the boresight.
+
+    All quaternions are rotated in one batched call.
+
+    Args:
+        quats (array): The (N, 4) detector quaternions.
+
+    Returns:
+        (array): The N angles in radians.
+
+    """
+    quats = np.atleast_2d(quats)
+    if len(quats) == 0:
+        return np.zeros(0)
+    vec = qa.rotate(quats, ZAXIS)
+    return np.arccos(np.clip(vec[:, 2], -1.0, 1.0))
+
+
+def sim_detectors_toast(
+    hw, tele, tubes=None, columnar=False, nproc=None, executor=None
+):
     """Update hardware model with simulated detector positions.
 
     Given a Hardware model, generate all detector properties for the specified
@@ -36,13 +63,19 @@ def sim_detectors_toast(hw, tele, tubes=None):
         hw (Hardware): The hardware object to update.
         tele (str): The telescope name.
         tubes (list, optional): The optional list of tube slots to include.
+        columnar (bool): If True, store new detectors in a DetectorTable.
+        nproc (int, optional): If greater than one, simulate the wafers with
+            this many processes.  With an executor, the number of its
+            workers, used to size the chunks of wafers.
+        executor (Executor, optional): Simulate the wafers with this
+            concurrent.futures executor instead of a new process pool.
 
     Returns:
         None
     
     """
     sim_telescope_detectors(
-        hw, tele, tubes=tubes,
+        hw, tele, tubes=tubes, columnar=columnar, nproc=nproc, executor=executor,
     )
 
 
@@ -141,62 +174,28 @@ def sector2(npos, pos):
     return sector
 
 
-def sim_wafer_detectors(
-    hw,
-    wafer,
-    platescale,
-    fwhm,
-    band=None,
-    partial_type=None,
-    center=np.array([0, 0, 0, 1], dtype=np.float64),
-):
-    """Generate detector properties for a wafer.
-
-    Given a Hardware configuration, generate all detector properties for
-    the specified wafer and optionally only the specified band.
+@functools.lru_cache(maxsize=None)
+def wafer_pixel_layout(packing, npix, pixsize_deg):
+    """Compute the nominal pixel layout of a wafer type.
 
-    By convention, polarization angle quantities are stored in degrees and
-    fwhm is stored in arcminutes.  These units are stripped to ease serialization
-    to TOML and JSON.  The units are restored when constructing focalplane tables
-    for TOAST.
+    The A and B polarization layouts of a wafer depend only on the packing,
+    the number of pixels and the projected pixel size.  The results are
+    cached, so that all wafers of the same type share one layout.  The
+    returned arrays are read-only.
 
     Args:
-        hw (Hardware): The hardware properties.
-        wafer (str): The wafer name.
-        platescale (float): The plate scale in degrees / mm.
-        fwhm (dict): Dictionary of nominal FWHM values in arcminutes for
-            each band.
-        band (str, optional): Optionally only use this band.
-        center (array, optional): The quaternion offset of the center.
+        packing (str): The wafer packing, "RP" (rhombus) or "HP" (hexagon).
+        npix (int): The number of pixels.
+        pixsize_deg (float): The pixel separation in degrees.
 
     Returns:
-        (OrderedDict): The properties of all selected detectors.
+        (tuple): The pixel quaternions with shape (npix, 2, 4), the layout
+            gamma angles in radians with shape (npix, 2), and the rotation
+            of the wafer with respect to the focalplane.
 
     """
-    # The properties of this wafer
-    wprops = hw.data["wafers"][wafer]
-
-    # The readout card and its properties
-    card = wprops["card"]
-    cardprops = hw.data["cards"][card]
-    
-    # The bands
-    bands = wprops["bands"]
-    if band is not None:
-        if band in bands:
-            bands = [band]
-        else:
-            msg = f"band '{band}' not valid for wafer '{wafer}'"
-            raise RuntimeError(msg)
-
-    # Lay out the pixel locations depending on the wafer type.  Also
-    # compute the polarization orientation rotation, as well as the A/B
-    # handedness for the Sinuous detectors.
-
-    npix = wprops["npixel"]
-    pixsep = platescale * wprops["pixsize"] * u.degree
-    handed = None
-    if wprops["packing"] == "RP":
+    pixsep = pixsize_deg * u.degree
+    if packing == "RP":
         # Feedhorn (NIST style)
         # The "gap" is the **additional** space beyond the normal pixel
         # separation.
@@ -237,21 +236,7 @@ def sim_wafer_detectors(
         layout_B = rhombus_hex_layout(
             nrhombus, width, "", "", gap=gap, pol=pol_B
         )
-
-        # kill pixels in partial arrays
-        if partial_type is None:
-            kill = wprops["pins"]
-        elif partial_type == "rhombus":
-            kill = np.linspace(dim**2, 3 * dim**2 - 1, 2 * dim**2, dtype=np.int32)
-        elif partial_type == "half":
-            kill1 = np.linspace(
-                0, ((dim**2 - dim) // 2 - 1), (dim**2 - dim) // 2, dtype=np.int32
-            )
-            kill2 = np.linspace(dim**2, 2 * dim**2 - 1, dim**2, dtype=np.int32)
-            kill = np.append(kill1, kill2)
-        else:
-            kill = wprops["pins"]
-    elif wprops["packing"] == "HP":
+    elif packing == "HP":
         # Hex close-packed
         # This is the center-center distance along the vertex-vertex axis
         width = (2 * (hex_nring(npix) - 1)) * pixsep
@@ -278,7 +263,102 @@ def sim_wafer_detectors(
 
         layout_A = hex_layout(npix, width, "", "", pol_A, center=hex_cent)
         layout_B = hex_layout(npix, width, "", "", pol_B, center=hex_cent)
-        
+    else:
+        msg = f"Unknown wafer packing '{packing}'"
+        raise RuntimeError(msg)
+
+    pix_quat = np.zeros((npix, 2, 4), dtype=np.float64)
+    pix_gamma = np.zeros((npix, 2), dtype=np.float64)
+    for px in range(npix):
+        if npix < 100:
+            pxstr = f"{px:02d}"
+        else:
+            pxstr = f"{px:03d}"
+        for ipol, layout in enumerate([layout_A, layout_B]):
+            pix_quat[px, ipol] = layout[pxstr]["quat"].flatten()
+            pix_gamma[px, ipol] = layout[pxstr]["gamma"]
+    pix_quat.flags.writeable = False
+    pix_gamma.flags.writeable = False
+    return pix_quat, pix_gamma, wafer_rot_rad
+
+
+def sim_wafer_table(
+    hw,
+    wafer,
+    platescale,
+    fwhm,
+    band=None,
+    partial_type=None,
+    center=np.array([0, 0, 0, 1], dtype=np.float64),
+):
+    """Generate a table of detector properties for a wafer.
+
+    Given a Hardware configuration, generate all detector properties for
+    the specified wafer and optionally only the specified band.  The
+    properties of all detectors are computed with array operations and
+    returned as columns of a DetectorTable.
+
+    By convention, polarization angle quantities are stored in degrees and
+    fwhm is stored in arcminutes.  These units are stripped to ease serialization
+    to TOML and JSON.  The units are restored when constructing focalplane tables
+    for TOAST.
+
+    Args:
+        hw (Hardware): The hardware properties.
+        wafer (str): The wafer name.
+        platescale (float): The plate scale in degrees / mm.
+        fwhm (dict): Dictionary of nominal FWHM values in arcminutes for
+            each band.
+        band (str, optional): Optionally only use this band.
+        center (array, optional): The quaternion offset of the center.
+
+    Returns:
+        (DetectorTable): The properties of all selected detectors.
+
+    """
+    # The properties of this wafer
+    wprops = hw.data["wafers"][wafer]
+
+    # The readout card and its properties
+    card = wprops["card"]
+    cardprops = hw.data["cards"][card]
+    
+    # The bands
+    bands = wprops["bands"]
+    if band is not None:
+        if band in bands:
+            bands = [band]
+        else:
+            msg = f"band '{band}' not valid for wafer '{wafer}'"
+            raise RuntimeError(msg)
+
+    # Lay out the pixel locations depending on the wafer type.  The layout
+    # only depends on the wafer type and plate scale, and is shared by all
+    # wafers of that type.
+    npix = wprops["npixel"]
+    handed = None
+    pix_quat, pix_gamma, wafer_rot_rad = wafer_pixel_layout(
+        wprops["packing"], npix, platescale * wprops["pixsize"]
+    )
+
+    if wprops["packing"] == "RP":
+        # This dim is also the number of pixels along the short axis.
+        dim = rhomb_dim(npix // 3)
+
+        # kill pixels in partial arrays
+        if partial_type is None:
+            kill = wprops["pins"]
+        elif partial_type == "rhombus":
+            kill = np.linspace(dim**2, 3 * dim**2 - 1, 2 * dim**2, dtype=np.int32)
+        elif partial_type == "half":
+            kill1 = np.linspace(
+                0, ((dim**2 - dim) // 2 - 1), (dim**2 - dim) // 2, dtype=np.int32
+            )
+            kill2 = np.linspace(dim**2, 2 * dim**2 - 1, dim**2, dtype=np.int32)
+            kill = np.append(kill1, kill2)
+        else:
+            kill = wprops["pins"]
+    else:
         if partial_type is None:
             kill = wprops["pins"]
         elif partial_type == "half":
@@ -293,85 +373,192 @@ def sim_wafer_detectors(
                     kill.append(ii)
         else:
             kill = wprops["pins"]
-    else:
-        msg = f"Unknown wafer packing '{wprops['packing']}'"
-        raise RuntimeError(msg)
-
-    # Now we go through each pixel and create the orthogonal detectors for
-    # each band.
-    dets = OrderedDict()
 
+    # Now we create the orthogonal detectors for each band of every
+    # remaining pixel.  Detectors are ordered by pixel, then band, then
+    # polarization, and all properties are computed for the whole wafer at
+    # once.
     chan_per_coax = cardprops["nchannel"] // cardprops["ncoax"]
     chan_per_bias = cardprops["nchannel"] // cardprops["nbias"]
 
-    doff = 0
-    p = 0
-    idoff = int(wafer) * 10000
-    for px in range(npix):
-        if px in kill:
-            continue
-        pstr = f"{p:03}"
-        if npix < 100:
-            pxstr = f"{px:02d}"
-        else:
-            pxstr = f"{px:03d}"
-        for b in bands:
-            for pl, layout in zip(["A", "B"], [layout_A, layout_B]):
-                dprops = OrderedDict()
-                dprops["wafer"] = wafer
-                dprops["ID"] = idoff + doff
-                dprops["pixel"] = pstr
-                dprops["band"] = b
-                dprops["fwhm"] = fwhm[b]
-                dprops["pol"] = pl
-                if handed is not None:
-                    dprops["handed"] = handed[px]
-                # Made-up assignment to readout channels
-                dprops["card"] = card
-                dprops["channel"] = doff
-                dprops["coax"] = doff // chan_per_coax
-                dprops["bias"] = doff // chan_per_bias
-
-                # Polarization angle in wafer basis.  This is the gamma angle
-                # returned by the layout functions above, less the rotation
-                # of the wafer.
-                wafer_gamma = layout[pxstr]["gamma"]
-                dprops["pol_ang_wafer"] = np.degrees(wafer_gamma - wafer_rot_rad)
-
-                # Polarization angle in focalplane basis.  This is, by
-                # definition, equal to the gamma angle computed by the layout
-                # functions.  However, we must also account for the extra rotation
-                # of the center offset passed to this function.
-                if center is not None:
-                    dprops["quat"] = qa.mult(center, layout[pxstr]["quat"]).flatten()
-                    _, _, temp_gamma = quat_to_xieta(dprops["quat"])
-                    dprops["gamma"] = np.degrees(temp_gamma)
-                else:
-                    dprops["quat"] = layout[pxstr]["quat"].flatten()
-                    dprops["gamma"] = np.degrees(wafer_gamma)
-                dprops["pol_ang"] = dprops["gamma"]
-
-                dname = f"{wafer}_{pstr}_{b}_{pl}"
-                dets[dname] = dprops
-                doff += 1
-        p += 1
-
-    return dets
-
-
-def sim_telescope_detectors(hw, tele, tubes=None):
-    """Generate detector properties for a telescope.
+    pixels = np.arange(npix)
+    if len(kill) > 0:
+        pixels = pixels[np.logical_not(np.isin(pixels, np.asarray(kill, dtype=int)))]
+    nalive = len(pixels)
+    nband = len(bands)
+    ndet = nalive * nband * 2
+    pstrs = [f"{p:03}" for p in range(nalive)]
+
+    # Pixel quaternions and layout gamma angles, with shape (nalive, 2, ...)
+    # for the A / B layouts.
+    layout_quat = pix_quat[pixels]
+    layout_gamma = pix_gamma[pixels]
+
+    # Broadcast to (nalive, nband, 2) and flatten to the detector ordering.
+    shape = (nalive, nband, 2)
+    quat = np.broadcast_to(layout_quat[:, None, :, :], shape + (4,)).reshape(-1, 4)
+    wafer_gamma = np.broadcast_to(layout_gamma[:, None, :], shape).reshape(-1)
+
+    # Polarization angle in focalplane basis.  This is, by definition, equal
+    # to the gamma angle computed by the layout functions.  However, we must
+    # also account for the extra rotation of the center offset passed to
+    # this function.
+    if center is not None:
+        quat = qa.mult(center, quat).reshape(-1, 4)
+        _, _, temp_gamma = quat_to_xieta(quat)
+        gamma = np.degrees(temp_gamma)
+    else:
+        quat = np.array(quat)
+        gamma = np.degrees(wafer_gamma)
+
+    doff = np.arange(ndet, dtype=np.int64)
+    pidx = np.repeat(np.arange(nalive), nband * 2)
+    bidx = np.tile(np.repeat(np.arange(nband), 2), nalive)
+    polidx = np.tile(np.array([0, 1]), nalive * nband)
+    pols = np.array(["A", "B"], dtype=np.str_)
+    band_arr = np.array(bands, dtype=np.str_)
+    pstr_arr = np.array(pstrs, dtype=np.str_)
+
+    columns = OrderedDict()
+    columns["wafer"] = np.full(ndet, str(wafer))
+    columns["ID"] = int(wafer) * 10000 + doff
+    columns["pixel"] = pstr_arr[pidx]
+    columns["band"] = band_arr[bidx]
+    columns["fwhm"] = np.array([fwhm[b] for b in bands], dtype=np.float64)[bidx]
+    columns["pol"] = pols[polidx]
+    if handed is not None:
+        columns["handed"] = np.asarray(handed)[pixels][pidx]
+    # Made-up assignment to readout channels
+    columns["card"] = np.full(ndet, str(card))
+    columns["channel"] = doff
+    columns["coax"] = doff // chan_per_coax
+    columns["bias"] = doff // chan_per_bias
+    # Polarization angle in wafer basis.  This is the gamma angle
+    # returned by the layout functions above, less the rotation
+    # of the wafer.
+    columns["pol_ang_wafer"] = np.degrees(wafer_gamma - wafer_rot_rad)
+    columns["quat"] = quat
+    columns["gamma"] = gamma
+    columns["pol_ang"] = np.array(gamma)
+
+    names = [
+        f"{wafer}_{pstrs[p]}_{bands[b]}_{pols[pl]}"
+        for p in range(nalive)
+        for b in range(nband)
+        for pl in range(2)
+    ]
+
+    return DetectorTable(names=names, columns=columns)
+
+
+def sim_wafer_detectors(
+    hw,
+    wafer,
+    platescale,
+    fwhm,
+    band=None,
+    partial_type=None,
+    center=np.array([0, 0, 0, 1], dtype=np.float64),
+):
+    """Generate detector properties for a wafer.
+
+    Given a Hardware configuration, generate all detector properties for
+    the specified wafer and optionally only the specified band.  This is a
+    wrapper around sim_wafer_table() which returns a dictionary.
+
+    Args:
+        hw (Hardware): The hardware properties.
+        wafer (str): The wafer name.
+        platescale (float): The plate scale in degrees / mm.
+        fwhm (dict): Dictionary of nominal FWHM values in arcminutes for
+            each band.
+        band (str, optional): Optionally only use this band.
+        center (array, optional): The quaternion offset of the center.
+
+    Returns:
+        (OrderedDict): The properties of all selected detectors.
+
+    """
+    return sim_wafer_table(
+        hw,
+        wafer,
+        platescale,
+        fwhm,
+        band=band,
+        partial_type=partial_type,
+        center=center,
+    ).to_dict()
+
+
+def _sim_wafer_task(job):
+    """Simulate one wafer in a worker process."""
+    hw, wafer, platescale, fwhm, center = job
+    return sim_wafer_table(hw, wafer, platescale, fwhm, center=center)
+
+
+def _sim_wafers(hw, wafer_jobs, fwhm, executor=None, nworker=None):
+    """Simulate a list of wafers, serially or with an executor.
+
+    Args:
+        hw (Hardware): The hardware object to use.
+        wafer_jobs (list): Tuples of (wafer, platescale, center).
+        fwhm (dict): Nominal FWHM values in arcminutes for each band.
+        executor (Executor, optional): If specified, the wafers are
+            distributed with executor.map().
+        nworker (int, optional): The number of workers of the executor.
+            If unknown, the wafers are sent one at a time.
+
+    Returns:
+        (list): The DetectorTable of each wafer, in the order of wafer_jobs.
+
+    """
+    if executor is None:
+        return [
+            sim_wafer_table(hw, wafer, platescale, fwhm, center=center)
+            for wafer, platescale, center in wafer_jobs
+        ]
+    # Only send the workers the wafer and card properties they need, not
+    # any existing detectors.
+    jobs = list()
+    for wafer, platescale, center in wafer_jobs:
+        card = hw.data["wafers"][wafer]["card"]
+        whw = Hardware()
+        whw.data["wafers"] = {wafer: hw.data["wafers"][wafer]}
+        whw.data["cards"] = {card: hw.data["cards"][card]}
+        jobs.append((whw, wafer, platescale, fwhm, center))
+    # Wafers of the same type are adjacent, so consecutive chunks let each
+    # worker reuse its cached pixel layouts.
+    if nworker is None:
+        chunksize = 1
+    else:
+        chunksize = max(1, len(jobs) // (4 * nworker))
+    return list(executor.map(_sim_wafer_task, jobs, chunksize=chunksize))
+
+
+def sim_telescope_table(hw, tele, tubes=None, nproc=None, executor=None):
+    """Generate a table of detector properties for a telescope.
 
     Given a Hardware model, generate all detector properties for the specified
-    telescope and optionally a subset of optics tubes (for the LAT).
+    telescope and optionally a subset of optics tubes (for the LAT).  The
+    hardware model is not modified.
+
+    The wafers are independent and can be simulated in parallel, either by
+    passing an existing executor (for example a ProcessPoolExecutor shared
+    across telescopes) or nproc > 1 to use a temporary process pool.  The
+    result is identical to the serial case.
 
     Args:
         hw (Hardware): The hardware object to use.
         tele (str): The telescope name.
         tubes (list, optional): The optional list of tubes to include.
+        nproc (int, optional): If greater than one, simulate the wafers with
+            this many processes.  With an executor, the number of its
+            workers, used to size the chunks of wafers.
+        executor (Executor, optional): Simulate the wafers with this
+            concurrent.futures executor instead of a new process pool.
 
     Returns:
-        (OrderedDict): The properties of all selected detectors.
+        (DetectorTable): The properties of all selected detectors.
 
     """
     zaxis = np.array([0, 0, 1], dtype=np.float64)
@@ -395,7 +582,8 @@ def sim_telescope_detectors(hw, tele, tubes=None):
                 msg = f"Invalid tube '{t}' for telescope '{tele}'"
                 raise RuntimeError(msg)
 
-    alldets = OrderedDict()
+    # The wafers to simulate and their centers
+    wafer_jobs = list()
     if ntube == 3:
         # This is a SAT.  We have three co-incident tubes.
         tubespace = teleprops["tubespace"]
@@ -442,14 +630,7 @@ def sim_telescope_detectors(hw, tele, tubes=None):
             for windx, (wafer, center) in enumerate(zip(tubeprops["wafers"], centers)):
                 wrot = qa.rotation(ZAXIS, wafer_ang_rad[windx])
                 cent = qa.mult(center, wrot)
-                dets = sim_wafer_detectors(
-                    hw,
-                    wafer,
-                    platescale,
-                    fwhm,
-                    center=cent,
-                )
-                alldets.update(dets)
+                wafer_jobs.append((wafer, platescale, cent))
     else:
         # This is the LAT.  Compute the tube centers.
         tubespace = teleprops["tubespace"]
@@ -478,16 +659,77 @@ def sim_telescope_detectors(hw, tele, tubes=None):
                     tcenters[location]["quat"],
                     qa.rotation(ZAXIS, wafer_ang_rad[windx]),
                 )
-                dets = sim_wafer_detectors(
-                    hw,
-                    wafer,
-                    platescale,
-                    fwhm,
-                    center=wcenter,
-                )
-                alldets.update(dets)
+                wafer_jobs.append((wafer, platescale, wcenter))
+
+    # Simulate each wafer, optionally in parallel.  The results are merged in
+    # the order of wafer_jobs regardless of the order they complete.
+    if executor is None and nproc is not None and nproc > 1:
+        with ProcessPoolExecutor(max_workers=nproc) as pool:
+            wafer_tables = _sim_wafers(hw, wafer_jobs, fwhm, pool, nworker=nproc)
+    else:
+        wafer_tables = _sim_wafers(hw, wafer_jobs, fwhm, executor, nworker=nproc)
+
+    return DetectorTable.concatenate(wafer_tables)
+
+
+def sim_telescope_detectors(
+    hw,
+    tele,
+    tubes=None,
+    columnar=False,
+    nproc=None,
+    executor=None,
+    cache_dir=None,
+):
+    """Generate detector properties for a telescope.
+
+    Given a Hardware model, generate all detector properties for the specified
+    telescope and optionally a subset of optics tubes (for the LAT).  The
+    detectors are added to the detector dictionary of the hardware model.
+    If the model has no detectors yet and columnar is True, they are stored
+    as a DetectorTable.  See sim_telescope_table() for details.
+
+    If a cache directory is given (or set with the S4SIM_CACHE environment
+    variable), the simulated detectors are stored there, keyed by a hash of
+    the hardware metadata, the tube selection and the s4sim version, and
+    later calls with the same inputs load them instead of simulating.
+
+    Args:
+        hw (Hardware): The hardware object to use.
+        tele (str): The telescope name.
+        tubes (list, optional): The optional list of tubes to include.
+        columnar (bool): If True, store new detectors in a DetectorTable.
+        nproc (int, optional): If greater than one, simulate the wafers with
+            this many processes.  With an executor, the number of its
+            workers, used to size the chunks of wafers.
+        executor (Executor, optional): Simulate the wafers with this
+            concurrent.futures executor instead of a new process pool.
+        cache_dir (str, optional): The focalplane cache directory.
+
+    Returns:
+        (OrderedDict): The properties of all selected detectors.
+
+    """
+    cache_dir = focalplane_cache_dir(cache_dir)
+    alldets = None
+    if cache_dir is not None:
+        cache_tubes = tubes
+        if cache_tubes is None:
+            cache_tubes = hw.data["telescopes"][tele]["tubes"]
+        alldets = load_cached_detectors(cache_dir, hw, tele, cache_tubes)
+    if alldets is None:
+        alldets = sim_telescope_table(
+            hw, tele, tubes=tubes, nproc=nproc, executor=executor
+        )
+        if cache_dir is not None:
+            save_cached_detectors(cache_dir, hw, tele, cache_tubes, alldets)
 
-    if "detectors" in hw.data:
+    if "detectors" in hw.data and len(hw.data["detectors"]) > 0:
+        if not isinstance(hw.data["detectors"], DetectorTable):
+            alldets = alldets.to_dict()
         hw.data["detectors"].update(alldets)
     else:
+        if not columnar:
+            alldets = alldets.to_dict()
         hw.data["detectors"] = alldets
+    return alldets
@@ -0,0 +1,628 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+"""Columnar detector tables.
+"""
+
+import os
+import struct
+import zipfile
+
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+import numpy as np
+
+
+# Prefixes of the members stored in a detector table file.
+_NAMES = "names"
+_COLUMNS = "columns"
+_COL_PREFIX = "col."
+_MASK_PREFIX = "mask."
+
+# Size of the fixed part of a zip local file header.
+_ZIP_LOCAL_HEADER = 30
+
+
+def _column_array(values):
+    """Convert a list of per-detector values into a typed array.
+
+    Strings become fixed-width unicode, integers int64 and floats float64.
+    Sequences (for example quaternions) are stacked into a 2D block.
+
+    Args:
+        values (list): The values of one property for all detectors.
+
+    Returns:
+        (array): The typed column.
+
+    """
+    first = values[0]
+    if isinstance(first, str):
+        return np.array(values, dtype=np.str_)
+    if isinstance(first, (bool, np.bool_)):
+        return np.array(values, dtype=bool)
+    if isinstance(first, (int, np.integer)):
+        col = np.array(values)
+        if col.dtype.kind in "iu":
+            return col.astype(np.int64)
+        return col.astype(np.float64)
+    if isinstance(first, (float, np.floating)):
+        return np.array(values, dtype=np.float64)
+    col = np.array(values)
+    if col.dtype.kind in "iu":
+        return col.astype(np.int64)
+    if col.dtype.kind == "f":
+        return col.astype(np.float64)
+    return col
+
+
+def _empty_value(col):
+    """Return a placeholder fill value matching the column type."""
+    if col.dtype.kind == "U":
+        return ""
+    return np.zeros(col.shape[1:], dtype=col.dtype)
+
+
+def _python_value(value):
+    """Convert a numpy element to the equivalent native type."""
+    if isinstance(value, np.ndarray):
+        return np.array(value)
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def load_npz_memmap(path):
+    """Memory-map the arrays of an uncompressed .npz file.
+
+    The members of a file written with np.savez are stored without
+    compression, so each array occupies a contiguous range of the file.
+    This maps every member read-only, instead of reading it into memory.
+    Members which cannot be mapped (compressed or object arrays) are read
+    normally.
+
+    Args:
+        path (str): The file to open.
+
+    Returns:
+        (dict): The arrays, keyed by member name without the ".npy" suffix.
+
+    """
+    result = dict()
+    with zipfile.ZipFile(path, "r") as zf, open(path, "rb") as f:
+        for info in zf.infolist():
+            key = info.filename
+            if key.endswith(".npy"):
+                key = key[:-4]
+            if info.compress_type != zipfile.ZIP_STORED:
+                with zf.open(info) as member:
+                    result[key] = np.lib.format.read_array(member)
+                continue
+            f.seek(info.header_offset)
+            header = f.read(_ZIP_LOCAL_HEADER)
+            name_len, extra_len = struct.unpack("<HH", header[26:30])
+            f.seek(info.header_offset + _ZIP_LOCAL_HEADER + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject:
+                raise RuntimeError(f"Cannot map object array '{key}' in {path}")
+            if int(np.prod(shape)) == 0:
+                result[key] = np.empty(shape, dtype=dtype)
+                continue
+            result[key] = np.memmap(
+                path,
+                dtype=dtype,
+                mode="r",
+                offset=f.tell(),
+                shape=shape,
+                order="F" if fortran else "C",
+            )
+    return result
+
+
+class DetectorTable(MutableMapping):
+    """Columnar storage of detector properties.
+
+    Each detector property is stored as a typed numpy array with one entry
+    per detector, and quaternions are stored as a single (N, 4) block.  The
+    table behaves like the dictionary of detector dictionaries used by the
+    Hardware class:  iterating yields detector names and indexing by name
+    returns an OrderedDict of that detector's properties.  Modifying the
+    returned dictionary does not modify the table.
+
+    Properties which are only defined for some detectors are stored with a
+    boolean mask, and are omitted from the rows of the other detectors.
+
+    Args:
+        names (array): The detector names.
+        columns (OrderedDict): Property name to array with one row per detector.
+        masks (dict, optional): Property name to boolean array of detectors
+            which define that property.
+
+    """
+
+    def __init__(self, names=None, columns=None, masks=None):
+        if names is None:
+            names = np.zeros(0, dtype=np.str_)
+        self._names = np.asarray(names)
+        if self._names.dtype.kind != "U":
+            self._names = self._names.astype(np.str_)
+        self._columns = OrderedDict()
+        if columns is not None:
+            for k, v in columns.items():
+                if len(v) != len(self._names):
+                    msg = f"Column '{k}' has {len(v)} rows, "
+                    msg += f"expected {len(self._names)}"
+                    raise ValueError(msg)
+                self._columns[k] = v
+        self._masks = dict()
+        if masks is not None:
+            self._masks.update(masks)
+        self._index = None
+        self._alive = None
+        self._value_index = dict()
+
+    @classmethod
+    def from_dict(cls, dets):
+        """Build a table from a dictionary of detector dictionaries.
+
+        Args:
+            dets (dict): Detector name to dictionary of properties.
+
+        Returns:
+            (DetectorTable): The new table.
+
+        """
+        if isinstance(dets, DetectorTable):
+            return dets.copy()
+        names = list(dets.keys())
+        ndet = len(names)
+        values = OrderedDict()
+        present = OrderedDict()
+        for row, props in enumerate(dets.values()):
+            for k, v in props.items():
+                if k not in values:
+                    values[k] = [None] * ndet
+                    present[k] = np.zeros(ndet, dtype=bool)
+                values[k][row] = v
+                present[k][row] = True
+        columns = OrderedDict()
+        masks = dict()
+        for k, vals in values.items():
+            mask = present[k]
+            if np.all(mask):
+                columns[k] = _column_array(vals)
+                continue
+            col = _column_array([x for x, m in zip(vals, mask) if m])
+            full = np.empty((ndet,) + col.shape[1:], dtype=col.dtype)
+            full[:] = _empty_value(col)
+            full[mask] = col
+            columns[k] = full
+            masks[k] = mask
+        return cls(names=np.array(names, dtype=np.str_), columns=columns, masks=masks)
+
+    def to_dict(self):
+        """Return the table as a dictionary of detector dictionaries.
+
+        Returns:
+            (OrderedDict): Detector name to OrderedDict of properties.
+
+        """
+        self._compact()
+        keys = list(self._columns.keys())
+        lists = dict()
+        for k, col in self._columns.items():
+            if col.ndim == 1:
+                lists[k] = col.tolist()
+            else:
+                lists[k] = np.array(col)
+        result = OrderedDict()
+        for row, name in enumerate(self._names.tolist()):
+            props = OrderedDict()
+            for k in keys:
+                if k in self._masks and not self._masks[k][row]:
+                    continue
+                props[k] = lists[k][row]
+            result[name] = props
+        return result
+
+    def _compact(self):
+        """Drop the rows of any detectors deleted since the last call."""
+        if self._alive is None:
+            return
+        alive = self._alive
+        self._alive = None
+        self._index = None
+        self._value_index = dict()
+        self._names = self._names[alive]
+        for k in list(self._columns.keys()):
+            self._columns[k] = self._columns[k][alive]
+        for k in list(self._masks.keys()):
+            self._masks[k] = self._masks[k][alive]
+        return
+
+    def _get_index(self):
+        if self._index is None:
+            self._index = {x: i for i, x in enumerate(self._names.tolist())}
+        return self._index
+
+    @property
+    def names(self):
+        """(array): The detector names, in table order."""
+        self._compact()
+        return self._names
+
+    @property
+    def columns(self):
+        """(OrderedDict): The property arrays, keyed by property name."""
+        self._compact()
+        return self._columns
+
+    @property
+    def masks(self):
+        """(dict): Presence masks of the partially defined properties."""
+        self._compact()
+        return self._masks
+
+    def column(self, key):
+        """Return the array of one detector property.
+
+        Args:
+            key (str): The property name.
+
+        Returns:
+            (array): The property for all detectors.
+
+        """
+        return self.columns[key]
+
+    def rows(self, names):
+        """Return the table rows of some detectors.
+
+        Args:
+            names (iterable): The detector names.
+
+        Returns:
+            (array): The row indices.
+
+        """
+        self._compact()
+        index = self._get_index()
+        return np.array([index[x] for x in names], dtype=np.int64)
+
+    def value_index(self, key):
+        """Return the inverted index of a detector property.
+
+        The index is built on first use and cached until the table is
+        modified.
+
+        Args:
+            key (str): The property name.
+
+        Returns:
+            (tuple): The sorted distinct values of the property and, for each
+                detector, the position of its value in that array.
+
+        """
+        self._compact()
+        if key not in self._value_index:
+            col = self._columns[key]
+            if col.ndim != 1:
+                raise ValueError(f"Cannot index multi-dimensional property '{key}'")
+            self._value_index[key] = np.unique(col, return_inverse=True)
+        return self._value_index[key]
+
+    def groups(self, key):
+        """Return the rows of the detectors sharing each value of a property.
+
+        Args:
+            key (str): The property name.
+
+        Returns:
+            (OrderedDict): Each distinct value, in sorted order, mapped to the
+                array of rows with that value.
+
+        """
+        values, inverse = self.value_index(key)
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.searchsorted(inverse[order], np.arange(len(values) + 1))
+        return OrderedDict(
+            [
+                (x, order[bounds[i] : bounds[i + 1]])
+                for i, x in enumerate(values.tolist())
+            ]
+        )
+
+    def match(self, key, select):
+        """Evaluate a predicate on a detector property.
+
+        The predicate is evaluated once per distinct value of the property,
+        and the result is expanded to the detectors through the inverted
+        index.  Detectors which do not define the property are selected.
+
+        Args:
+            key (str): The property name.
+            select (callable): Function taking the array of distinct values
+                and returning a boolean array.
+
+        Returns:
+            (array): Boolean array, True for the selected detectors.
+
+        """
+        values, inverse = self.value_index(key)
+        result = np.asarray(select(values), dtype=bool)[inverse]
+        if key in self._masks:
+            result |= np.logical_not(self._masks[key])
+        return result
+
+    def take(self, rows):
+        """Return a new table with a subset of the rows.
+
+        If the rows form a single contiguous range, the columns of the new
+        table are views of this table and no data is copied.
+
+        Args:
+            rows (array): Integer row indices, a boolean mask or a slice.
+
+        Returns:
+            (DetectorTable): The new table.
+
+        """
+        self._compact()
+        if isinstance(rows, slice):
+            # Basic slicing returns views of the existing columns
+            sel = rows
+        else:
+            sel = np.asarray(rows)
+            if sel.dtype == bool:
+                sel = np.flatnonzero(sel)
+            if len(sel) > 0 and sel[-1] - sel[0] + 1 == len(sel):
+                if np.all(np.diff(sel) == 1):
+                    sel = slice(int(sel[0]), int(sel[-1]) + 1)
+        columns = OrderedDict([(k, v[sel]) for k, v in self._columns.items()])
+        masks = dict()
+        for k, v in self._masks.items():
+            m = v[sel]
+            if not np.all(m):
+                masks[k] = m
+        return DetectorTable(names=self._names[sel], columns=columns, masks=masks)
+
+    def copy(self):
+        """Return a deep copy of the table, loading any memory-mapped data."""
+        self._compact()
+        return DetectorTable(
+            names=np.array(self._names),
+            columns=OrderedDict([(k, np.array(v)) for k, v in self._columns.items()]),
+            masks={k: np.array(v) for k, v in self._masks.items()},
+        )
+
+    def __len__(self):
+        if self._alive is None:
+            return len(self._names)
+        return len(self._get_index())
+
+    def __iter__(self):
+        self._compact()
+        return iter(self._names.tolist())
+
+    def __contains__(self, name):
+        return name in self._get_index()
+
+    def __getitem__(self, name):
+        row = self._get_index()[name]
+        props = OrderedDict()
+        for k, col in self._columns.items():
+            if k in self._masks and not self._masks[k][row]:
+                continue
+            props[k] = _python_value(col[row])
+        return props
+
+    def __setitem__(self, name, props):
+        self.update({name: props})
+
+    def __delitem__(self, name):
+        index = self._get_index()
+        row = index.pop(name)
+        if self._alive is None:
+            self._alive = np.ones(len(self._names), dtype=bool)
+        self._alive[row] = False
+
+    @classmethod
+    def concatenate(cls, tables):
+        """Concatenate several tables.
+
+        Properties missing from some of the tables are masked for those rows.
+        Detector names are assumed to be unique across the tables.
+
+        Args:
+            tables (list): The DetectorTable instances, in order.
+
+        Returns:
+            (DetectorTable): The new table.
+
+        """
+        tables = [x for x in tables if len(x) > 0]
+        if len(tables) == 0:
+            return cls()
+        if len(tables) == 1:
+            return tables[0].copy()
+        keys = list()
+        ref = dict()
+        for tb in tables:
+            for k, v in tb.columns.items():
+                if k not in ref:
+                    keys.append(k)
+                    ref[k] = v
+        columns = OrderedDict()
+        masks = dict()
+        for k in keys:
+            chunks = list()
+            mchunks = list()
+            for tb in tables:
+                n = len(tb.names)
+                if k in tb.columns:
+                    chunks.append(tb.columns[k])
+                    mchunks.append(tb.masks.get(k, np.ones(n, dtype=bool)))
+                else:
+                    fill = np.empty((n,) + ref[k].shape[1:], dtype=ref[k].dtype)
+                    fill[:] = _empty_value(ref[k])
+                    chunks.append(fill)
+                    mchunks.append(np.zeros(n, dtype=bool))
+            columns[k] = np.concatenate(chunks)
+            mask = np.concatenate(mchunks)
+            if not np.all(mask):
+                masks[k] = mask
+        names = np.concatenate([x.names for x in tables])
+        return cls(names=names, columns=columns, masks=masks)
+
+    def update(self, other=(), **kwargs):
+        """Add or replace detectors.
+
+        Detectors already in the table are replaced and new detectors are
+        appended, in the order of the input.
+
+        Args:
+            other (dict or DetectorTable): The detectors to add.
+
+        Returns:
+            None
+
+        """
+        if kwargs:
+            other = OrderedDict(other)
+            other.update(kwargs)
+        if not isinstance(other, DetectorTable):
+            other = DetectorTable.from_dict(OrderedDict(other))
+        if len(other) == 0:
+            return
+        for name in other:
+            if name in self:
+                del self[name]
+        new = DetectorTable.concatenate([self, other])
+        self.__dict__.update(new.__dict__)
+        return
+
+    def __eq__(self, other):
+        if not isinstance(other, DetectorTable):
+            return NotImplemented
+        if not np.array_equal(self.names, other.names):
+            return False
+        if list(self.columns.keys()) != list(other.columns.keys()):
+            return False
+        for k, v in self.columns.items():
+            if not np.array_equal(v, other.columns[k]):
+                return False
+        return True
+
+    def __repr__(self):
+        return "<DetectorTable {} detectors, columns {}>".format(
+            len(self), list(self.columns.keys())
+        )
+
+    def __reduce__(self):
+        # Pickle (and MPI broadcast) plain arrays rather than memory maps.
+        self._compact()
+        return (
+            DetectorTable,
+            (
+                np.array(self._names),
+                OrderedDict([(k, np.array(v)) for k, v in self._columns.items()]),
+                {k: np.array(v) for k, v in self._masks.items()},
+            ),
+        )
+
+    def to_arrays(self, prefix=""):
+        """Return the arrays which make up the table.
+
+        Args:
+            prefix (str): Prepended to every array name, so that several
+                tables can share one file.
+
+        Returns:
+            (OrderedDict): The arrays keyed by member name.
+
+        """
+        self._compact()
+        arrays = OrderedDict()
+        arrays[prefix + _NAMES] = self._names
+        arrays[prefix + _COLUMNS] = np.array(list(self._columns.keys()), dtype=np.str_)
+        for k, v in self._columns.items():
+            if v.dtype.hasobject:
+                raise ValueError(f"Detector property '{k}' is not a typed column")
+            arrays[prefix + _COL_PREFIX + k] = v
+        for k, v in self._masks.items():
+            arrays[prefix + _MASK_PREFIX + k] = v
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix=""):
+        """Construct a table from the arrays returned by to_arrays().
+
+        The column arrays are used without copying, so memory-mapped arrays
+        remain memory-mapped.
+
+        Args:
+            arrays (dict): The arrays keyed by member name.
+            prefix (str): The prefix of the member names of this table.
+
+        Returns:
+            (DetectorTable): The table.
+
+        """
+        columns = OrderedDict()
+        for k in arrays[prefix + _COLUMNS].tolist():
+            columns[k] = arrays[prefix + _COL_PREFIX + k]
+        masks = dict()
+        mask_prefix = prefix + _MASK_PREFIX
+        for k, v in arrays.items():
+            if k.startswith(mask_prefix):
+                masks[k[len(mask_prefix) :]] = np.array(v)
+        return cls(names=arrays[prefix + _NAMES], columns=columns, masks=masks)
+
+    def save(self, path, overwrite=False):
+        """Write the table to an uncompressed .npz file.
+
+        Args:
+            path (str): The file to write.
+            overwrite (bool): If True, overwrite the file if it exists.
+                If False, then existing files will cause an exception.
+
+        Returns:
+            None
+
+        """
+        if os.path.exists(path):
+            if overwrite:
+                os.remove(path)
+            else:
+                raise RuntimeError(
+                    "Dump path {} already exists.  Use overwrite option".format(path)
+                )
+        arrays = self.to_arrays()
+        # np.savez appends the suffix if it is missing, so use a file object.
+        with open(path, "wb") as f:
+            np.savez(f, **arrays)
+        return
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Read a table written by save().
+
+        Args:
+            path (str): The file to read.
+            mmap (bool): If True, memory-map the columns instead of reading
+                them into memory.
+
+        Returns:
+            (DetectorTable): The table.
+
+        """
+        if mmap:
+            arrays = load_npz_memmap(path)
+        else:
+            with np.load(path) as npz:
+                arrays = {k: npz[k] for k in npz.files}
+        return cls.from_arrays(arrays)
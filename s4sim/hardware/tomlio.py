@@ -0,0 +1,148 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+"""Streaming TOML input / output of hardware models.
+"""
+
+import re
+
+from collections import OrderedDict
+from collections.abc import Mapping
+
+import toml
+
+from .table import DetectorTable
+
+# Default number of detectors encoded or parsed at once.
+CHUNK_SIZE = 1000
+
+# A table header line, as written by the toml package.  Arrays of tables
+# ("[[...]]") are not part of the hardware schema.
+_HEADER = re.compile(r"^\[[^\[]")
+
+
+def _merge(dest, src):
+    """Recursively merge nested dictionaries."""
+    for k, v in src.items():
+        if k in dest and isinstance(dest[k], dict) and isinstance(v, dict):
+            _merge(dest[k], v)
+        else:
+            dest[k] = v
+    return
+
+
+def _detector_chunks(dets, chunk_size):
+    """Yield dictionaries of at most chunk_size detectors."""
+    if isinstance(dets, DetectorTable):
+        for first in range(0, len(dets), chunk_size):
+            rows = slice(first, min(first + chunk_size, len(dets)))
+            yield dets.take(rows).to_dict()
+        return
+    chunk = OrderedDict()
+    for name, props in dets.items():
+        chunk[name] = props
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = OrderedDict()
+    if len(chunk) > 0:
+        yield chunk
+    return
+
+
+def write_toml(data, f, chunk_size=CHUNK_SIZE):
+    """Write hardware data to a TOML text stream.
+
+    The output is the same document that toml.dumps() would produce for the
+    whole data dictionary, but the detectors are encoded and written
+    chunk_size detectors at a time, so the full document is never held in
+    memory.  Columnar detectors are converted to dictionaries one chunk at a
+    time.
+
+    Args:
+        data (dict): The hardware data.
+        f (file): The open text stream.
+        chunk_size (int): The number of detectors to encode at once.
+
+    Returns:
+        None
+
+    """
+    encoder = toml.TomlNumpyEncoder()
+    first = True
+
+    def _write(piece):
+        nonlocal first
+        if piece == "":
+            return
+        if not first:
+            f.write("\n")
+        f.write(piece)
+        first = False
+        return
+
+    # Top-level values are written before any table
+    _write(
+        toml.dumps(
+            OrderedDict(
+                [(k, v) for k, v in data.items() if not isinstance(v, Mapping)]
+            ),
+            encoder=encoder,
+        )
+    )
+    for k, v in data.items():
+        if k == "detectors":
+            for chunk in _detector_chunks(v, chunk_size):
+                _write(toml.dumps({k: chunk}, encoder=encoder))
+        elif isinstance(v, Mapping):
+            _write(toml.dumps({k: v}, encoder=encoder))
+    return
+
+
+def read_toml(f, columnar=False, chunk_size=CHUNK_SIZE):
+    """Read hardware data from a TOML text stream.
+
+    The stream is split at table headers into chunks of at most chunk_size
+    tables, and each chunk is parsed separately and merged into the result.
+    Only one chunk of text is held in memory at a time.  This relies on the
+    layout written by the toml package (one table header or key per line),
+    which is the case for all hardware files.
+
+    Args:
+        f (file): The open text stream.
+        columnar (bool): If True, each chunk of detectors is converted to a
+            DetectorTable as it is read, which avoids building the much
+            larger dictionary of all detectors.
+        chunk_size (int): The number of tables to parse at once.
+
+    Returns:
+        (dict): The hardware data.
+
+    """
+    data = dict()
+    tables = list()
+
+    def _parse(lines):
+        chunk = toml.loads("".join(lines))
+        for k, v in chunk.items():
+            if columnar and k == "detectors":
+                tables.append(DetectorTable.from_dict(v))
+                # Keep the position of the section
+                data.setdefault(k, None)
+            else:
+                _merge(data, {k: v})
+        return
+
+    lines = list()
+    nheader = 0
+    for line in f:
+        if _HEADER.match(line):
+            if nheader == chunk_size:
+                _parse(lines)
+                lines = list()
+                nheader = 0
+            nheader += 1
+        lines.append(line)
+    _parse(lines)
+
+    if len(tables) > 0:
+        data["detectors"] = DetectorTable.concatenate(tables)
+    return data
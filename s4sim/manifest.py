@@ -0,0 +1,127 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+"""Ledger of the completed products of a simulation run.
+"""
+
+import json
+import os
+import zlib
+
+
+MANIFEST_NAME = "manifest.jsonl"
+
+# Bytes read at a time when computing checksums.
+CHUNK_SIZE = 1 << 24
+
+
+def checksum(path):
+    """Return the CRC-32 checksum of a file as a hexadecimal string."""
+    crc = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+    return "{:08x}".format(crc)
+
+
+class RunManifest(object):
+    """Append-only record of the products written by a run.
+
+    Every completed product is one JSON line holding the Monte Carlo
+    index, the path of the product relative to the output directory, its
+    size and checksum.  Lines are appended with a single write to a file
+    opened in append mode, so that concurrent writers do not interleave
+    and a job killed while writing leaves at most one truncated line,
+    which is ignored when reading.
+
+    Args:
+        outdir (str): The output directory of the run.
+
+    """
+
+    def __init__(self, outdir):
+        self.outdir = outdir
+        self.path = os.path.join(outdir, MANIFEST_NAME)
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def record(self, mc, fname):
+        """Append a completed product to the manifest.
+
+        Args:
+            mc (int): The Monte Carlo index.
+            fname (str): The path of the product.
+
+        Returns:
+            (dict): The recorded entry.
+
+        """
+        entry = {
+            "mc": int(mc),
+            "product": os.path.relpath(fname, self.outdir),
+            "size": os.path.getsize(fname),
+            "crc32": checksum(fname),
+        }
+        line = (json.dumps(entry, sort_keys=True) + "\n").encode()
+        os.makedirs(self.outdir, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            # Terminate a line truncated by a killed job
+            size = os.fstat(fd).st_size
+            if size > 0 and os.pread(fd, 1, size - 1) != b"\n":
+                line = b"\n" + line
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        return entry
+
+    def read(self):
+        """Read the manifest.
+
+        Returns:
+            (dict): For every Monte Carlo index, a dictionary of the latest
+                entry of each product.  Empty if there is no manifest.
+
+        """
+        products = dict()
+        try:
+            f = open(self.path, "r")
+        except FileNotFoundError:
+            return products
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                products.setdefault(entry["mc"], dict())[entry["product"]] = entry
+        return products
+
+    def completed(self, products, expected):
+        """Test if all expected products of a realization are recorded.
+
+        Args:
+            products (dict): The products of the realization, as returned
+                by read().
+            expected (list): For every product, a list of alternative
+                file names, any of which completes the product.
+
+        Returns:
+            (bool): True if every expected product is recorded.
+
+        """
+        for alternatives in expected:
+            names = [os.path.relpath(x, self.outdir) for x in alternatives]
+            if not any(name in products for name in names):
+                return False
+        return True
+
+    def verify(self, entry):
+        """Return True if a recorded product is unchanged on disk."""
+        fname = os.path.join(self.outdir, entry["product"])
+        if not os.path.isfile(fname) or os.path.getsize(fname) != entry["size"]:
+            return False
+        return checksum(fname) == entry["crc32"]
@@ -0,0 +1,115 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+"""Analytic noise parameters of a hardware model as arrays.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+# RNG index of the common mode of the first tube.  Detector indices stay
+# below this.
+COMMON_MODE_INDEX = 100000
+
+
+def noise_parameters(hw, det_index=None):
+    """Noise parameters of all detectors in a hardware model as arrays.
+
+    Band values are expanded to detectors through the band index of the
+    columnar detector table and replaced by per-detector values where the
+    detectors define them, following DetectorParams.  The detectors of hw
+    are converted to a table in place if needed.
+
+    Args:
+        hw (Hardware): The hardware model.
+        det_index (dict, optional): The RNG index of every detector.  The
+            default is the position in the sorted list of names, the
+            index the TOAST focalplane assigns.
+
+    Returns:
+        (OrderedDict): Arrays of the sorted detector names and their fmin
+            [Hz], fknee [Hz], alpha, NET [K], RNG index and tube.
+
+    """
+    hw.to_columnar()
+    dets = hw.data["detectors"]
+    order = np.argsort(dets.names, kind="stable")
+    dets = dets.take(order)
+    bands, band_rows = dets.value_index("band")
+
+    def get_par(key, scale):
+        band_values = np.array([hw.data["bands"][x][key] for x in bands.tolist()])
+        values = band_values[band_rows] * scale
+        if key in dets.columns:
+            present = dets.masks.get(key, np.ones(len(dets), dtype=bool))
+            values[present] = dets.column(key)[present] * scale
+        return values
+
+    params = OrderedDict()
+    params["names"] = dets.names
+    params["fmin"] = get_par("fmin", 1e-3)  # mHz -> Hz
+    params["fknee"] = get_par("fknee", 1e-3)  # mHz -> Hz
+    # DetectorParams replaces the hardware model value with 1
+    params["alpha"] = np.ones(len(dets))
+    params["NET"] = get_par("NET", 1e-6)  # uK -> K
+    if det_index is None:
+        params["index"] = np.arange(len(dets))
+    else:
+        params["index"] = np.array([det_index[x] for x in dets.names.tolist()])
+    wafers, wafer_rows = dets.value_index("wafer")
+    hwindex = hw.index()
+    params["tube"] = np.array([hwindex.tube(x) for x in wafers.tolist()])[wafer_rows]
+    return params
+
+
+def common_mode_parameters(common_mode_noise, all_tubes):
+    """Noise parameters of the per-tube common modes as arrays.
+
+    Args:
+        common_mode_noise (str): The analytic parameters of every common
+            mode, "fmin[Hz],fknee[Hz],alpha,NET[K]".
+        all_tubes (list): The tubes which have a common mode.  Their order
+            sets the RNG indices, so it should not depend on the detector
+            selection.
+
+    Returns:
+        (OrderedDict): Arrays of the common mode names and their fmin,
+            fknee, alpha, NET and RNG index, as from noise_parameters().
+
+    """
+    fmin, fknee, alpha, net = np.array(common_mode_noise.split(",")).astype(np.float64)
+    ntube = len(all_tubes)
+    params = OrderedDict()
+    params["names"] = np.array(["common_mode_{}".format(x) for x in all_tubes])
+    params["fmin"] = np.full(ntube, fmin)
+    params["fknee"] = np.full(ntube, fknee)
+    params["alpha"] = np.full(ntube, alpha)
+    params["NET"] = np.full(ntube, net)
+    params["index"] = COMMON_MODE_INDEX + np.arange(ntube)
+    return params
+
+
+def common_mode_mixing(tubes, all_tubes):
+    """Sparse mixing matrix of detectors and per-tube common modes.
+
+    Args:
+        tubes (array): The tube of every detector.
+        all_tubes (list): The tubes which have a common mode.
+
+    Returns:
+        (csr_matrix): The (ndet, ndet + ntube) matrix.  Every detector
+            sees its own noise and the common mode of its tube.  The
+            columns of every row are sorted.
+
+    """
+    ndet = len(tubes)
+    tube_index = {x: i for i, x in enumerate(all_tubes)}
+    cols = np.empty(2 * ndet, dtype=np.int64)
+    cols[0::2] = np.arange(ndet)
+    cols[1::2] = ndet + np.array([tube_index[x] for x in np.asarray(tubes).tolist()])
+    rowptr = 2 * np.arange(ndet + 1)
+    return csr_matrix(
+        (np.ones(2 * ndet), cols, rowptr), shape=(ndet, ndet + len(all_tubes))
+    )
@@ -0,0 +1,97 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+"""In-place sum and difference of detector pairs.
+"""
+
+import numpy as np
+
+
+# Number of elements processed at once.  Only one block is ever copied.
+BLOCK_SIZE = 16384
+
+
+def pair_indices(dets):
+    """Find the A/B detector pairs.
+
+    Args:
+        dets (list): The detector names.
+
+    Returns:
+        (list): (A, B) tuples of detector names, in the order of the A
+            detectors.
+
+    """
+    available = set(dets)
+    pairs = list()
+    for det in dets:
+        if not det.endswith("A"):
+            continue
+        pairdet = det[:-1] + "B"
+        if pairdet not in available:
+            raise RuntimeError(
+                "Detector pair not available ({}, {})".format(det, pairdet)
+            )
+        pairs.append((det, pairdet))
+    return pairs
+
+
+def _flatten(a, b):
+    """Return flat views of two contiguous arrays of the same size."""
+    if not (a.flags.c_contiguous and b.flags.c_contiguous):
+        raise RuntimeError("Pair buffers must be contiguous")
+    if a.size != b.size:
+        raise RuntimeError("Pair buffers have different sizes")
+    return a.reshape(-1), b.reshape(-1)
+
+
+def sum_difference(a, b, scratch=None):
+    """Replace a and b with their half sum and half difference in place.
+
+    The result is identical to a, b = 0.5 * (a + b), 0.5 * (a - b), but
+    the arrays are processed one block at a time and the only temporary
+    is a block sized scratch buffer.
+
+    Args:
+        a (array): The first contiguous array, replaced by 0.5 * (a + b).
+        b (array): The second contiguous array, replaced by 0.5 * (a - b).
+        scratch (dict, optional): Work buffers of BLOCK_SIZE elements by
+            dtype, reused across calls.  A buffer is added for a new dtype.
+
+    Returns:
+        None
+
+    """
+    a, b = _flatten(a, b)
+    if scratch is None:
+        scratch = dict()
+    if a.dtype not in scratch:
+        scratch[a.dtype] = np.empty(BLOCK_SIZE, dtype=a.dtype)
+    work = scratch[a.dtype]
+    for first in range(0, a.size, BLOCK_SIZE):
+        ablock = a[first : first + BLOCK_SIZE]
+        bblock = b[first : first + BLOCK_SIZE]
+        temp = work[: ablock.size]
+        np.subtract(ablock, bblock, out=temp)
+        ablock += bblock
+        ablock *= 0.5
+        np.multiply(temp, 0.5, out=bblock)
+    return
+
+
+def merge_flags(a, b):
+    """Replace both flag arrays with their bitwise OR in place.
+
+    Args:
+        a (array): The first contiguous flag array.
+        b (array): The second contiguous flag array.
+
+    Returns:
+        None
+
+    """
+    a, b = _flatten(a, b)
+    for first in range(0, a.size, BLOCK_SIZE):
+        ablock = a[first : first + BLOCK_SIZE]
+        ablock |= b[first : first + BLOCK_SIZE]
+        b[first : first + BLOCK_SIZE] = ablock
+    return
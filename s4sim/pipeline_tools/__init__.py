@@ -1,8 +1,29 @@
 # Copyright (c) 2020-2020 CMB-S4 Collaboration.
 # Full license can be found in the top level "LICENSE" file.
 
-from .atm import scale_atmosphere_by_bandpass
+from .atm import add_atm_args, scale_atmosphere_by_bandpass
+from .checkpoint import (
+    MapCheckpoint,
+    add_checkpoint_args,
+    check_checkpoint_args,
+    checkpoint_map_path,
+)
 from .hardware import add_hw_args, load_focalplanes
 from .noise import add_s4_noise_args, get_analytic_noise, get_elevation_noise
-from .observation import create_observations
+from .observation import add_observation_args, create_observations
+from .pointing import add_pointing_args, expand_pointing
+from .precision import (
+    add_precision_args,
+    allocate_tod,
+    check_precision_args,
+    tod_dtype,
+)
+from .profiling import (
+    add_profile_args,
+    profile_stage,
+    setup_profiling,
+    write_profile,
+)
 from .pysm import add_pysm_args, simulate_sky_signal
+from .share import free_shared
+from .signal import add_signal_args, assemble_signal
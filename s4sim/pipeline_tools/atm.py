@@ -1,6 +1,8 @@
 # Copyright (c) 2020-2020 CMB-S4 Collaboration.
 # Full license can be found in the top level "LICENSE" file.
 
+from collections import OrderedDict
+
 import numpy as np
 
 from toast.timing import function_timer, Timer
@@ -14,6 +16,189 @@ if atm_available_utils:
         atm_absorption_coefficient_vec,
     )
 
+from ..absorption import AbsorptionTable, band_average
+
+
+# Absorption tables reused across observations and realizations
+_absorption_tables = dict()
+
+
+def add_atm_args(parser):
+    parser.add_argument(
+        "--atm-absorption-cache",
+        required=False,
+        help="Directory of persistent, interpolated atmospheric absorption "
+        "tables.  If set, the bandpass scaling interpolates cached libaatm "
+        "spectra on a (PWV, temperature, pressure) grid instead of calling "
+        "libaatm for every observation.",
+    )
+    parser.add_argument(
+        "--atm-absorption-check",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Compare interpolated absorption against a direct libaatm call "
+        "and report the error (slow, for validation)",
+        dest="atm_absorption_check",
+    )
+    return
+
+
+def _bandpass_key(bandpass):
+    """Return a hashable version of a focalplane bandpass entry."""
+    if bandpass is None or isinstance(bandpass, str):
+        return bandpass
+    return tuple(tuple(np.asarray(x).tolist()) for x in bandpass)
+
+
+def get_absorption_table(cache_dir, altitude):
+    """Return the shared absorption table of a site altitude."""
+    key = (cache_dir, altitude)
+    if key not in _absorption_tables:
+        _absorption_tables[key] = AbsorptionTable(altitude, cache_dir=cache_dir)
+    return _absorption_tables[key]
+
+
+def _absorption_direct(todcomm, altitude, air_temperature, surface_pressure, pwv):
+    """Sample the absorption coefficient with libaatm across the group."""
+    freqmin = 0
+    freqmax = 1000
+    nfreq = 10001
+    freqstep = (freqmax - freqmin) / (nfreq - 1)
+    if todcomm is None:
+        nfreq_task = nfreq
+        my_ifreq_min = 0
+        my_ifreq_max = nfreq
+    else:
+        nfreq_task = int(nfreq // todcomm.size) + 1
+        my_ifreq_min = nfreq_task * todcomm.rank
+        my_ifreq_max = min(nfreq, nfreq_task * (todcomm.rank + 1))
+    my_nfreq = my_ifreq_max - my_ifreq_min
+    if my_nfreq > 0:
+        if atm_available_utils:
+            my_freqs = freqmin + np.arange(my_ifreq_min, my_ifreq_max) * freqstep
+            my_absorption = atm_absorption_coefficient_vec(
+                altitude,
+                air_temperature,
+                surface_pressure,
+                pwv,
+                my_freqs[0],
+                my_freqs[-1],
+                my_nfreq,
+            )
+        else:
+            raise RuntimeError("Atmosphere utilities from libaatm are not available")
+    else:
+        my_freqs = np.array([])
+        my_absorption = np.array([])
+    if todcomm is None:
+        freqs = my_freqs
+        absorption = my_absorption
+    else:
+        freqs = np.hstack(todcomm.allgather(my_freqs))
+        absorption = np.hstack(todcomm.allgather(my_absorption))
+    return freqs, absorption
+
+
+def _absorption_interpolated(todcomm, table, air_temperature, surface_pressure, pwv):
+    """Interpolate the absorption coefficient from a cached table.
+
+    Grid nodes which are not cached yet are computed across the group and
+    stored by the first process.  The first process decides which nodes
+    are missing, so that every process agrees on the work split and the
+    collective even if another job adds nodes to the cache meanwhile.
+    """
+    if todcomm is None:
+        rank, ntask = 0, 1
+    else:
+        rank, ntask = todcomm.rank, todcomm.size
+    if rank == 0:
+        missing = table.missing(air_temperature, surface_pressure, pwv)
+    else:
+        missing = None
+    if todcomm is not None:
+        missing = todcomm.bcast(missing, root=0)
+    computed = [(node, table.compute_node(node)) for node in missing[rank::ntask]]
+    if todcomm is not None and len(missing) > 0:
+        computed = [x for y in todcomm.allgather(computed) for x in y]
+    for node, absorption in computed:
+        table.add_node(node, absorption, save=(rank == 0))
+    return table.freqs, table(air_temperature, surface_pressure, pwv)
+
+
+@function_timer
+def atmosphere_scale_factors(args, obs, mc, log=None):
+    """ Return the bandpass scaling of every local detector.
+
+    The absorption coefficient is averaged once for each distinct bandpass
+    of the local detectors.  All processes of the observation must call
+    this.
+
+    Args:
+        args (argparse.Namespace) :  The pipeline arguments.
+        obs (dict) :  The observation.
+        mc (int) :  The Monte Carlo realization.
+        log (Logger) :  Optional logger for the absorption check.
+
+    Returns:
+        factors (OrderedDict) :  The scaling factor of every local
+            detector.
+
+    """
+    tod = obs["tod"]
+    todcomm = tod.mpicomm
+    site_id = obs["site_id"]
+    weather = obs["weather"]
+    if "focalplane" in obs:
+        focalplane = obs["focalplane"]
+    else:
+        focalplane = None
+    start_time = obs["start_time"]
+    weather.set(site_id, mc, start_time)
+    altitude = obs["altitude"]
+    air_temperature = weather.air_temperature
+    surface_pressure = weather.surface_pressure
+    pwv = weather.pwv
+    if args.atm_absorption_cache is None:
+        # Use the entire processing group to sample the absorption
+        # coefficient as a function of frequency
+        freqs, absorption = _absorption_direct(
+            todcomm, altitude, air_temperature, surface_pressure, pwv
+        )
+    else:
+        table = get_absorption_table(args.atm_absorption_cache, altitude)
+        freqs, absorption = _absorption_interpolated(
+            todcomm, table, air_temperature, surface_pressure, pwv
+        )
+        if args.atm_absorption_check and (todcomm is None or todcomm.rank == 0):
+            err = table.error(air_temperature, surface_pressure, pwv)
+            if log is None:
+                log = Logger.get()
+            log.info(
+                "{}: interpolated absorption error = {:.3e}".format(obs["name"], err)
+            )
+    # loading = atm_atmospheric_loading(altitude, pwv, freq)
+    # Detectors in the same band share the bandpass, so the absorption
+    # is averaged once per distinct bandpass.
+    groups = OrderedDict()
+    for det in tod.local_dets:
+        # Use detector bandpass from the focalplane
+        center = focalplane[det]["bandcenter_ghz"]
+        width = focalplane[det]["bandwidth_ghz"]
+        bandpass = focalplane[det].get("bandpass", None)
+        key = (center, width, _bandpass_key(bandpass))
+        if key not in groups:
+            groups[key] = (bandpass, list())
+        groups[key][1].append(det)
+    factors = OrderedDict()
+    for (center, width, _), (bandpass, dets) in groups.items():
+        # Interpolate the absorption coefficient to do a top hat or
+        # tabulated integral across the bandpass
+        absorption_det = band_average(freqs, absorption, center, width, bandpass)
+        for det in dets:
+            factors[det] = absorption_det
+    return factors
+
 
 @function_timer
 def scale_atmosphere_by_bandpass(args, comm, data, totalname, mc, verbose=False):
@@ -21,8 +206,10 @@ def scale_atmosphere_by_bandpass(args, comm, data, totalname, mc, verbose=False)
     Assume that cached signal under totalname is pure atmosphere
     and scale the absorption coefficient according to the bandpass.
     If the focalplane is included in the observation and defines
-    bandpasses for the detectors, the scaling is computed for each
-    detector separately.
+    bandpasses for the detectors, the scaling is computed once for each
+    distinct bandpass.  A tabulated bandpass (a file name or a pair of
+    [frequencies, responses] sequences) in the "bandpass" entry of the
+    focalplane replaces the top hat defined by the band center and width.
     """
     if not args.simulate_atmosphere:
         return
@@ -36,69 +223,8 @@ def scale_atmosphere_by_bandpass(args, comm, data, totalname, mc, verbose=False)
     timer.start()
     for obs in data.obs:
         tod = obs["tod"]
-        todcomm = tod.mpicomm
-        site_id = obs["site_id"]
-        weather = obs["weather"]
-        if "focalplane" in obs:
-            focalplane = obs["focalplane"]
-        else:
-            focalplane = None
-        start_time = obs["start_time"]
-        weather.set(site_id, mc, start_time)
-        altitude = obs["altitude"]
-        air_temperature = weather.air_temperature
-        surface_pressure = weather.surface_pressure
-        pwv = weather.pwv
-        # Use the entire processing group to sample the absorption
-        # coefficient as a function of frequency
-        freqmin = 0
-        freqmax = 1000
-        nfreq = 10001
-        freqstep = (freqmax - freqmin) / (nfreq - 1)
-        if todcomm is None:
-            nfreq_task = nfreq
-            my_ifreq_min = 0
-            my_ifreq_max = nfreq
-        else:
-            nfreq_task = int(nfreq // todcomm.size) + 1
-            my_ifreq_min = nfreq_task * todcomm.rank
-            my_ifreq_max = min(nfreq, nfreq_task * (todcomm.rank + 1))
-        my_nfreq = my_ifreq_max - my_ifreq_min
-        if my_nfreq > 0:
-            if atm_available_utils:
-                my_freqs = freqmin + np.arange(my_ifreq_min, my_ifreq_max) * freqstep
-                my_absorption = atm_absorption_coefficient_vec(
-                    altitude,
-                    air_temperature,
-                    surface_pressure,
-                    pwv,
-                    my_freqs[0],
-                    my_freqs[-1],
-                    my_nfreq,
-                )
-            else:
-                raise RuntimeError(
-                    "Atmosphere utilities from libaatm are not available"
-                )
-        else:
-            my_freqs = np.array([])
-            my_absorption = np.array([])
-        if todcomm is None:
-            freqs = my_freqs
-            absorption = my_absorption
-        else:
-            freqs = np.hstack(todcomm.allgather(my_freqs))
-            absorption = np.hstack(todcomm.allgather(my_absorption))
-        # loading = atm_atmospheric_loading(altitude, pwv, freq)
-        for det in tod.local_dets:
-            # Use detector bandpass from the focalplane
-            center = focalplane[det]["bandcenter_ghz"]
-            width = focalplane[det]["bandwidth_ghz"]
-            nstep = 101
-            # Interpolate the absorption coefficient to do a top hat
-            # integral across the bandpass
-            det_freqs = np.linspace(center - width / 2, center + width / 2, nstep)
-            absorption_det = np.mean(np.interp(det_freqs, freqs, absorption))
+        factors = atmosphere_scale_factors(args, obs, mc, log=log)
+        for det, absorption_det in factors.items():
             cachename = "{}_{}".format(totalname, det)
             ref = tod.cache.reference(cachename)
             ref *= absorption_det
@@ -0,0 +1,223 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from toast.dist import Data
+from toast.map import DistPixels, covariance_apply, covariance_invert
+from toast.mpi import MPI
+from toast.timing import function_timer, Timer
+from toast.todmap import OpAccumDiag
+from toast.utils import Logger
+
+from ..checkpoint import CheckpointStore
+
+
+def add_checkpoint_args(parser):
+    parser.add_argument(
+        "--checkpoint",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Process every Monte Carlo realization a few observations at a "
+        "time, accumulate binned maps and checkpoint them, so that a job "
+        "which is stopped resumes after the last completed observations.  "
+        "Replaces Madam and filter-and-bin.",
+        dest="checkpoint",
+    )
+    parser.add_argument(
+        "--checkpoint-obs",
+        required=False,
+        default=1,
+        type=int,
+        help="Number of observations per process group between checkpoints",
+        dest="checkpoint_obs",
+    )
+    return
+
+
+def check_checkpoint_args(args):
+    """ Raise an error if the requested outputs cannot be checkpointed."""
+    if not args.checkpoint:
+        return
+    if not args.skip_madam:
+        raise RuntimeError(
+            "--checkpoint requires --skip-madam:  destriping is a global "
+            "solve which cannot resume from a subset of observations"
+        )
+    if args.filterbin_ground_order is not None or args.filterbin_poly_order is not None:
+        raise RuntimeError("--checkpoint does not support filter-and-bin")
+    if args.tidas is not None:
+        raise RuntimeError("--checkpoint does not support TIDAS export")
+    if args.checkpoint_obs < 1:
+        raise RuntimeError("--checkpoint-obs must be positive")
+    return
+
+
+def checkpoint_map_path(args, outpath):
+    return os.path.join(
+        outpath, args.mapmaker_prefix + "_checkpoint_telescope_all_time_all_bmap.fits"
+    )
+
+
+class MapCheckpoint(object):
+    """ Accumulate binned maps of one realization with checkpoints.
+
+    The local observations of every process group are processed in steps
+    of args.checkpoint_obs observations, all groups in lockstep.  After
+    each step the noise weighted map, hits and inverse pixel covariance
+    accumulated by every process are saved under <outpath>/checkpoint and
+    committed.  A new MapCheckpoint for the same output directory and
+    process layout resumes after the last committed step.
+
+    Args:
+        args (argparse.Namespace) :  The pipeline arguments.
+        comm (toast.Comm) :  The toast communicator.
+        data (toast.Data) :  The distributed data with the pointing
+            metadata.
+        outpath (str) :  The output directory of the realization.
+        detweights (dict) :  The noise weights of the detectors.
+
+    """
+
+    def __init__(self, args, comm, data, outpath, detweights):
+        self.args = args
+        self.comm = comm
+        self.data = data
+        self.outpath = outpath
+        self.detweights = detweights
+        self.store = CheckpointStore(
+            os.path.join(outpath, "checkpoint"), comm.world_rank
+        )
+        self.nobs_step = args.checkpoint_obs
+
+        mpicomm = comm.comm_world
+        nstep = -(-len(data.obs) // self.nobs_step)
+        if mpicomm is not None:
+            nstep = mpicomm.allreduce(nstep, op=MPI.MAX)
+        self.nstep = nstep
+
+        self.zmap = DistPixels(data, comm=mpicomm, nnz=3, dtype=np.float64)
+        self.hits = DistPixels(data, comm=mpicomm, nnz=1, dtype=np.int64)
+        self.invnpp = DistPixels(data, comm=mpicomm, nnz=6, dtype=np.float64)
+        for distmap in self.maps.values():
+            if distmap.data is not None:
+                distmap.data.fill(0)
+
+        # The checkpoint is only valid for the same observations on every
+        # process, which the names of the local observations capture
+        names = [obs["name"] for obs in data.obs]
+        if mpicomm is None:
+            all_names = [names]
+        else:
+            all_names = mpicomm.allgather(names)
+        self.meta = {
+            "ntask": len(all_names),
+            "group_size": comm.group_size,
+            "nobs_step": self.nobs_step,
+            "obs": hashlib.sha256(json.dumps(all_names).encode()).hexdigest(),
+        }
+        self.step = self._resume()
+
+    @property
+    def maps(self):
+        return {"zmap": self.zmap, "hits": self.hits, "invnpp": self.invnpp}
+
+    def _resume(self):
+        log = Logger.get()
+        mpicomm = self.comm.comm_world
+        if self.comm.world_rank == 0:
+            step = self.store.committed(self.meta)
+        else:
+            step = None
+        if mpicomm is not None:
+            step = mpicomm.bcast(step, root=0)
+        if step == 0:
+            return 0
+        arrays = self.store.load(step)
+        for name, distmap in self.maps.items():
+            if distmap.data is not None:
+                distmap.data[:] = arrays[name]
+        if self.comm.world_rank == 0:
+            log.info(
+                "Resuming after {} of {} observation steps from {}".format(
+                    step, self.nstep, self.store.path
+                )
+            )
+        return step
+
+    def pending(self):
+        """ Yield the observations of every remaining step as toast.Data."""
+        while self.step < self.nstep:
+            first = self.step * self.nobs_step
+            data = Data(self.data.comm)
+            data.obs.extend(self.data.obs[first : first + self.nobs_step])
+            yield data
+            self.step += 1
+
+    @function_timer
+    def accumulate(self, data, name):
+        """ Bin the signal of one step and commit a checkpoint.
+
+        Args:
+            data (toast.Data) :  The observations of the step.
+            name (str) :  The cache prefix of the signal.
+
+        Returns:
+            None
+
+        """
+        OpAccumDiag(
+            zmap=self.zmap,
+            hits=self.hits,
+            invnpp=self.invnpp,
+            detweights=self.detweights,
+            name=name,
+            common_flag_mask=self.args.common_flag_mask,
+        ).exec(data)
+        arrays = dict()
+        for key, distmap in self.maps.items():
+            if distmap.data is None:
+                arrays[key] = np.zeros(0, dtype=distmap.dtype)
+            else:
+                arrays[key] = distmap.data
+        step = self.step + 1
+        self.store.save(step, arrays)
+        if self.comm.comm_world is not None:
+            self.comm.comm_world.barrier()
+        if self.comm.world_rank == 0:
+            self.store.commit(step, self.meta)
+        return
+
+    @function_timer
+    def finalize(self):
+        """ Reduce the accumulated maps and write the binned map and hits.
+
+        The checkpoint is removed once the maps are written.
+
+        Returns:
+            None
+
+        """
+        log = Logger.get()
+        timer = Timer()
+        timer.start()
+        for distmap in self.maps.values():
+            distmap.allreduce()
+        prefix = checkpoint_map_path(self.args, self.outpath)[: -len("_bmap.fits")]
+        self.hits.write_healpix_fits(prefix + "_hmap.fits")
+        covariance_invert(self.invnpp, 1e-3)
+        covariance_apply(self.invnpp, self.zmap)
+        self.zmap.write_healpix_fits(prefix + "_bmap.fits")
+        if self.comm.comm_world is not None:
+            self.comm.comm_world.barrier()
+        if self.comm.world_rank == 0:
+            self.store.clear()
+            timer.report_clear("Write checkpointed binned map")
+            log.info("Wrote {}_bmap.fits".format(prefix))
+        return
+
@@ -8,9 +8,10 @@ import numpy as np
 from toast.pipeline_tools import Telescope, Focalplane, Site, Schedule, CES
 from toast.timing import function_timer, Timer
 from toast.utils import Logger
-import toast.qarray as qa
 
 from .. import hardware
+from .noise import get_analytic_noise
+from .share import share_hardware
 
 
 XAXIS, YAXIS, ZAXIS = np.eye(3)
@@ -123,6 +124,15 @@ def add_hw_args(parser):
         required=False,
         help="Telescope, one of: LAT0, LAT1, LAT2, SAT1, SAT2, SAT3",
     )
+    parser.add_argument(
+        "--hardware-shared",
+        required=False,
+        action="store_true",
+        help="Keep one copy of the detector properties per node in shared "
+        "memory and build the focalplane on every process instead of "
+        "broadcasting the full hardware and focalplane from the root process",
+        dest="hardware_shared",
+    )
     return
 
 
@@ -138,6 +148,8 @@ class BandParams:
         self.lower = band_data["low"]  # GHz
         self.center = band_data["center"]  # GHz
         self.upper = band_data["high"]  # GHz
+        # Optional tabulated bandpass
+        self.bandpass = band_data.get("bandpass", "")
         return
 
 
@@ -176,6 +188,7 @@ class DetectorParams:
         # ensure that the center frequency of band is center of upper and lower bands
         self.center = 0.5 * (self.lower + self.upper)
         self.width = self.upper - self.lower
+        self.bandpass = band.bandpass
         self.wafer = wafer
         self.tube = tube
         self.telescope = telescope
@@ -195,6 +208,7 @@ class DetectorParams:
             "freq": self.center,
             "bandcenter_ghz": self.center,
             "bandwidth_ghz": self.width,
+            "bandpass": self.bandpass,
             "index": self.index,
             "telescope": self.telescope,
             "tube": self.tube,
@@ -226,8 +240,13 @@ def get_hardware(args, comm, verbose=False):
             log.info("Simulating default hardware configuration")
             hw = hardware.sim_nominal()
             timer.report_clear("Get example hardware")
-            hw.data["detectors"] = hardware.sim_telescope_detectors(hw, telescope.name)
+            # Reuses a cached focalplane if S4SIM_CACHE is set
+            hw.data["detectors"] = hardware.sim_telescope_detectors(
+                hw, telescope.name, columnar=True
+            )
             timer.report_clear("Get telescope detectors")
+        # Index the detector properties for fast selection
+        hw.to_columnar()
         # Construct a running index for all detectors across all
         # telescopes for independent noise realizations
         det_index = {}
@@ -248,34 +267,26 @@ def get_hardware(args, comm, verbose=False):
                 "No detectors match query: telescope={}, "
                 "tubes={}, match={}".format(telescope.name, tubes, match)
             )
+        dets = hw.data["detectors"]
+        keep = np.ones(len(dets), dtype=bool)
         if args.thinfp:
             # Only accept a fraction of the detectors for
-            # testing and development
-            thin_index = {}
-            for idet, det in enumerate(sorted(hw.data["detectors"])):
-                thin_index[det] = idet
-            delete_detectors = []
-            for det_name in hw.data["detectors"].keys():
-                if (thin_index[det_name] // 2) % args.thinfp != 0:
-                    delete_detectors.append(det_name)
-            for det_name in delete_detectors:
-                del hw.data["detectors"][det_name]
+            # testing and development.  Detectors are thinned in pairs
+            # by their position in the sorted list of names.
+            order = np.argsort(dets.names, kind="stable")
+            thin_index = np.empty(len(dets), dtype=np.int64)
+            thin_index[order] = np.arange(len(dets))
+            keep &= (thin_index // 2) % args.thinfp == 0
         if args.radiusfp_deg:
             # Only accept detectors inside the given radius
             radius = np.radians(args.radiusfp_deg)
-            # Comparing to the cosine of the radius avoids repeated
-            # arccos evaluations
-            cosradius = np.cos(radius)
-            inside = radius > 0
-            delete_detectors = []
-            for det_name, det_data in hw.data["detectors"].items():
-                det_quat = det_data["quat"]
-                vec = qa.rotate(det_quat, ZAXIS)
-                rcos = np.dot(vec, ZAXIS)
-                if (rcos < cosradius and inside) or (rcos > cosradius and not inside):
-                    delete_detectors.append(det_name)
-            for det_name in delete_detectors:
-                del hw.data["detectors"][det_name]
+            theta = hardware.boresight_angle(dets.column("quat"))
+            if radius > 0:
+                keep &= theta <= radius
+            else:
+                keep &= theta >= -radius
+        if not np.all(keep):
+            hw.data["detectors"] = dets.take(keep)
 
         ndetector = len(hw.data["detectors"])
         log.info(
@@ -294,8 +305,11 @@ def get_hardware(args, comm, verbose=False):
         hw = None
         det_index = None
     if comm.comm_world is not None:
-        hw = comm.comm_world.bcast(hw)
-        det_index = comm.comm_world.bcast(det_index)
+        if args.hardware_shared:
+            hw, det_index = share_hardware(comm.comm_world, hw, det_index)
+        else:
+            hw = comm.comm_world.bcast(hw)
+            det_index = comm.comm_world.bcast(det_index)
     return hw, telescope, det_index
 
 
@@ -328,60 +342,116 @@ def get_telescope(args, comm, verbose=False):
     return telescope
 
 
-def get_focalplane(args, comm, hw, det_index, verbose=False):
-    """ Translate hardware configuration into a TOAST focalplane dictionary
+class S4Focalplane(Focalplane):
+    """ A focalplane whose noise model is built from the hardware model.
+
+    The noise model is built on first use from the columnar detector table
+    of the hardware attached with set_hardware().  The hardware and the
+    noise model are not pickled, so broadcasting the focalplane does not
+    carry the PSDs of every detector.  Without a hardware model the TOAST
+    noise model of the detector dictionaries is used.
     """
-    if comm.world_rank == 0:
-        detector_data = {}
-        band_params = {}
-        for band_name, band_data in hw.data["bands"].items():
-            band_params[band_name] = BandParams(band_name, band_data)
-        # User may force the effective focal plane radius to be larger
-        # than the default.  This will widen the size of the simulated
-        # atmosphere but has no other effect for the time being.
-        fpradius = None
-        try:
-            fpradius = args.focalplane_radius_deg
-        except:
-            pass
-        if fpradius is None:
-            fpradius = 0
-        for det_name, det_data in hw.data["detectors"].items():
-            # RNG index for this detector
-            index = det_index[det_name]
-            wafer = det_data["wafer"]
-            # Determine which tube has this wafer
-            for tube_name, tube_data in hw.data["tubes"].items():
-                if wafer in tube_data["wafers"]:
-                    break
-            # Determine which telescope has this tube
-            for telescope_name, telescope_data in hw.data["telescopes"].items():
-                if tube_name in telescope_data["tubes"]:
-                    break
-            else:
-                raise RuntimeError(
-                    "Unable to match tube {} to a telescope".format(tube_name)
-                )
-            fpradius = max(fpradius, FOCALPLANE_RADII_DEG[telescope_name])
-            det_params = DetectorParams(
-                det_data,
-                band_params[det_data["band"]],
-                wafer,
-                tube_name,
-                telescope_name,
-                index,
+
+    _noise_source = None
+
+    def set_hardware(self, args, comm, hw, det_index):
+        """ Attach the hardware model that the noise model is built from.
+
+        Args:
+            args (argparse.Namespace) :  The pipeline arguments.
+            comm (toast.Comm) :  The toast communicator.
+            hw (Hardware) :  The hardware model of the focalplane detectors.
+            det_index (dict) :  The RNG index of every detector.
+        Returns:
+            None
+        """
+        self._noise_source = (args, comm, hw, det_index)
+        self._noise = None
+        return
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_noise_source", None)
+        state.pop("_noise", None)
+        return state
+
+    @property
+    def noise(self):
+        if self._noise is None and self._noise_source is not None:
+            args, comm, hw, det_index = self._noise_source
+            if not args.common_mode_noise:
+                # The running indices the focalplane would assign, so the
+                # noise realizations do not change
+                det_index = None
+            self._noise = get_analytic_noise(
+                args, comm, hw, verbose=False, det_index=det_index
             )
-            detector_data[det_name] = det_params.get_dict()
-        # Create a focal plane in the telescope
-        focalplane = Focalplane(
-            detector_data=detector_data,
-            sample_rate=args.sample_rate,
-            radius_deg=fpradius,
+        return super().noise
+
+
+def _build_focalplane(args, hw, det_index):
+    """ Translate hardware configuration into a TOAST focalplane object
+    """
+    detector_data = {}
+    band_params = {}
+    hwindex = hw.index()
+    for band_name, band_data in hw.data["bands"].items():
+        band_params[band_name] = BandParams(band_name, band_data)
+    # User may force the effective focal plane radius to be larger
+    # than the default.  This will widen the size of the simulated
+    # atmosphere but has no other effect for the time being.
+    fpradius = None
+    try:
+        fpradius = args.focalplane_radius_deg
+    except:
+        pass
+    if fpradius is None:
+        fpradius = 0
+    for det_name, det_data in hw.data["detectors"].items():
+        # RNG index for this detector
+        index = det_index[det_name]
+        wafer = det_data["wafer"]
+        # Determine which tube and telescope have this wafer
+        tube_name = hwindex.tube(wafer)
+        telescope_name = hwindex.telescope(tube_name)
+        fpradius = max(fpradius, FOCALPLANE_RADII_DEG[telescope_name])
+        det_params = DetectorParams(
+            det_data,
+            band_params[det_data["band"]],
+            wafer,
+            tube_name,
+            telescope_name,
+            index,
         )
+        detector_data[det_name] = det_params.get_dict()
+    # Create a focal plane in the telescope
+    focalplane = S4Focalplane(
+        detector_data=detector_data,
+        sample_rate=args.sample_rate,
+        radius_deg=fpradius,
+    )
+    return focalplane
+
+
+def get_focalplane(args, comm, hw, det_index, verbose=False):
+    """ Translate hardware configuration into a TOAST focalplane dictionary
+
+    With --hardware-shared every process already has the hardware and
+    builds the focalplane itself.  Otherwise it is built on the root
+    process and broadcast.  The noise model is built afterwards, on every
+    process, from the hardware model.
+    """
+    if args.hardware_shared:
+        focalplane = _build_focalplane(args, hw, det_index)
     else:
-        focalplane = None
-    if comm.comm_world is not None:
-        focalplane = comm.comm_world.bcast(focalplane)
+        if comm.world_rank == 0:
+            focalplane = _build_focalplane(args, hw, det_index)
+        else:
+            focalplane = None
+        if comm.comm_world is not None:
+            focalplane = comm.comm_world.bcast(focalplane)
+    # Every process builds its noise model when first used
+    focalplane.set_hardware(args, comm, hw, det_index)
     return focalplane
 
 
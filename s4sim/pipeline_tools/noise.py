@@ -1,13 +1,16 @@
 # Copyright (c) 2020-2020 CMB-S4 Collaboration.
 # Full license can be found in the top level "LICENSE" file.
 
+from collections import OrderedDict
+
 import numpy as np
 
 from toast.timing import function_timer, Timer
-from toast.tod import AnalyticNoise
+from toast.tod import AnalyticNoise, Noise
 from toast.utils import Logger
 import toast.qarray as qa
 from .. import hardware
+from ..noise import common_mode_mixing, common_mode_parameters, noise_parameters
 
 
 def add_s4_noise_args(parser):
@@ -26,9 +29,105 @@ def add_s4_noise_args(parser):
         help="Disable elevation-dependent noise scaling",
         dest="no_elevation_noise",
     )
+    parser.add_argument(
+        "--elevation-noise-boresight",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Derive detector elevations for the noise scaling from the "
+        "boresight pointing and the focalplane offsets instead of expanding "
+        "the pointing of every detector",
+        dest="elevation_noise_boresight",
+    )
     return
 
 
+class ElevationScaledNoise(Noise):
+    """ A view of a shared noise model with per-detector PSD scaling.
+
+    Observations of the same focalplane share one noise model.  Instead
+    of copying all PSDs for every observation, this wrapper stores one
+    scale factor per detector and applies it when a PSD is requested.
+    Everything else is read from the shared model.
+
+    Args:
+        base (Noise) :  The shared noise model.  It is never modified.
+    """
+
+    def __init__(self, base):
+        # The base class constructor is not called:  all state lives in
+        # the shared model.
+        self._base = base
+        self._scales = dict()
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the wrapper itself
+        if name in ("_base", "_scales"):
+            raise AttributeError(name)
+        return getattr(self._base, name)
+
+    def __getstate__(self):
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    @property
+    def base(self):
+        """ The shared noise model """
+        return self._base
+
+    def scale(self, det):
+        """ The PSD scale factor of a detector """
+        return self._scales.get(det, 1.0)
+
+    def set_scale(self, det, factor):
+        """ Set the PSD scale factor of a detector """
+        self._scales[det] = factor
+
+    def weight(self, det, key):
+        """ The mixing weight of the shared model """
+        return self._base.weight(det, key)
+
+    def psd(self, det):
+        """ The scaled PSD of a detector.  This returns a new array. """
+        psd = self._base.psd(det)
+        if det in self._scales:
+            psd = psd * self._scales[det]
+        return psd
+
+
+def _detector_elevation(tod, det, istart, n):
+    """ Median elevation of one detector from its own pointing
+    """
+    try:
+        # Some TOD classes provide a shortcut to Az/El
+        el = tod.read_azel(detector=det, local_start=istart, n=n)[1]
+    except Exception:
+        azelquat = tod.read_pntg(detector=det, azel=True, local_start=istart, n=n)
+        # Convert Az/El quaternion of the detector back into
+        # angles for the simulation.
+        theta = qa.to_position(azelquat)[0]
+        el = np.pi / 2 - theta
+    return np.median(el)
+
+
+def _boresight_elevations(tod, fp, dets, istart, n):
+    """ Median elevations of detectors from the boresight pointing
+
+    Rotations in azimuth do not change the elevation of a detector, so
+    the detector elevations follow from the boresight orientation at the
+    median boresight elevation and the focalplane offsets.  All detectors
+    are rotated in one batched operation.
+    """
+    boresight = tod.read_boresight_azel(local_start=istart, n=n)
+    theta = qa.to_position(boresight)[0]
+    imedian = np.argsort(theta)[len(theta) // 2]
+    quats = np.array([fp[det]["quat"] for det in dets])
+    theta = qa.to_position(qa.mult(boresight[imedian], quats))[0]
+    return np.pi / 2 - np.atleast_1d(theta)
+
+
 @function_timer
 def get_elevation_noise(args, comm, data, key="noise"):
     """ Insert elevation-dependent noise
@@ -43,107 +142,147 @@ def get_elevation_noise(args, comm, data, key="noise"):
         tod = obs["tod"]
         fp = obs["focalplane"]
         noise = obs[key]
-        for det in tod.local_dets:
+        dets = tod.local_dets
+        for det in dets:
             if det not in noise.keys:
                 raise RuntimeError(
                     'Detector "{}" does not have a PSD in the noise object'.format(det)
                 )
-            A = fp[det]["A"]
-            C = fp[det]["C"]
-            psd = noise.psd(det)
-            # We only consider a small range of samples for the elevation
-            n = tod.local_samples[1]
-            istart = max(0, n // 2 - 1000)
-            istop = min(n, n // 2 + 1000)
-            try:
-                # Some TOD classes provide a shortcut to Az/El
-                el = tod.read_azel(detector=det, local_start=istart, n=istop - istart)[
-                    1
-                ]
-            except Exception:
-                azelquat = tod.read_pntg(
-                    detector=det, azel=True, local_start=istart, n=istop - istart
-                )
-                # Convert Az/El quaternion of the detector back into
-                # angles for the simulation.
-                theta = qa.to_position(azelquat)[0]
-                el = np.pi / 2 - theta
-            el = np.median(el)
-            # Scale the analytical noise PSD. Pivot is at el = 50 deg.
-            psd[:] *= (A / np.sin(el) + C) ** 2
+        if len(dets) == 0:
+            continue
+        # We only consider a small range of samples for the elevation
+        n = tod.local_samples[1]
+        istart = max(0, n // 2 - 1000)
+        istop = min(n, n // 2 + 1000)
+        if args.elevation_noise_boresight:
+            el = _boresight_elevations(tod, fp, dets, istart, istop - istart)
+        else:
+            el = np.array(
+                [_detector_elevation(tod, det, istart, istop - istart) for det in dets]
+            )
+        A = np.array([fp[det]["A"] for det in dets])
+        C = np.array([fp[det]["C"] for det in dets])
+        # Scale the analytical noise PSD. Pivot is at el = 50 deg.
+        scale = (A / np.sin(el) + C) ** 2
+        for det, det_scale in zip(dets, scale):
+            if isinstance(noise, ElevationScaledNoise):
+                # Noise models shared between observations are not modified
+                noise.set_scale(det, noise.scale(det) * det_scale)
+            else:
+                psd = noise.psd(det)
+                psd[:] *= det_scale
     if comm.world_rank == 0:
         timer.report_clear("Elevation noise")
     return
 
 
+class MixedAnalyticNoise(AnalyticNoise):
+    """ Analytic noise with a sparse mixing matrix.
+
+    The PSDs of the detectors and of the extra noise keys (e.g. per-tube
+    common modes) are analytic.  Detector timestreams are mixed from the
+    keys through a CSR matrix, which is kept as is instead of a dictionary
+    of weights for every detector.
+
+    Args:
+        mixing (csr_matrix) :  The (ndet, nkey) mixing matrix, rows in the
+            order of mixed_detectors and columns in the order of keys.
+        mixed_detectors (list) :  The detectors, rows of the matrix.
+        keys (list) :  The noise keys, columns of the matrix.
+        kwargs :  The AnalyticNoise arguments for all detectors and keys.
+    """
+
+    def __init__(self, *, mixing, mixed_detectors, keys, **kwargs):
+        super().__init__(**kwargs)
+        self._mixing = mixing
+        self._rows = {x: i for i, x in enumerate(mixed_detectors)}
+        self._cols = {x: i for i, x in enumerate(keys)}
+        # Only simulate the keys that some detector sees
+        self._keys = sorted(keys[x] for x in np.unique(mixing.indices).tolist())
+        # weight() is called for every pair of local detector and key, so
+        # it reads plain lists of the CSR arrays rather than numpy scalars
+        self._indptr = mixing.indptr.tolist()
+        self._indices = mixing.indices.tolist()
+        self._data = mixing.data.tolist()
+
+    @property
+    def mixing(self):
+        """ The sparse mixing matrix """
+        return self._mixing
+
+    def weight(self, det, key):
+        """ Return the mixing weight for noise `key` in `det`."""
+        row = self._rows.get(det)
+        col = self._cols.get(key)
+        if row is None or col is None:
+            return 0
+        for i in range(self._indptr[row], self._indptr[row + 1]):
+            if self._indices[i] == col:
+                return self._data[i]
+        return 0
+
+
 @function_timer
-def get_analytic_noise(args, comm, focalplane, verbose=True):
+def get_analytic_noise(args, comm, focalplane, verbose=True, det_index=None):
     """ Create a TOAST noise object.
 
     Create a noise object from the 1/f noise parameters contained in the
-    focalplane database.
+    focalplane database.  The focalplane is either a dictionary of detector
+    dictionaries or a Hardware object, whose columnar detector table is
+    translated into parameter arrays without per-detector dictionaries.
+    With --common-mode-noise, every tube gets a common mode which is mixed
+    into its detectors through a sparse matrix.
 
     """
     timer = Timer()
     timer.start()
-    detectors = sorted(focalplane.keys())
-    fmins = {}
-    fknees = {}
-    alphas = {}
-    NETs = {}
-    rates = {}
-    indices = {}
-    for d in detectors:
-        rates[d] = args.sample_rate
-        fmins[d] = focalplane[d]["fmin"]
-        fknees[d] = focalplane[d]["fknee"]
-        alphas[d] = focalplane[d]["alpha"]
-        NETs[d] = focalplane[d]["NET"]
-        indices[d] = focalplane[d]["index"]
+    if isinstance(focalplane, hardware.Hardware):
+        params = noise_parameters(focalplane, det_index)
+    else:
+        params = OrderedDict()
+        params["names"] = np.array(sorted(focalplane.keys()))
+        for key in ["fmin", "fknee", "alpha", "NET", "index", "tube"]:
+            if key == "tube" and not args.common_mode_noise:
+                continue
+            params[key] = np.array(
+                [focalplane[d][key] for d in params["names"].tolist()]
+            )
+    detectors = params["names"].tolist()
 
     if args.common_mode_noise:
         # Add an extra "virtual" detector for common mode noise for
-        # every optics tube
-        fmin, fknee, alpha, net = np.array(args.common_mode_noise.split(",")).astype(
-            np.float64
-        )
-        hw = hardware.get_example()
-        for itube, tube in enumerate(sorted(hw.data["tubes"].keys())):
-            d = "common_mode_{}".format(tube)
-            detectors.append(d)
-            rates[d] = args.sample_rate
-            fmins[d] = fmin
-            fknees[d] = fknee
-            alphas[d] = alpha
-            NETs[d] = net
-            indices[d] = 100000 + itube
-
-    noise = AnalyticNoise(
-        rate=rates,
-        fmin=fmins,
-        detectors=detectors,
-        fknee=fknees,
-        alpha=alphas,
-        NET=NETs,
-        indices=indices,
-    )
+        # every optics tube.  The tubes of the nominal hardware are used so
+        # that the RNG indices do not depend on the detector selection.
+        all_tubes = sorted(hardware.sim_nominal().data["tubes"].keys())
+        common = common_mode_parameters(args.common_mode_noise, all_tubes)
+        keys = detectors + common["names"].tolist()
+        for key in ["fmin", "fknee", "alpha", "NET", "index"]:
+            params[key] = np.hstack([params[key], common[key]])
+    else:
+        keys = detectors
+
+    # AnalyticNoise takes dictionaries keyed by detector
+    def as_dict(values):
+        return dict(zip(keys, np.asarray(values).tolist()))
 
+    kwargs = dict(
+        detectors=keys,
+        rate=as_dict(np.full(len(keys), args.sample_rate)),
+        fmin=as_dict(params["fmin"]),
+        fknee=as_dict(params["fknee"]),
+        alpha=as_dict(params["alpha"]),
+        NET=as_dict(params["NET"]),
+        indices=as_dict(params["index"]),
+    )
     if args.common_mode_noise:
-        # Update the mixing matrix in the noise operator
-        mixmatrix = {}
-        keys = set()
-        for det in focalplane.keys():
-            tube = focalplane[det]["tube"]
-            common = "common_mode_{}".format(tube)
-            mixmatrix[det] = {det: 1, common: 1}
-            keys.add(det)
-            keys.add(common)
-        # There should probably be an accessor method to update the
-        # mixmatrix in the TOAST Noise object.
-        if noise._mixmatrix is not None:
-            raise RuntimeError("Did not expect non-empty mixing matrix")
-        noise._mixmatrix = mixmatrix
-        noise._keys = list(sorted(keys))
+        noise = MixedAnalyticNoise(
+            mixing=common_mode_mixing(params["tube"], all_tubes),
+            mixed_detectors=detectors,
+            keys=keys,
+            **kwargs,
+        )
+    else:
+        noise = AnalyticNoise(**kwargs)
 
     timer.stop()
     if comm.world_rank == 0 and verbose:
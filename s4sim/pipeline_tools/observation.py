@@ -1,7 +1,6 @@
 # Copyright (c) 2020-2020 CMB-S4 Collaboration.
 # Full license can be found in the top level "LICENSE" file.
 
-import copy
 import numpy as np
 
 from toast.dist import distribute_uniform, Data
@@ -10,10 +9,88 @@ from toast.timing import function_timer, Timer
 from toast.todmap import TODGround
 from toast.utils import Logger
 
-from .noise import get_analytic_noise
+from ..balance import (
+    balanced_detbreaks,
+    count_detbreaks,
+    detector_costs,
+    distribute_weighted,
+)
+from .noise import ElevationScaledNoise
 from .hardware import get_hardware, get_focalplane
 
 
+# Detector partitions of each focalplane, reused for every observation
+_detbreaks_cache = dict()
+
+
+def add_observation_args(parser):
+    parser.add_argument(
+        "--balance-detbreaks",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Place the detector breaks at the pair boundaries closest to an "
+        "even split of the detector samples, instead of filling detector "
+        "ranks in order",
+        dest="balance_detbreaks",
+    )
+    parser.add_argument(
+        "--detbreak-wafer-overhead",
+        required=False,
+        default=0,
+        type=float,
+        help="Fixed cost of a wafer in detectors when balancing the detector "
+        "breaks.  A wafer of N detectors costs samples x (N + overhead).",
+        dest="detbreak_wafer_overhead",
+    )
+    parser.add_argument(
+        "--distribute-by-cost",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Balance the process groups by the number of detector samples "
+        "of each CES instead of the number of CESs",
+        dest="distribute_by_cost",
+    )
+    return
+
+
+def get_detbreaks(focalplane, ndetrank, balance=False, nsample=1, overhead=0):
+    """ Partition the focalplane detectors across detector ranks.
+
+    The partition only depends on the focalplane, so it is computed once
+    and cached.  Detector pairs are never split.
+
+    Args:
+        focalplane (Focalplane) :  The focalplane.
+        ndetrank (int) :  The number of detector ranks.
+        balance (bool) :  Use the balanced planner instead of filling the
+            ranks in order.  The ranks are balanced by the cost of their
+            wafers, the number of samples times the number of detectors
+            plus the overhead.
+        nsample (int) :  The number of samples in the observation.
+        overhead (float) :  The fixed cost of a wafer, in detectors.
+    Returns:
+        detbreaks (list) :  Indices of the sorted detector list where the
+            detectors of a new rank start.
+    """
+    # The sample count scales all costs equally and does not move the
+    # breaks, so it is not part of the key
+    key = (id(focalplane), ndetrank, balance, overhead)
+    if key in _detbreaks_cache and _detbreaks_cache[key][0] is focalplane:
+        return _detbreaks_cache[key][1]
+    detlist = sorted(list(focalplane.detquats.keys()))
+    if balance:
+        wafers = [focalplane.detector_data[x]["wafer"] for x in detlist]
+        costs = detector_costs(wafers, nsample, overhead=overhead)
+        detbreaks = balanced_detbreaks(detlist, ndetrank, costs=costs)
+    else:
+        detbreaks = count_detbreaks(detlist, ndetrank)
+    # Keep a reference to the focalplane so that its id is not reused
+    _detbreaks_cache[key] = (focalplane, detbreaks)
+    return detbreaks
+
+
 @function_timer
 def create_observation(args, comm, telescope, ces, verbose=True):
     """ Create a TOAST observation.
@@ -38,19 +115,13 @@ def create_observation(args, comm, telescope, ces, verbose=True):
         el_nod = None
 
     # Create a list of detector break indices that avoids splitting detector pairs
-    detlist = sorted(list(focalplane.detquats.keys()))
-    detbreaks = []
-    last_det = None
-    ndet_target = len(detlist) // ndetrank
-    if ndet_target * ndetrank < len(detlist):
-        ndet_target += 1
-    ndet = 0
-    for idet, det in enumerate(detlist):
-        if ndet >= ndet_target and det[:-1] != last_det[:-1]:
-            ndet = 0
-            detbreaks.append(idet)
-        ndet += 1
-        last_det = det
+    detbreaks = get_detbreaks(
+        focalplane,
+        ndetrank,
+        balance=args.balance_detbreaks,
+        nsample=totsamples,
+        overhead=args.detbreak_wafer_overhead,
+    )
 
     try:
         tod = TODGround(
@@ -103,7 +174,9 @@ def create_observation(args, comm, telescope, ces, verbose=True):
     )
     obs["tod"] = tod
     obs["baselines"] = None
-    obs["noise"] = copy.deepcopy(focalplane.noise)
+    # Observations share the PSDs of the focalplane noise model and only
+    # store their elevation scaling
+    obs["noise"] = ElevationScaledNoise(focalplane.noise)
     obs["id"] = int(ces.mjdstart * 10000)
     obs["intervals"] = tod.subscans
     obs["site"] = site.name
@@ -151,11 +224,22 @@ def create_observations(args, comm, schedules):
 
         breaks = get_breaks(comm, all_ces, args)
 
-        groupdist = distribute_uniform(nces, comm.ngroups, breaks=breaks)
-        group_firstobs = groupdist[comm.group][0]
-        group_numobs = groupdist[comm.group][1]
+        if args.distribute_by_cost:
+            # Weight each CES by its number of detector samples
+            ndet = len(telescope.focalplane.detquats)
+            costs = [
+                (ces.stop_time - ces.start_time) * args.sample_rate * ndet
+                for ces in all_ces
+            ]
+            groupdist = distribute_weighted(costs, comm.ngroups, breaks=breaks)
+            group_ces = groupdist[comm.group]
+        else:
+            groupdist = distribute_uniform(nces, comm.ngroups, breaks=breaks)
+            group_firstobs = groupdist[comm.group][0]
+            group_numobs = groupdist[comm.group][1]
+            group_ces = range(group_firstobs, group_firstobs + group_numobs)
 
-        for ices in range(group_firstobs, group_firstobs + group_numobs):
+        for ices in group_ces:
             obs = create_observation(args, comm, telescope, all_ces[ices])
             data.obs.append(obs)
 
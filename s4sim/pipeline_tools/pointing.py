@@ -0,0 +1,152 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+
+import numpy as np
+
+from toast.dist import Data
+import toast.pipeline_tools as toast_tools
+from toast.timing import function_timer, Timer
+from toast.todmap import OpPointingHpix
+from toast.utils import Logger
+
+from ..pointingcache import PointingCache
+
+
+def add_pointing_args(parser):
+    parser.add_argument(
+        "--pointing-cache-dir",
+        required=False,
+        help="Directory of expanded detector pointing.  Observations found "
+        "there are loaded instead of expanded, new ones are added.",
+        dest="pointing_cache_dir",
+    )
+    return
+
+
+def _pointing_key(args, tod, name):
+    """ Return the pointing cache key of the local part of an observation."""
+    dets = tod.local_dets
+    detoffset = tod.detoffset()
+    detquats = np.array([detoffset[det] for det in dets])
+    boresight = tod.read_boresight()
+    try:
+        hwpang = tod.local_hwp_angle()
+    except Exception:
+        hwpang = None
+    if hwpang is not None:
+        boresight = np.hstack([boresight.ravel(), hwpang])
+    return PointingCache.key(
+        name,
+        dets,
+        detquats,
+        boresight,
+        local_samples=[int(x) for x in tod.local_samples],
+        nside=args.nside,
+        nside_submap=args.nside_submap,
+        nest=True,
+        mode="IQU",
+        single_precision=args.single_precision_pointing,
+    )
+
+
+@function_timer
+def expand_pointing(args, comm, data):
+    """ Expand boresight pointing to every detector.
+
+    Without a pointing cache directory this is toast_tools.expand_pointing.
+    Otherwise the pixel numbers and weights of each observation are loaded
+    from the cache if they were stored by an earlier job with the same
+    observation, detectors, boresight and pixelization, and expanded and
+    stored if not.  Pixels are stored as int32 and weights in the precision
+    of the run, float32 with --single-precision-pointing.
+
+    Args:
+        args (argparse.Namespace) :  The pipeline arguments.
+        comm (toast.Comm) :  The toast communicator.
+        data (toast.Data) :  The distributed data.
+
+    Returns:
+        None
+
+    """
+    if args.pointing_cache_dir is None:
+        toast_tools.expand_pointing(args, comm, data)
+        return
+
+    log = Logger.get()
+    timer = Timer()
+    timer.start()
+
+    if comm.world_rank == 0:
+        log.info("Expanding pointing with cache in {}".format(args.pointing_cache_dir))
+
+    cache = PointingCache(args.pointing_cache_dir)
+    if args.single_precision_pointing:
+        pixels_dtype, weights_dtype = np.int32, np.float32
+    else:
+        pixels_dtype, weights_dtype = np.int64, np.float64
+    nside_submap = min(args.nside, args.nside_submap)
+    npix_submap = 12 * nside_submap**2
+    nsubmap = (args.nside // nside_submap) ** 2
+    hit_submaps = np.zeros(nsubmap, dtype=bool)
+    nloaded = 0
+    for obs in data.obs:
+        tod = obs["tod"]
+        key = _pointing_key(args, tod, obs["name"])
+        if cache.has(key):
+            pixels, weights, submaps = cache.read(key)
+            for idet, det in enumerate(tod.local_dets):
+                tod.cache.put(
+                    "pixels_{}".format(det),
+                    pixels[idet].astype(pixels_dtype, copy=False),
+                    replace=True,
+                )
+                tod.cache.put(
+                    "weights_{}".format(det),
+                    weights[idet].astype(weights_dtype, copy=False),
+                    replace=True,
+                )
+            hit_submaps[submaps] = True
+            nloaded += 1
+            del pixels, weights
+            continue
+        # Expand this observation only
+        subdata = Data(data.comm)
+        subdata.obs.append(obs)
+        pointing = OpPointingHpix(
+            nside=args.nside,
+            nest=True,
+            mode="IQU",
+            single_precision=args.single_precision_pointing,
+            nside_submap=args.nside_submap,
+        )
+        pointing.exec(subdata)
+        submaps = pointing.local_submaps
+        hit_submaps[submaps] = True
+        pixels = np.array(
+            [tod.cache.reference("pixels_{}".format(det)) for det in tod.local_dets],
+            dtype=np.int32,
+        )
+        weights = np.array(
+            [tod.cache.reference("weights_{}".format(det)) for det in tod.local_dets],
+            dtype=weights_dtype,
+        )
+        cache.write(key, pixels, weights, submaps)
+        del pixels, weights
+
+    # The same metadata as OpPointingHpix
+    data["pixels_local_submaps"] = np.arange(nsubmap, dtype=pixels_dtype)[hit_submaps]
+    data["pixels_npix_submap"] = npix_submap
+    data["pixels_nsubmap"] = nsubmap
+    data["pixels_npix"] = 12 * args.nside**2
+
+    if comm.comm_world is not None:
+        nloaded = comm.comm_world.allreduce(nloaded)
+        nobs = comm.comm_world.allreduce(len(data.obs))
+        comm.comm_world.barrier()
+    else:
+        nobs = len(data.obs)
+    if comm.world_rank == 0:
+        log.info("Loaded {} of {} local pointing matrices".format(nloaded, nobs))
+        timer.report_clear("Pointing generation")
+    return
@@ -0,0 +1,63 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+
+import numpy as np
+
+from toast.timing import function_timer
+
+from ..precision import check_precision_args
+
+
+def add_precision_args(parser):
+    parser.add_argument(
+        "--single-precision-tod",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Store the total signal (atmosphere, sky, noise) and the "
+        "scanned sky signal in single precision.  Validate against a double "
+        "precision run with s4_compare_maps.",
+        dest="single_precision_tod",
+    )
+    return
+
+
+def tod_dtype(args):
+    """ Return the data type of the cached signal buffers."""
+    if args.single_precision_tod:
+        return np.float32
+    return np.float64
+
+
+@function_timer
+def allocate_tod(args, data, name):
+    """ Create zeroed signal buffers in the precision of the run.
+
+    The toast operators add to existing cached buffers and only create
+    double precision buffers for missing ones.  Creating single precision
+    buffers up front makes every operator accumulate into them.  Existing
+    buffers are left untouched.
+
+    Args:
+        args (argparse.Namespace) :  The pipeline arguments.
+        data (toast.Data) :  The distributed data.
+        name (str) :  The cache prefix of the signal.
+
+    Returns:
+        None
+
+    """
+    dtype = tod_dtype(args)
+    if dtype == np.float64:
+        return
+    for obs in data.obs:
+        tod = obs["tod"]
+        nsamp = tod.local_samples[1]
+        for det in tod.local_dets:
+            cachename = "{}_{}".format(name, det)
+            if tod.cache.exists(cachename):
+                continue
+            ref = tod.cache.create(cachename, dtype, (nsamp,))
+            ref[:] = 0
+            del ref
+    return
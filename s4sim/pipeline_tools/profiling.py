@@ -0,0 +1,61 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+
+import os
+
+from toast.utils import Logger
+
+from ..profiling import StageTrace
+
+
+def add_profile_args(parser):
+    parser.add_argument(
+        "--profile-trace",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Record the wall time, CPU time and peak memory of every stage "
+        "and process in <outdir>/profile.jsonl.  Summarize with "
+        "s4_profile_summary.",
+        dest="profile_trace",
+    )
+    parser.add_argument(
+        "--profile-allocations",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Also trace the bytes allocated in every stage.  Slow.",
+        dest="profile_allocations",
+    )
+    return
+
+
+def setup_profiling(args, comm):
+    """ Enable the stage trace if requested."""
+    if args.profile_trace:
+        StageTrace.get().enable(comm.world_rank, allocations=args.profile_allocations)
+    return
+
+
+def profile_stage(name, **kwargs):
+    """ Return a context manager recording one stage of the pipeline.
+
+    Args:
+        name (str) :  The stage name.
+        kwargs :  Parameters of the stage, e.g. mc=mc.
+
+    """
+    return StageTrace.get().stage(name, **kwargs)
+
+
+def write_profile(args, comm):
+    """ Gather the stage trace to the root process and write it."""
+    trace = StageTrace.get()
+    if not trace.enabled:
+        return
+    path = os.path.join(args.outdir, "profile.jsonl")
+    trace.write(path, comm=comm.comm_world)
+    if comm.world_rank == 0:
+        log = Logger.get()
+        log.info("Wrote stage trace to {}".format(path))
+    return
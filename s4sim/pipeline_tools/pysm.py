@@ -1,17 +1,32 @@
 # Copyright (c) 2020-2020 CMB-S4 Collaboration.
 # Full license can be found in the top level "LICENSE" file.
 
+import healpy as hp
 import numpy as np
 
+from toast.map import DistPixels
 from toast.timing import function_timer, Timer
-from toast.todmap import OpSimPySM
+from toast.todmap import OpSimPySM, OpSimScan
+from toast.todmap.pysm import PySMSky
+from toast.todmap.sim_det_pysm import (
+    assemble_map_on_rank0,
+    extract_detector_parameters,
+    extract_local_dets,
+)
 from toast.utils import Logger
 
+from ..skycache import SkyCache
+from .precision import allocate_tod
+
 try:
     import pysm
+    import pysm.units as u
 except:
     pysm = None
 
+# Number of samples of the top hat bandpasses, as in OpSimPySM
+N_POINTS_BANDPASS = 10
+
 try:
     import so_pysm_models
 except Exception as e:
@@ -45,28 +60,90 @@ def add_pysm_args(parser):
         dest="pysm_apply_beam",
     )
     parser.set_defaults(pysm_apply_beam=True)
+    parser.add_argument(
+        "--pysm-cache-dir",
+        required=False,
+        help="Directory of bandpass-integrated and smoothed PySM maps.  "
+        "Detectors that share a band and beam are simulated once and the "
+        "maps are reused by later runs",
+        dest="pysm_cache_dir",
+    )
     return
 
 
-@function_timer
-def simulate_sky_signal(
-    args, comm, data, focalplanes, subnpix, localsm, signalname=None
-):
-    """ Use PySM to simulate smoothed sky signal.
+def _band_keys(args, comm, local_dets, focalplanes):
+    """ Return the cache key and parameters of every local band.
+
+    The keys of all processes in comm are combined, so that all of them
+    visit the same bands in the same order.
 
     """
-    log = Logger.get()
-    timer = Timer()
-    timer.start()
-    # Convolve a signal TOD from PySM
-    if comm.world_rank == 0:
-        log.info("Simulating sky signal with PySM")
+    local_keys = dict()
+    det_keys = dict()
+    for det in local_dets:
+        bandcenter, bandwidth, fwhm_deg = extract_detector_parameters(det, focalplanes)
+        if not args.pysm_apply_beam:
+            fwhm_deg = None
+        elif fwhm_deg == -1:
+            raise RuntimeError(
+                "apply beam is True but focalplane doesn't have fwhm for {}".format(det)
+            )
+        key = SkyCache.key(
+            args.pysm_model.split(","),
+            args.nside,
+            bandcenter,
+            bandwidth,
+            fwhm=fwhm_deg,
+            coord="G",
+            nest=True,
+            units="K_CMB",
+            pysm_version=getattr(pysm, "__version__", None),
+        )
+        local_keys[key] = (bandcenter, bandwidth, fwhm_deg)
+        det_keys[det] = key
+    if comm is None:
+        all_keys = local_keys
+    else:
+        all_keys = dict()
+        for keys in comm.allgather(local_keys):
+            all_keys.update(keys)
+    return all_keys, det_keys
 
-    map_dist = (
-        None
-        if comm is None
-        else pysm.MapDistribution(nside=args.nside, mpi_comm=comm.comm_rank)
+
+def _simulate_band(comm, pysm_sky, npix, bandcenter, bandwidth, fwhm_deg):
+    """ Run PySM for one band and return the NEST map on the root process."""
+    bandpass = (
+        np.linspace(
+            bandcenter - bandwidth / 2, bandcenter + bandwidth / 2, N_POINTS_BANDPASS
+        ),
+        np.ones(N_POINTS_BANDPASS),
     )
+    local_maps = dict()
+    pysm_sky.exec(local_maps, out="sky", bandpasses={"": bandpass})
+    local_map = local_maps["sky"]
+    if fwhm_deg is not None:
+        local_map = pysm.apply_smoothing_and_coord_transform(
+            local_map, fwhm=fwhm_deg * u.deg, map_dist=pysm_sky.map_dist
+        )
+    if comm is None:
+        pixel_indices = np.arange(local_map.shape[1])
+    else:
+        pixel_indices = pysm_sky.map_dist.pixel_indices
+    full_map = assemble_map_on_rank0(comm, local_map, pixel_indices, 3, npix)
+    if comm is None or comm.rank == 0:
+        # PySM is RING
+        full_map = hp.reorder(full_map, r2n=True)
+    return full_map
+
+
+def get_pysm_components(args, map_dist):
+    """ Parse the PySM model tags.
+
+    Returns:
+        pysm_model (list) :  The PySM preset tags.
+        pysm_component_objects (list) :  The so_pysm_models components.
+
+    """
     pysm_component_objects = []
     pysm_model = []
     for model_tag in args.pysm_model.split(","):
@@ -124,9 +201,124 @@ def simulate_sky_signal(
                         model_tag, args.nside, map_dist=map_dist
                     )
                 )
+    return pysm_model, pysm_component_objects
+
+
+@function_timer
+def simulate_cached_sky_signal(
+    args,
+    comm,
+    data,
+    focalplanes,
+    map_dist,
+    signalname,
+):
+    """ Scan PySM maps from the sky cache.
 
+    Detectors with the same band center, band width and beam are grouped
+    and their map is simulated once.  Maps are looked up in the cache
+    directory first, missing ones are simulated and stored.  Every process
+    then reads only its local submaps from the cached file.
+
+    """
+    log = Logger.get()
+    cache = SkyCache(args.pysm_cache_dir)
+    mpicomm = comm.comm_rank
+    rank = 0 if mpicomm is None else mpicomm.rank
+
+    local_dets = extract_local_dets(data)
+    all_keys, det_keys = _band_keys(args, mpicomm, local_dets, focalplanes)
+
+    npix = data["pixels_npix"]
+    npix_submap = data["pixels_npix_submap"]
+    local_submaps = data["pixels_local_submaps"]
+    pysm_sky = None
+    nsim = 0
+    for key in sorted(all_keys):
+        # All processes must agree, another job may be writing the map
+        cached = cache.has(key)
+        if mpicomm is not None:
+            cached = mpicomm.bcast(cached, root=0)
+        if not cached:
+            if pysm_sky is None:
+                # The sky model is only loaded if some map is missing
+                pysm_model, pysm_component_objects = get_pysm_components(
+                    args, map_dist
+                )
+                pysm_sky = PySMSky(
+                    comm=mpicomm,
+                    pixel_indices=None,
+                    nside=args.nside,
+                    pysm_sky_config=pysm_model,
+                    pysm_component_objects=pysm_component_objects,
+                    units="K_CMB",
+                    map_dist=map_dist,
+                )
+            full_map = _simulate_band(mpicomm, pysm_sky, npix, *all_keys[key])
+            if rank == 0:
+                cache.write(key, full_map)
+            nsim += 1
+        if mpicomm is not None:
+            mpicomm.Barrier()
+
+        dets = sorted(det for det, det_key in det_keys.items() if det_key == key)
+        if len(dets) == 0:
+            continue
+        distmap = DistPixels(data, comm=None, nnz=3, dtype=np.float32)
+        if distmap.data is not None:
+            distmap.data[:] = cache.read_submaps(key, local_submaps, npix_submap)
+        OpSimScan(input_map=distmap, out=signalname, dets=dets).exec(data)
+        del distmap
+
+    if rank == 0:
+        log.info(
+            "Scanned {} PySM bands, {} simulated and {} from {}".format(
+                len(all_keys), nsim, len(all_keys) - nsim, args.pysm_cache_dir
+            )
+        )
+    return
+
+
+@function_timer
+def simulate_sky_signal(
+    args, comm, data, focalplanes, subnpix, localsm, signalname=None
+):
+    """ Use PySM to simulate smoothed sky signal.
+
+    """
+    log = Logger.get()
+    timer = Timer()
+    timer.start()
+    # Convolve a signal TOD from PySM
+    if comm.world_rank == 0:
+        log.info("Simulating sky signal with PySM")
+
+    map_dist = (
+        None
+        if comm is None
+        else pysm.MapDistribution(nside=args.nside, mpi_comm=comm.comm_rank)
+    )
     if signalname is None:
         signalname = "pysmsignal"
+    allocate_tod(args, data, signalname)
+    assert args.coord in "CQ", "Input S4 models are always in Equatorial coordinates"
+    if args.pysm_cache_dir is not None:
+        simulate_cached_sky_signal(
+            args,
+            comm,
+            data,
+            focalplanes,
+            map_dist,
+            signalname,
+        )
+        if comm.comm_world is not None:
+            comm.comm_world.barrier()
+        timer.stop()
+        if comm.world_rank == 0:
+            timer.report("PySM")
+        return signalname
+
+    pysm_model, pysm_component_objects = get_pysm_components(args, map_dist)
     op_sim_pysm = OpSimPySM(
         comm=comm.comm_rank,
         out=signalname,
@@ -140,7 +332,6 @@ def simulate_sky_signal(
         coord="G",  # setting G doesn't perform any rotation
         map_dist=map_dist,
     )
-    assert args.coord in "CQ", "Input S4 models are always in Equatorial coordinates"
     op_sim_pysm.exec(data)
     if comm.comm_world is not None:
         comm.comm_world.barrier()
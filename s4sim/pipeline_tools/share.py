@@ -0,0 +1,152 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+"""Node-level sharing of hardware data between processes.
+"""
+
+import numpy as np
+
+from toast.mpi import MPI
+
+from .. import hardware
+
+
+# Shared memory windows must stay allocated for as long as the arrays which
+# use them.  Hardware is loaded once per job, so they are kept here until
+# free_shared() is called at the end of the pipeline.
+_windows = list()
+_comms = list()
+
+
+def node_comms(comm):
+    """Split a communicator into node communicators.
+
+    Args:
+        comm (MPI.Comm): The communicator to split.
+
+    Returns:
+        (tuple): The communicator of the processes on this node and the
+            communicator of the first process on every node (None on the
+            other processes).
+
+    """
+    comm_node = comm.Split_type(MPI.COMM_TYPE_SHARED, key=comm.rank)
+    if comm_node.rank == 0:
+        color = 0
+    else:
+        color = MPI.UNDEFINED
+    comm_leaders = comm.Split(color, key=comm.rank)
+    if comm_leaders == MPI.COMM_NULL:
+        comm_leaders = None
+    return comm_node, comm_leaders
+
+
+def free_shared():
+    """Free the shared memory windows and their communicators.
+
+    This is collective over the processes that shared the hardware.  The
+    shared hardware arrays must not be used afterwards.
+
+    Returns:
+        None
+
+    """
+    while len(_windows) > 0:
+        _windows.pop(0).Free()
+    while len(_comms) > 0:
+        _comms.pop(0).Free()
+    return
+
+
+def shared_array(comm_node, comm_leaders, array, shape, dtype):
+    """Copy an array into memory shared by all processes on a node.
+
+    The array is broadcast from the first process of the world to the first
+    process of every node, directly into the shared memory window of that
+    node.  The other processes only attach to the window.
+
+    Args:
+        comm_node (MPI.Comm): The node communicator.
+        comm_leaders (MPI.Comm): The node leader communicator or None.
+        array (array): The array on the root process, None elsewhere.
+        shape (tuple): The shape of the array.
+        dtype (str): The dtype string of the array.
+
+    Returns:
+        (array): A read-only array in shared memory.
+
+    """
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    if comm_node.rank == 0:
+        size = max(nbytes, 1)
+    else:
+        size = 0
+    win = MPI.Win.Allocate_shared(size, 1, comm=comm_node)
+    _windows.append(win)
+    buf, _ = win.Shared_query(0)
+    raw = np.ndarray(buffer=buf, dtype=np.uint8, shape=(max(nbytes, 1),))
+    if comm_leaders is not None:
+        if array is not None:
+            raw[:nbytes] = np.ascontiguousarray(array).view(np.uint8).reshape(-1)
+        comm_leaders.Bcast([raw, MPI.BYTE], root=0)
+    comm_node.Barrier()
+    result = np.ndarray(buffer=raw, dtype=dtype, shape=shape)
+    result.flags.writeable = False
+    return result
+
+
+def share_hardware(comm, hw, det_index=None):
+    """Distribute hardware to all processes with one copy per node.
+
+    The non-detector sections are small and are broadcast as usual.  The
+    detector columns (and the optional running detector index) are placed
+    in node-level shared memory windows, so every process holds a
+    DetectorTable backed by the single copy of its node instead of a
+    private, unpickled copy of all detectors.
+
+    Args:
+        comm (MPI.Comm): The communicator.  All processes must call this.
+        hw (Hardware): The hardware on the root process, None elsewhere.
+        det_index (dict): Optional map of detector name to running index on
+            the root process.
+
+    Returns:
+        (tuple): The Hardware with shared columnar detectors and the
+            det_index dictionary.
+
+    """
+    comm_node, comm_leaders = node_comms(comm)
+    _comms.extend(x for x in [comm_node, comm_leaders] if x is not None)
+    layout = None
+    arrays = None
+    if comm.rank == 0:
+        hw.to_columnar()
+        dets = hw.data["detectors"]
+        arrays = dets.to_arrays()
+        if det_index is not None:
+            arrays["det_index"] = np.array([det_index[x] for x in dets.names])
+        aux = hardware.Hardware()
+        aux.data.update([(k, v) for k, v in hw.data.items() if k != "detectors"])
+        layout = (aux, [(k, v.shape, v.dtype.str) for k, v in arrays.items()])
+    # Two-level broadcast:  first to the node leaders, then within each node
+    if comm_leaders is not None:
+        layout = comm_leaders.bcast(layout, root=0)
+    layout = comm_node.bcast(layout, root=0)
+    aux, shapes = layout
+
+    shared = dict()
+    for k, shape, dtype in shapes:
+        if arrays is None:
+            array = None
+        else:
+            array = arrays[k]
+        shared[k] = shared_array(comm_node, comm_leaders, array, shape, dtype)
+
+    hw = aux
+    hw.data["detectors"] = hardware.DetectorTable.from_arrays(shared)
+    if "det_index" in shared:
+        names = hw.data["detectors"].names.tolist()
+        det_index = dict(zip(names, shared["det_index"].tolist()))
+    else:
+        det_index = None
+    return hw, det_index
@@ -0,0 +1,135 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+"""Fused assembly of the simulated signal of one Monte Carlo realization.
+"""
+
+import numpy as np
+
+import toast.pipeline_tools as toast_tools
+from toast.timing import function_timer, Timer
+from toast.utils import Logger
+
+from .atm import atmosphere_scale_factors
+from .profiling import profile_stage
+
+
+# Number of samples processed at once.  A block of the output and of each
+# input (8 bytes per sample) stays in the core-local cache.
+BLOCK_SIZE = 16384
+
+
+def add_signal_args(parser):
+    parser.add_argument(
+        "--fused-signal",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Apply the atmosphere scaling and add the sky signal in one "
+        "fused pass over the detector buffers.  In double precision the "
+        "result is identical to the separate operators.",
+        dest="fused_signal",
+    )
+    return
+
+
+def _scale_and_add(total, scale, signal):
+    """Apply total = total * scale + signal one block at a time.
+
+    Single precision buffers are updated through a double precision
+    block, so they are rounded once per pass rather than per operation.
+    """
+    if total.dtype == np.float64:
+        work = None
+    else:
+        work = np.empty(BLOCK_SIZE, dtype=np.float64)
+    for first in range(0, total.size, BLOCK_SIZE):
+        block = total[first : first + BLOCK_SIZE]
+        if work is not None:
+            out = block
+            block = work[: out.size]
+            block[:] = out
+        if scale is not None:
+            block *= scale
+        if signal is not None:
+            block += signal[first : first + BLOCK_SIZE]
+        if work is not None:
+            out[:] = block
+    return
+
+
+@function_timer
+def assemble_signal(
+    args, comm, data, mc, totalname, signalname, purge=False, verbose=True
+):
+    """ Assemble the total signal of one realization.
+
+    This replaces the sequence of scale_atmosphere_by_bandpass(),
+    add_signal(), simulate_noise(), simulate_sss() and scramble_gains().
+    The cached signal under totalname must be pure atmosphere (or absent).
+    The atmosphere scaling and the sky are applied in one pass, one block
+    of samples at a time, in the same order as by the separate operators,
+    so the result is bit-identical in double precision.  Single precision
+    buffers (--single-precision-tod) are updated through double precision
+    blocks.  Noise, the scan-synchronous signal and the gain errors are
+    then simulated by the TOAST operators.
+
+    Args:
+        args (argparse.Namespace) :  The pipeline arguments.
+        comm (toast.Comm) :  The toast communicator.
+        data (toast.Data) :  The distributed data.
+        mc (int) :  The Monte Carlo realization.
+        totalname (str) :  Cache prefix of the total signal.
+        signalname (str) :  Cache prefix of the sky signal or None.
+        purge (bool) :  If True, the sky signal is cleared after use.
+
+    Returns:
+        None
+
+    """
+    log = Logger.get()
+    timer = Timer()
+    timer.start()
+
+    if signalname == totalname:
+        signalname = None
+
+    # First pass:  atmosphere scaling and sky signal
+    for obs in data.obs:
+        tod = obs["tod"]
+        if args.simulate_atmosphere:
+            factors = atmosphere_scale_factors(args, obs, mc, log=log)
+        else:
+            factors = None
+        for det in tod.local_dets:
+            cachename = "{}_{}".format(totalname, det)
+            if signalname is None:
+                sky = None
+            else:
+                sky = tod.cache.reference("{}_{}".format(signalname, det))
+            if tod.cache.exists(cachename):
+                total = tod.cache.reference(cachename)
+                scale = None if factors is None else factors[det]
+                _scale_and_add(total, scale, sky)
+                del total
+            elif sky is not None:
+                tod.cache.put(cachename, sky)
+            del sky
+        if purge and signalname is not None:
+            for det in tod.local_dets:
+                tod.cache.clear("{}_{}".format(signalname, det))
+
+    with profile_stage("noise", mc=mc):
+        toast_tools.simulate_noise(args, comm, data, mc, totalname)
+
+    with profile_stage("sss", mc=mc):
+        toast_tools.simulate_sss(args, comm, data, mc, totalname)
+
+    with profile_stage("gains", mc=mc):
+        toast_tools.scramble_gains(args, comm, data, mc, totalname)
+
+    if comm.comm_world is not None:
+        comm.comm_world.barrier()
+    timer.stop()
+    if comm.world_rank == 0 and verbose:
+        timer.report("Fused signal assembly")
+    return
@@ -0,0 +1,105 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+"""Persistent cache of expanded detector pointing.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from .hardware.table import load_npz_memmap
+
+
+# Bump this if the layout of the cached pointing changes.
+POINTING_SCHEMA = 1
+
+
+class PointingCache(object):
+    """Detector pixel numbers and Stokes weights stored on disk.
+
+    Each entry holds the pointing matrix of one process's share of one
+    observation:  the (ndet, nsamp) pixel numbers, the (ndet, nsamp, nnz)
+    weights and the indices of the hit submaps.  Entries are uncompressed
+    .npz files which are memory mapped when loaded.
+
+    Args:
+        cache_dir (str): The cache directory.
+
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def key(name, dets, detquats, boresight, **kwargs):
+        """Return the cache key of an observation.
+
+        Args:
+            name (str): The observation (CES) name.
+            dets (list): The local detector names.
+            detquats (array): The (ndet, 4) detector quaternions.
+            boresight (array): The local boresight quaternions.
+            kwargs: The pixelization and any other parameters that change
+                the pointing matrix, e.g. nside, nest and mode.
+
+        Returns:
+            (str): The hexadecimal key.
+
+        """
+        digest = hashlib.sha256()
+        params = {"name": name, "dets": list(dets), "schema": POINTING_SCHEMA}
+        params.update(kwargs)
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        for array in detquats, boresight:
+            digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, "pointing_{}.npz".format(key[:32]))
+
+    def has(self, key):
+        """Return True if the pointing of a key is in the cache."""
+        return os.path.isfile(self.path(key))
+
+    def write(self, key, pixels, weights, submaps):
+        """Store the pointing matrix of an observation.
+
+        The file is written under a temporary name and then renamed, so
+        that concurrent jobs never read a partial file.
+
+        Args:
+            key (str): The cache key.
+            pixels (array): The (ndet, nsamp) pixel numbers.
+            weights (array): The (ndet, nsamp, nnz) pointing weights.
+            submaps (array): The indices of the hit submaps.
+
+        Returns:
+            None
+
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, pixels=pixels, weights=weights, submaps=submaps)
+            os.replace(temp, self.path(key))
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+        return
+
+    def read(self, key):
+        """Memory map the pointing matrix of an observation.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            (tuple): The read-only pixels, weights and submaps arrays.
+
+        """
+        arrays = load_npz_memmap(self.path(key))
+        return arrays["pixels"], arrays["weights"], arrays["submaps"]
@@ -0,0 +1,85 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+"""Single precision TOD checks and map-level comparison of runs.
+"""
+
+import numpy as np
+
+# healpy.UNSEEN, the value of unobserved pixels
+UNSEEN = -1.6375e30
+
+
+def check_precision_args(args):
+    """Raise an error if the requested operators need double precision TOD.
+
+    The compiled kernels of the polynomial and ground filters and of the
+    checkpoint binner (OpAccumDiag) only accept double precision signal.
+
+    Args:
+        args (argparse.Namespace): The pipeline arguments.
+
+    Returns:
+        None
+
+    """
+    if not args.single_precision_tod:
+        return
+    for dest, option in [
+        ("apply_polyfilter", "--polyfilter"),
+        ("apply_groundfilter", "--groundfilter"),
+        ("checkpoint", "--checkpoint"),
+    ]:
+        if getattr(args, dest, False):
+            raise RuntimeError(
+                "--single-precision-tod does not support {}".format(option)
+            )
+    return
+
+
+def map_differences(reference, test):
+    """Compare two maps pixel by pixel.
+
+    Pixels which are unobserved (UNSEEN) or not finite in either map are
+    ignored.
+
+    Args:
+        reference (array): The (npix,) or (ncomp, npix) reference map.
+        test (array): The map to compare, with the same shape.
+
+    Returns:
+        (list): One dictionary per component with the number of compared
+            pixels, the RMS of the reference, the RMS and the maximum of the
+            absolute difference and the ratio of the two RMS values.
+
+    """
+    reference = np.atleast_2d(reference)
+    test = np.atleast_2d(test)
+    if reference.shape != test.shape:
+        raise RuntimeError(
+            "Map shapes differ: {} and {}".format(reference.shape, test.shape)
+        )
+    good = np.ones(reference.shape[1], dtype=bool)
+    for m in reference, test:
+        good &= np.all(np.isfinite(m), axis=0)
+        good &= np.all(np.abs(m - UNSEEN) > 1e-3 * np.abs(UNSEEN), axis=0)
+    stats = list()
+    for ref, tst in zip(reference, test):
+        ref = ref[good].astype(np.float64)
+        diff = tst[good].astype(np.float64) - ref
+        npix = ref.size
+        if npix == 0:
+            rms_ref, rms_diff, max_diff = 0.0, 0.0, 0.0
+        else:
+            rms_ref = float(np.sqrt(np.mean(ref**2)))
+            rms_diff = float(np.sqrt(np.mean(diff**2)))
+            max_diff = float(np.amax(np.abs(diff)))
+        stats.append(
+            {
+                "npix": int(npix),
+                "rms_reference": rms_ref,
+                "rms_difference": rms_diff,
+                "max_difference": max_diff,
+                "relative": rms_diff / rms_ref if rms_ref > 0 else 0.0,
+            }
+        )
+    return stats
@@ -0,0 +1,303 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+"""Per-stage profiling trace of every process.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import resource
+import time
+import tracemalloc
+
+import numpy as np
+
+
+def _rss():
+    """Return the current and peak resident set size in bytes.
+
+    The peak is the VmHWM of /proc/self/status, which _clear_peak_rss()
+    can reset.  Where it is not available, the lifetime peak reported by
+    getrusage() is used.
+
+    """
+    current, peak = None, None
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    current = int(line.split()[1]) * 1024
+                elif line.startswith("VmHWM:"):
+                    peak = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return current, peak
+
+
+def _clear_peak_rss():
+    """Reset the peak resident set size, if the kernel allows it."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+    return
+
+
+class _Stage(object):
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.peak_rss = 0
+        self.peak_alloc = 0
+
+
+class StageTrace(object):
+    """Record the resources used by the stages of a pipeline.
+
+    Every stage entered with stage() produces one record holding the
+    rank, the stage name, its start time, wall and CPU time, the peak
+    resident set size and, when tracemalloc is tracing, the peak and net
+    bytes allocated.  Stages may be nested;  the peaks of an inner stage
+    count towards the enclosing one.  An instance is disabled until
+    enable() is called and then records nothing.
+
+    Use StageTrace.get() to obtain the instance shared by the pipeline.
+
+    """
+
+    _instance = None
+
+    def __init__(self):
+        self.enabled = False
+        self.rank = 0
+        self.records = list()
+        self._stack = list()
+
+    @classmethod
+    def get(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def enable(self, rank, allocations=False):
+        """Start recording stages.
+
+        Args:
+            rank (int): The rank of this process.
+            allocations (bool): Trace memory allocations with tracemalloc.
+                This slows down Python code which allocates many small
+                objects.
+
+        Returns:
+            None
+
+        """
+        self.enabled = True
+        self.rank = rank
+        if allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        return
+
+    def _fold_peaks(self):
+        """Add the peaks since the last reset to the enclosing stage."""
+        _, peak_rss = _rss()
+        if tracemalloc.is_tracing():
+            peak_alloc = tracemalloc.get_traced_memory()[1]
+        else:
+            peak_alloc = 0
+        if len(self._stack) > 0:
+            parent = self._stack[-1]
+            parent.peak_rss = max(parent.peak_rss, peak_rss)
+            parent.peak_alloc = max(parent.peak_alloc, peak_alloc)
+        return peak_rss, peak_alloc
+
+    @contextmanager
+    def stage(self, name, **kwargs):
+        """Record one stage.
+
+        Args:
+            name (str): The stage name.
+            kwargs: JSON serializable parameters of the stage, e.g. the
+                Monte Carlo index.
+
+        """
+        if not self.enabled:
+            yield
+            return
+        self._fold_peaks()
+        _clear_peak_rss()
+        stage = _Stage(name, kwargs)
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            alloc_start = tracemalloc.get_traced_memory()[0]
+        else:
+            alloc_start = None
+        rss_start, _ = _rss()
+        self._stack.append(stage)
+        start = time.time()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            self._stack.pop()
+            rss_end, peak_rss = _rss()
+            stage.peak_rss = max(stage.peak_rss, peak_rss)
+            record = OrderedDict()
+            record["rank"] = self.rank
+            record["stage"] = name
+            record["depth"] = len(self._stack)
+            record.update(stage.args)
+            record["start"] = start
+            record["wall"] = wall
+            record["cpu"] = cpu
+            record["peak_rss"] = stage.peak_rss
+            if rss_start is not None and rss_end is not None:
+                record["rss_change"] = rss_end - rss_start
+            if alloc_start is not None:
+                alloc_end, peak_alloc = tracemalloc.get_traced_memory()
+                stage.peak_alloc = max(stage.peak_alloc, peak_alloc)
+                record["alloc_peak"] = stage.peak_alloc - alloc_start
+                record["alloc_net"] = alloc_end - alloc_start
+            if len(self._stack) > 0:
+                parent = self._stack[-1]
+                parent.peak_rss = max(parent.peak_rss, stage.peak_rss)
+                parent.peak_alloc = max(parent.peak_alloc, stage.peak_alloc)
+            self.records.append(record)
+        return
+
+    def write(self, path, comm=None):
+        """Gather the records of all processes and write them as JSON lines.
+
+        Args:
+            path (str): The trace file, written by the root process.
+            comm (MPI.Comm, optional): The communicator of all processes
+                with records.
+
+        Returns:
+            None
+
+        """
+        if comm is None:
+            all_records = [self.records]
+            rank = 0
+        else:
+            all_records = comm.gather(self.records, root=0)
+            rank = comm.rank
+        if rank == 0:
+            with open(path, "w") as f:
+                for records in all_records:
+                    for record in records:
+                        f.write(json.dumps(record) + "\n")
+        return
+
+
+def read_trace(path):
+    """Read the records of a trace file.
+
+    Args:
+        path (str): The JSON lines trace file.
+
+    Returns:
+        (list): The records as dictionaries.
+
+    """
+    records = list()
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if len(line) > 0:
+                records.append(json.loads(line))
+    return records
+
+
+def summarize(records):
+    """Summarize the load imbalance of every stage across processes.
+
+    The wall and CPU time of repeated stages, e.g. one per Monte Carlo
+    realization, are added up per process first.
+
+    Args:
+        records (list): The trace records.
+
+    Returns:
+        (list): One dictionary per stage, in order of first appearance,
+            with the number of processes, the number of calls, the
+            minimum, mean and maximum wall time per process, the
+            imbalance (maximum over mean wall time), the rank with the
+            maximum, the ratio of CPU to wall time and the largest peak
+            resident set size.
+
+    """
+    stages = OrderedDict()
+    for record in records:
+        stage = stages.setdefault(
+            record["stage"], {"wall": dict(), "cpu": dict(), "calls": 0, "rss": 0}
+        )
+        rank = record["rank"]
+        stage["wall"][rank] = stage["wall"].get(rank, 0) + record["wall"]
+        stage["cpu"][rank] = stage["cpu"].get(rank, 0) + record["cpu"]
+        stage["calls"] += 1
+        stage["rss"] = max(stage["rss"], record["peak_rss"])
+    summary = list()
+    for name, stage in stages.items():
+        ranks = sorted(stage["wall"])
+        wall = np.array([stage["wall"][x] for x in ranks])
+        cpu = np.array([stage["cpu"][x] for x in ranks])
+        mean = np.mean(wall)
+        summary.append(
+            OrderedDict(
+                stage=name,
+                nproc=len(ranks),
+                calls=stage["calls"],
+                wall_min=float(np.amin(wall)),
+                wall_mean=float(mean),
+                wall_max=float(np.amax(wall)),
+                imbalance=float(np.amax(wall) / mean) if mean > 0 else 1.0,
+                slowest_rank=ranks[np.argmax(wall)],
+                cpu_fraction=float(np.sum(cpu) / np.sum(wall)) if mean > 0 else 0.0,
+                peak_rss=stage["rss"],
+            )
+        )
+    return summary
+
+
+def chrome_trace(records):
+    """Convert trace records to the Chrome trace event format.
+
+    Every process is a thread of a single process in the viewer.
+
+    Args:
+        records (list): The trace records.
+
+    Returns:
+        (dict): The trace, to be written with json.dump().
+
+    """
+    if len(records) == 0:
+        return {"traceEvents": []}
+    t0 = min(x["start"] for x in records)
+    events = list()
+    for record in records:
+        args = {
+            k: v
+            for k, v in record.items()
+            if k not in ("rank", "stage", "start", "wall")
+        }
+        events.append(
+            {
+                "name": record["stage"],
+                "ph": "X",
+                "pid": 0,
+                "tid": record["rank"],
+                "ts": (record["start"] - t0) * 1e6,
+                "dur": record["wall"] * 1e6,
+                "args": args,
+            }
+        )
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
@@ -0,0 +1,85 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+"""Compare the maps of two simulation runs.
+"""
+
+import argparse
+import os
+import sys
+
+import healpy as hp
+
+from ..manifest import RunManifest
+from ..precision import map_differences
+
+
+def _map_pairs(reference, test):
+    """List the (reference, test) maps to compare."""
+    if os.path.isfile(reference) and os.path.isfile(test):
+        return [(reference, test)]
+    ref_products = RunManifest(reference).read()
+    test_products = RunManifest(test).read()
+    pairs = list()
+    for mc in sorted(ref_products):
+        for product in sorted(ref_products[mc]):
+            if not product.endswith((".fits", ".fits.gz")):
+                continue
+            if product not in test_products.get(mc, dict()):
+                continue
+            pairs.append(
+                (os.path.join(reference, product), os.path.join(test, product))
+            )
+    return pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="This program compares the maps of a reference run, e.g. \
+            with double precision TOD, to the maps of a test run, e.g. with \
+            --single-precision-tod.  Run directories are paired through \
+            their run manifests.",
+        usage="s4_compare_maps <reference> <test> [options]",
+    )
+
+    parser.add_argument("reference", type=str, help="Reference map or run directory")
+    parser.add_argument("test", type=str, help="Test map or run directory")
+    parser.add_argument(
+        "--tolerance",
+        required=False,
+        type=float,
+        help="Exit with an error if the RMS difference of any map component "
+        "exceeds this fraction of the reference RMS",
+    )
+
+    args = parser.parse_args()
+
+    pairs = _map_pairs(args.reference, args.test)
+    if len(pairs) == 0:
+        print("No maps to compare", flush=True)
+        sys.exit(1)
+
+    failed = False
+    for ref_file, test_file in pairs:
+        ref_map = hp.read_map(ref_file, field=None, nest=None)
+        test_map = hp.read_map(test_file, field=None, nest=None)
+        print(os.path.relpath(test_file, args.test))
+        stats = map_differences(ref_map, test_map)
+        for icomp, stat in enumerate(stats):
+            print(
+                "  {:3} npix = {:10}  rms = {:.6e}  rms diff = {:.6e}  "
+                "max diff = {:.6e}  relative = {:.3e}".format(
+                    "IQU"[icomp] if len(stats) == 3 else icomp,
+                    stat["npix"],
+                    stat["rms_reference"],
+                    stat["rms_difference"],
+                    stat["max_difference"],
+                    stat["relative"],
+                )
+            )
+            if args.tolerance is not None and stat["relative"] > args.tolerance:
+                failed = True
+    if failed:
+        print("Maps differ by more than {}".format(args.tolerance), flush=True)
+        sys.exit(1)
+
+    return
@@ -3,10 +3,12 @@
 """Simulate the nominal hardware model.
 """
 
+import os
 import sys
 import argparse
 
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 from ..hardware import sim_nominal, sim_detectors_toast
 
@@ -33,6 +35,30 @@ def main():
         help="Write plain text (without gzip compression)",
     )
 
+    parser.add_argument(
+        "--columnar",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Write detectors to a memory-mappable .detectors.npz sidecar file",
+    )
+
+    parser.add_argument(
+        "--nproc",
+        required=False,
+        default=1,
+        type=int,
+        help="Number of processes used to simulate wafers (0 = all cores)",
+    )
+
+    parser.add_argument(
+        "--binary",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Write a single memory-mappable binary .npz file instead of TOML",
+    )
+
     parser.add_argument(
         "--overwrite",
         required=False,
@@ -43,19 +69,46 @@ def main():
 
     args = parser.parse_args()
 
+    nproc = args.nproc
+    if nproc == 0:
+        nproc = os.cpu_count()
+
     print("Getting nominal config...", flush=True)
     hw = sim_nominal()
-    for tele, teleprops in hw.data["telescopes"].items():
-        print("Simulating detectors for telescope {}...".format(tele), flush=True)
-        sim_detectors_toast(hw, tele)
+    executor = None
+    if nproc > 1:
+        executor = ProcessPoolExecutor(max_workers=nproc)
+    try:
+        for tele, teleprops in hw.data["telescopes"].items():
+            print("Simulating detectors for telescope {}...".format(tele), flush=True)
+            sim_detectors_toast(
+                hw, tele, columnar=args.columnar, nproc=nproc, executor=executor
+            )
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
-    if args.plain:
+    if args.binary:
+        outpath = "{}.npz".format(args.out)
+        print("Dumping config to {}...".format(outpath))
+        hw.dump(outpath, overwrite=args.overwrite, binary=True)
+    elif args.plain:
         outpath = "{}.toml".format(args.out)
         print("Dumping config to {}...".format(outpath))
-        hw.dump(outpath, overwrite=args.overwrite, compress=False)
+        hw.dump(
+            outpath,
+            overwrite=args.overwrite,
+            compress=False,
+            columnar=args.columnar,
+        )
     else:
         outpath = "{}.toml.gz".format(args.out)
         print("Dumping config to {}...".format(outpath))
-        hw.dump(outpath, overwrite=args.overwrite, compress=True)
+        hw.dump(
+            outpath,
+            overwrite=args.overwrite,
+            compress=True,
+            columnar=args.columnar,
+        )
 
     return
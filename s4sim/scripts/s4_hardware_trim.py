@@ -37,6 +37,22 @@ def main():
         help="Write plain text (without gzip compression)",
     )
 
+    parser.add_argument(
+        "--columnar",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Write detectors to a memory-mappable .detectors.npz sidecar file",
+    )
+
+    parser.add_argument(
+        "--binary",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Write a single memory-mappable binary .npz file instead of TOML",
+    )
+
     parser.add_argument(
         "--overwrite",
         required=False,
@@ -95,7 +111,8 @@ def main():
                 match[fields[0]] = fields[1]
 
     print("Loading hardware from {}...".format(args.hardware), flush=True)
-    hw = Hardware(args.hardware)
+    # Columnar detectors keep the memory use low for full-size hardware maps
+    hw = Hardware(args.hardware, columnar=True)
 
     print("Selecting detectors from:")
     if telescopes is not None:
@@ -113,13 +130,27 @@ def main():
 
     newhw = hw.select(telescopes=telescopes, tubes=tubes, match=match)
 
-    if args.plain:
+    if args.binary:
+        outpath = "{}.npz".format(args.out)
+        print("Dumping selected config to {}...".format(outpath))
+        newhw.dump(outpath, overwrite=args.overwrite, binary=True)
+    elif args.plain:
         outpath = "{}.toml".format(args.out)
         print("Dumping selected config to {}...".format(outpath))
-        newhw.dump(outpath, overwrite=args.overwrite, compress=False)
+        newhw.dump(
+            outpath,
+            overwrite=args.overwrite,
+            compress=False,
+            columnar=args.columnar,
+        )
     else:
         outpath = "{}.toml.gz".format(args.out)
         print("Dumping selected config to {}...".format(outpath))
-        newhw.dump(outpath, overwrite=args.overwrite, compress=True)
+        newhw.dump(
+            outpath,
+            overwrite=args.overwrite,
+            compress=True,
+            columnar=args.columnar,
+        )
 
     return
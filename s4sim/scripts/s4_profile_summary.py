@@ -0,0 +1,80 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+"""Summarize a pipeline stage trace.
+"""
+
+import argparse
+import json
+
+from ..profiling import chrome_trace, read_trace, summarize
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="This program reads the stage trace written by \
+            toast_s4_sim.py --profile-trace and prints the time, memory and \
+            load imbalance of every stage across processes.",
+        usage="s4_profile_summary <trace file> [options]",
+    )
+
+    parser.add_argument("trace", type=str, help="Input trace file (profile.jsonl)")
+    parser.add_argument(
+        "--chrome",
+        required=False,
+        type=str,
+        help="Also write the trace in the Chrome trace event format to this file",
+    )
+    parser.add_argument(
+        "--json",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Print the summary as JSON lines",
+    )
+
+    args = parser.parse_args()
+
+    records = read_trace(args.trace)
+    summary = summarize(records)
+
+    if args.json:
+        for stage in summary:
+            print(json.dumps(stage))
+    else:
+        print(
+            "{:<24} {:>6} {:>6} {:>10} {:>10} {:>10} {:>9} {:>7} {:>5} {:>9}".format(
+                "Stage",
+                "Nproc",
+                "Calls",
+                "Min [s]",
+                "Mean [s]",
+                "Max [s]",
+                "Imbalance",
+                "Slowest",
+                "CPU",
+                "RSS [GB]",
+            )
+        )
+        for stage in summary:
+            print(
+                "{:<24} {:>6} {:>6} {:>10.2f} {:>10.2f} {:>10.2f} {:>9.2f} {:>7} "
+                "{:>5.2f} {:>9.2f}".format(
+                    stage["stage"],
+                    stage["nproc"],
+                    stage["calls"],
+                    stage["wall_min"],
+                    stage["wall_mean"],
+                    stage["wall_max"],
+                    stage["imbalance"],
+                    stage["slowest_rank"],
+                    stage["cpu_fraction"],
+                    stage["peak_rss"] / 2**30,
+                )
+            )
+
+    if args.chrome is not None:
+        with open(args.chrome, "w") as f:
+            json.dump(chrome_trace(records), f)
+        print("Wrote {}".format(args.chrome), flush=True)
+
+    return
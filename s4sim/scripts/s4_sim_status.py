@@ -0,0 +1,90 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+"""Report the completed realizations of simulation runs.
+"""
+
+import argparse
+import os
+
+from ..manifest import RunManifest
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="This program reads the run manifests of toast_s4_sim.py \
+            output directories and reports the completed realizations \
+            without listing the output files.",
+        usage="s4_sim_status --product name [--product name] "
+        "[outdir, [outdir]] ...",
+    )
+
+    parser.add_argument("outdir", type=str, nargs="+", help="Run output directory")
+    parser.add_argument(
+        "--mc-start", type=int, default=0, help="First Monte Carlo realization"
+    )
+    parser.add_argument(
+        "--mc-count",
+        type=int,
+        default=1,
+        help="Number of Monte Carlo realizations expected in each run",
+    )
+    parser.add_argument(
+        "--product",
+        type=str,
+        action="append",
+        required=True,
+        help="Expected product of every realization, relative to the "
+        "realization directory, e.g. "
+        "toast_telescope_all_time_all_bmap.fits.  Alternative names are "
+        "separated by commas.  Repeat for every product.",
+        dest="products",
+    )
+    parser.add_argument(
+        "--verify",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Check the size and checksum of every recorded product",
+    )
+    parser.add_argument(
+        "--missing",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Only print the output directories with missing realizations",
+    )
+
+    args = parser.parse_args()
+
+    mcs = range(args.mc_start, args.mc_start + args.mc_count)
+    ndone = 0
+    for outdir in args.outdir:
+        manifest = RunManifest(outdir)
+        products = manifest.read()
+        done = list()
+        for mc in mcs:
+            entries = products.get(mc, dict())
+            mcdir = os.path.join(outdir, "{:08}".format(mc))
+            expected = [
+                [os.path.join(mcdir, x) for x in product.split(",")]
+                for product in args.products
+            ]
+            if not manifest.completed(entries, expected):
+                continue
+            if args.verify:
+                bad = [x for x in entries.values() if not manifest.verify(x)]
+                for entry in bad:
+                    print("{}: {} is modified".format(outdir, entry["product"]))
+                if len(bad) > 0:
+                    continue
+            done.append(mc)
+        if len(done) == len(mcs):
+            ndone += 1
+            if not args.missing:
+                print("{}: complete".format(outdir))
+        else:
+            missing = sorted(set(mcs) - set(done))
+            print("{}: missing {}".format(outdir, " ".join(str(x) for x in missing)))
+    print("{} of {} runs complete".format(ndone, len(args.outdir)), flush=True)
+
+    return
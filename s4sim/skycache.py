@@ -0,0 +1,121 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+"""Persistent cache of bandpass-integrated, smoothed sky maps.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+
+# Bump this if the layout of the cached maps changes.
+SKY_SCHEMA = 1
+
+
+class SkyCache(object):
+    """Sky maps stored on disk by their simulation parameters.
+
+    A sky map only depends on the sky model, the resolution, the bandpass,
+    the beam and the coordinate system.  Every map is stored as one NEST
+    ordered (npix, nnz) array, which is the layout of a full set of
+    submaps of any size, so each process can memory map the file and read
+    only its local submaps.
+
+    Args:
+        cache_dir (str): The cache directory.
+
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def key(models, nside, bandcenter, bandwidth, fwhm=None, coord="G", **kwargs):
+        """Return the cache key of a sky map.
+
+        Args:
+            models (list): The sky model tags.
+            nside (int): The HEALPix resolution.
+            bandcenter (float): The band center in GHz.
+            bandwidth (float): The band width in GHz.
+            fwhm (float, optional): The beam FWHM in degrees or None if the
+                map is not smoothed.
+            coord (str): The output coordinate system.
+            kwargs: Any other parameters that change the map, e.g. the
+                version of the sky model package.
+
+        Returns:
+            (str): The hexadecimal key.
+
+        """
+        params = {
+            "models": list(models),
+            "nside": int(nside),
+            "bandcenter": float(bandcenter),
+            "bandwidth": float(bandwidth),
+            "fwhm": None if fwhm is None else float(fwhm),
+            "coord": coord,
+            "schema": SKY_SCHEMA,
+        }
+        params.update(kwargs)
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, "sky_{}.npy".format(key[:32]))
+
+    def has(self, key):
+        """Return True if the map of a key is in the cache."""
+        return os.path.isfile(self.path(key))
+
+    def write(self, key, skymap):
+        """Store a sky map.
+
+        The map is written under a temporary name and then renamed, so that
+        concurrent jobs never read a partial file.
+
+        Args:
+            key (str): The cache key.
+            skymap (array): The NEST ordered map, either (nnz, npix) as
+                returned by healpy or (npix, nnz).
+
+        Returns:
+            None
+
+        """
+        skymap = np.asarray(skymap, dtype=np.float32)
+        if skymap.ndim == 2 and skymap.shape[0] < skymap.shape[1]:
+            skymap = skymap.T
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, np.ascontiguousarray(skymap))
+            os.replace(temp, self.path(key))
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+        return
+
+    def read_submaps(self, key, local_submaps, npix_submap):
+        """Read some submaps of a cached sky map.
+
+        Args:
+            key (str): The cache key.
+            local_submaps (array): The global indices of the submaps.
+            npix_submap (int): The number of pixels in a submap.
+
+        Returns:
+            (array): The (nsubmap, npix_submap, nnz) submap data.
+
+        """
+        skymap = np.load(self.path(key), mmap_mode="r")
+        npix, nnz = skymap.shape
+        if npix % npix_submap != 0:
+            raise RuntimeError(
+                "{} pixels cannot be split in submaps of {}".format(npix, npix_submap)
+            )
+        submaps = skymap.reshape(npix // npix_submap, npix_submap, nnz)
+        return np.array(submaps[np.asarray(local_submaps, dtype=np.int64)])
@@ -0,0 +1,67 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+
+"""Absorption table tests.
+"""
+
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+import numpy as np
+
+from ..absorption import AbsorptionTable, atm_available_utils, band_average
+
+
+class AbsorptionTest(TestCase):
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def test_table(self):
+        if not atm_available_utils:
+            print("libaatm not available, skipping absorption tests")
+            return
+        kwargs = dict(freqmin=20, freqmax=300, nfreq=281)
+        table = AbsorptionTable(5200, cache_dir=self.outdir, **kwargs)
+        # Grid nodes are reproduced exactly
+        np.testing.assert_allclose(
+            table(270.0, 55000.0, 1.0), table.direct(270.0, 55000.0, 1.0)
+        )
+        weather = (272.3, 55420.0, 1.13)
+        bands = [(30, 7), (90, 25), (150, 30), (220, 50), (280, 60)]
+        self.assertLess(table.error(*weather, bands=bands), 1e-3)
+        # A new table reuses the nodes on disk
+        check = AbsorptionTable(5200, cache_dir=self.outdir, **kwargs)
+        self.assertEqual(check.missing(*weather), list())
+        np.testing.assert_array_equal(check(*weather), table(*weather))
+        # Other altitudes do not
+        other = AbsorptionTable(2843, cache_dir=self.outdir, **kwargs)
+        self.assertEqual(len(other.missing(*weather)), 8)
+
+    def test_band_average(self):
+        freqs = np.linspace(0, 1000, 10001)
+        values = np.sin(freqs / 50) ** 2 + freqs / 1000
+        center, width = 93.0, 28.0
+        band_freqs = np.linspace(center - width / 2, center + width / 2, 101)
+        tophat = np.mean(np.interp(band_freqs, freqs, values))
+        self.assertEqual(band_average(freqs, values, center, width), tophat)
+        self.assertEqual(band_average(freqs, values, center, width, ""), tophat)
+        # A flat tabulated bandpass is the same top hat
+        flat = [band_freqs, np.ones(101)]
+        self.assertAlmostEqual(
+            band_average(freqs, values, center, width, flat), tophat, places=12
+        )
+        path = os.path.join(self.outdir, "bandpass.txt")
+        weights = np.exp(-0.5 * ((band_freqs - center) / 5) ** 2)
+        np.savetxt(path, np.vstack([band_freqs, weights]).T)
+        check = np.sum(weights * np.interp(band_freqs, freqs, values)) / np.sum(
+            weights
+        )
+        self.assertAlmostEqual(
+            band_average(freqs, values, center, width, path), check, places=12
+        )
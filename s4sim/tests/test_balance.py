@@ -0,0 +1,118 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+
+"""Load balancing tests.
+"""
+
+from unittest import TestCase
+
+import numpy as np
+
+from ..balance import (
+    balanced_detbreaks,
+    count_detbreaks,
+    detector_costs,
+    distribute_weighted,
+    pair_prefixes,
+)
+
+
+class BalanceTest(TestCase):
+    def setUp(self):
+        # 3 wafers of different sizes, all detectors in A/B pairs
+        self.names = sorted(
+            "{}_{:03d}_{}".format(wafer, pixel, pol)
+            for wafer, npixel in [("LF", 7), ("MF", 37), ("HF", 91)]
+            for pixel in range(npixel)
+            for pol in "AB"
+        )
+
+    def check_pairs(self, detbreaks):
+        prefixes = pair_prefixes(self.names)
+        for i in detbreaks:
+            self.assertNotEqual(prefixes[i], prefixes[i - 1])
+
+    def test_count(self):
+        detbreaks = count_detbreaks(self.names, 8)
+        self.check_pairs(detbreaks)
+        self.assertEqual(len(detbreaks), 7)
+        # Pinned output of the original per-detector loop, with some
+        # unpaired detectors
+        names = sorted(
+            "{}_{:03d}_{}".format(wafer, pixel, pol)
+            for wafer, npixel in [("LF", 7), ("MF", 37), ("HF", 91)]
+            for pixel in range(npixel)
+            for pol in ("A" if pixel % 5 == 0 else "AB")
+        )
+        self.assertEqual(count_detbreaks(names, 3), [81, 162])
+        self.assertEqual(count_detbreaks(names, 8), [32, 63, 95, 126, 158, 189, 220])
+        self.assertEqual(count_detbreaks(names, 1), [])
+        self.assertEqual(count_detbreaks([], 4), [])
+
+    def test_balanced(self):
+        ndet = len(self.names)
+        for ndetrank in [2, 7, 8, 30]:
+            detbreaks = balanced_detbreaks(self.names, ndetrank)
+            self.check_pairs(detbreaks)
+            self.assertEqual(len(detbreaks), ndetrank - 1)
+            sizes = np.diff([0] + detbreaks + [ndet])
+            # Every rank is within one pair of the average
+            self.assertLessEqual(np.max(np.abs(sizes - ndet / ndetrank)), 2)
+        # Costs move the breaks towards the expensive detectors
+        costs = np.array([4.0 if x.startswith("LF") else 1.0 for x in self.names])
+        detbreaks = balanced_detbreaks(self.names, 2, costs=costs)
+        cumulative = np.cumsum(costs)
+        self.assertLessEqual(abs(cumulative[detbreaks[0] - 1] - cumulative[-1] / 2), 4)
+        self.assertEqual(balanced_detbreaks(self.names, 1), [])
+
+    def test_costs(self):
+        ndet = len(self.names)
+        ndetrank = 4
+        wafers = np.array([x[:2] for x in self.names])
+        # Every wafer costs its samples times its detectors
+        costs = detector_costs(wafers, 1000)
+        np.testing.assert_array_equal(costs, 1000)
+        for overhead in [0, 20]:
+            costs = detector_costs(wafers, 1000, overhead=overhead)
+            for wafer, npixel in [("LF", 7), ("MF", 37), ("HF", 91)]:
+                self.assertAlmostEqual(
+                    np.sum(costs[wafers == wafer]), 1000 * (2 * npixel + overhead)
+                )
+            detbreaks = balanced_detbreaks(self.names, ndetrank, costs=costs)
+            self.check_pairs(detbreaks)
+            self.assertEqual(len(detbreaks), ndetrank - 1)
+            bounds = [0] + detbreaks + [ndet]
+            loads = np.array(
+                [np.sum(costs[x:y]) for x, y in zip(bounds[:-1], bounds[1:])]
+            )
+            # The ranks are balanced within the cost of the dearest pair
+            self.assertLessEqual(
+                np.max(np.abs(loads - np.sum(costs) / ndetrank)),
+                2 * np.max(costs),
+            )
+        # Without an overhead the ranks get equal detector counts
+        costs = detector_costs(wafers, 1000)
+        detbreaks = balanced_detbreaks(self.names, ndetrank, costs=costs)
+        self.assertEqual(detbreaks, balanced_detbreaks(self.names, ndetrank))
+
+    def test_distribute(self):
+        np.random.seed(1234)
+        # CES lengths from minutes to hours, two seasons
+        weights = np.random.uniform(5, 300, 200)
+        breaks = [120]
+        ngroup = 8
+        dist = distribute_weighted(weights, ngroup, breaks=breaks)
+        self.assertEqual(len(dist), ngroup)
+        items = np.concatenate(dist)
+        self.assertEqual(sorted(items.tolist()), list(range(len(weights))))
+        for group in dist:
+            # No group crosses the season break
+            self.assertTrue(np.all(np.array(group) < 120) or min(group) >= 120)
+        loads = np.array([np.sum(weights[x]) for x in dist])
+        # LPT is within the largest item of the ideal load in every segment
+        first = np.array([min(x) < 120 for x in dist])
+        for segment in [loads[first], loads[np.logical_not(first)]]:
+            self.assertLess(np.max(segment) - np.min(segment), np.max(weights))
+        # Too many breaks
+        with self.assertRaises(RuntimeError):
+            distribute_weighted(weights, 2, breaks=[10, 20])
@@ -0,0 +1,56 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+
+"""Checkpoint tests.
+"""
+
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+import numpy as np
+
+from ..checkpoint import CheckpointStore
+
+
+class CheckpointTest(TestCase):
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.outdir, "checkpoint")
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def test_two_phase(self):
+        meta = {"ntask": 2, "obs": "abc"}
+        stores = [CheckpointStore(self.path, rank) for rank in range(2)]
+        self.assertEqual(stores[0].committed(meta), 0)
+        hits = [np.zeros(10, dtype=np.int64) for _ in stores]
+        for step in range(1, 4):
+            for rank, store in enumerate(stores):
+                hits[rank][step] += rank + 1
+                store.save(step, {"hits": hits[rank]})
+            stores[0].commit(step, meta)
+        self.assertEqual(stores[1].committed(meta), 3)
+        # A different job does not reuse the checkpoint
+        self.assertEqual(stores[1].committed({"ntask": 4, "obs": "abc"}), 0)
+
+        # Interrupted during the next checkpoint:  one rank saved step 4
+        saved = hits[0].copy()
+        hits[0][4] += 1
+        stores[0].save(4, {"hits": hits[0]})
+        step = stores[0].committed(meta)
+        self.assertEqual(step, 3)
+        for rank, store in enumerate(stores):
+            arrays = store.load(step)
+            expected = saved if rank == 0 else hits[rank]
+            np.testing.assert_array_equal(arrays["hits"], expected)
+        # The uncommitted step overwrote a generation of step 2
+        with self.assertRaises(RuntimeError):
+            stores[0].load(2)
+
+        stores[0].clear()
+        self.assertFalse(os.path.isdir(self.path))
+        self.assertEqual(stores[0].committed(meta), 0)
@@ -0,0 +1,253 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+
+"""Hardware model tests.
+"""
+
+import os
+import shutil
+import tempfile
+
+from collections import OrderedDict
+from unittest import TestCase
+
+import numpy as np
+import toast.qarray as qa
+
+from ..hardware import (
+    DetectorTable,
+    Hardware,
+    boresight_angle,
+    detector_sidecar,
+    is_binary_hardware,
+    sim_nominal,
+    sim_telescope_detectors,
+)
+
+
+def fake_hardware():
+    """Return a small Hardware object with two wafers of detectors."""
+    hw = Hardware()
+    hw.data["telescopes"] = OrderedDict([("SAT1", OrderedDict([("tubes", ["ST0"])]))])
+    hw.data["tubes"] = OrderedDict([("ST0", OrderedDict([("wafers", ["00", "01"])]))])
+    hw.data["wafers"] = OrderedDict(
+        [
+            ("00", OrderedDict([("card", "00"), ("bands", ["f090", "f150"])])),
+            ("01", OrderedDict([("card", "01"), ("bands", ["f090", "f150"])])),
+        ]
+    )
+    hw.data["cards"] = OrderedDict(
+        [("00", OrderedDict([("nchannel", 8)])), ("01", OrderedDict([("nchannel", 8)]))]
+    )
+    hw.data["crates"] = OrderedDict([("0", OrderedDict([("cards", ["00", "01"])]))])
+    hw.data["bands"] = OrderedDict(
+        [
+            ("f090", OrderedDict([("center", 90.0)])),
+            ("f150", OrderedDict([("center", 150.0)])),
+        ]
+    )
+    dets = OrderedDict()
+    ID = 0
+    for wafer in ["00", "01"]:
+        for pixel in range(3):
+            for band in ["f090", "f150"]:
+                for pol in ["A", "B"]:
+                    props = OrderedDict()
+                    props["wafer"] = wafer
+                    props["ID"] = ID
+                    props["pixel"] = f"{pixel:03d}"
+                    props["band"] = band
+                    props["pol"] = pol
+                    props["fwhm"] = 10.0 + ID
+                    props["quat"] = np.array([0.0, 0.0, np.sin(ID), np.cos(ID)])
+                    dets[f"{wafer}_{pixel:03d}_{band}_{pol}"] = props
+                    ID += 1
+    hw.data["detectors"] = dets
+    return hw
+
+
+class HardwareTest(TestCase):
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def test_table_roundtrip(self):
+        dets = fake_hardware().data["detectors"]
+        table = DetectorTable.from_dict(dets)
+        self.assertEqual(len(table), len(dets))
+        self.assertEqual(list(table), list(dets))
+        self.assertEqual(table.column("quat").shape, (len(dets), 4))
+        for name, props in dets.items():
+            row = table[name]
+            self.assertEqual(list(row.keys()), list(props.keys()))
+            np.testing.assert_array_equal(row["quat"], props["quat"])
+            self.assertEqual(row["band"], props["band"])
+        back = table.to_dict()
+        self.assertEqual(list(back), list(dets))
+
+    def test_table_edit(self):
+        dets = fake_hardware().data["detectors"]
+        table = DetectorTable.from_dict(dets)
+        names = list(dets)
+        del table[names[0]]
+        del table[names[5]]
+        self.assertEqual(len(table), len(names) - 2)
+        self.assertNotIn(names[0], table)
+        self.assertEqual(list(table), names[1:5] + names[6:])
+        extra = OrderedDict(dets[names[0]])
+        extra["handed"] = "L"
+        table[names[0]] = extra
+        self.assertEqual(list(table)[-1], names[0])
+        self.assertEqual(table[names[0]]["handed"], "L")
+        self.assertNotIn("handed", table[names[1]])
+
+    def test_sidecar(self):
+        hw = fake_hardware()
+        path = os.path.join(self.outdir, "hw.toml.gz")
+        hw.dump(path, compress=True, columnar=True)
+        self.assertTrue(os.path.isfile(detector_sidecar(path)))
+        check = Hardware(path)
+        self.assertTrue(check.columnar)
+        self.assertEqual(
+            check.data["detectors"], DetectorTable.from_dict(hw.data["detectors"])
+        )
+        self.assertIsInstance(check.data["detectors"].column("fwhm"), np.memmap)
+
+    def test_binary(self):
+        hw = fake_hardware()
+        path = os.path.join(self.outdir, "hw.npz")
+        hw.dump(path, binary=True)
+        self.assertTrue(is_binary_hardware(path))
+        check = Hardware(path)
+        self.assertEqual(list(check.data), list(hw.data))
+        for k, v in hw.data.items():
+            if k != "detectors":
+                self.assertEqual(check.data[k], v)
+        self.assertEqual(
+            check.data["detectors"], DetectorTable.from_dict(hw.data["detectors"])
+        )
+        self.assertIsInstance(check.data["detectors"].column("quat"), np.memmap)
+        # TOML files are still detected as such
+        tpath = os.path.join(self.outdir, "hw.toml.gz")
+        hw.dump(tpath, compress=True)
+        self.assertFalse(is_binary_hardware(tpath))
+
+    def test_toml_stream(self):
+        hw = fake_hardware()
+        path = os.path.join(self.outdir, "hw.toml.gz")
+        hw.dump(path, compress=True, chunk_size=5)
+        check = Hardware()
+        check.load(path, chunk_size=3)
+        self.assertEqual(list(check.data), list(hw.data))
+        self.assertEqual(list(check.data["detectors"]), list(hw.data["detectors"]))
+        np.testing.assert_array_equal(
+            check.data["detectors"]["01_002_f150_B"]["quat"],
+            hw.data["detectors"]["01_002_f150_B"]["quat"],
+        )
+        check.load(path, columnar=True, chunk_size=3)
+        self.assertEqual(
+            check.data["detectors"], DetectorTable.from_dict(hw.data["detectors"])
+        )
+        # Columnar detectors are written without conversion to a dictionary
+        cpath = os.path.join(self.outdir, "hwc.toml")
+        check.dump(cpath, chunk_size=5)
+        self.assertEqual(Hardware(cpath).data, Hardware(path).data)
+
+    def test_index(self):
+        hw = sim_nominal()
+        index = hw.index()
+        self.assertIs(hw.index(), index)
+        self.assertEqual(index.tube("037"), "ST8")
+        self.assertEqual(index.telescope("ST8"), "SAT3")
+        self.assertEqual(hw.wafer_map()["telescopes"]["037"], "SAT3")
+        with self.assertRaises(RuntimeError):
+            index.tube("not_a_wafer")
+        # Replacing a section rebuilds the index
+        hw.data["tubes"] = OrderedDict(hw.data["tubes"])
+        hw.data["tubes"]["ST8"] = OrderedDict([("wafers", ["037"])])
+        self.assertIsNot(hw.index(), index)
+        self.assertNotIn("038", hw.index().wafer_tube)
+
+    def test_select(self):
+        hw = fake_hardware()
+        match = {"band": "f090", "pixel": ["000", "002"]}
+        plain = hw.select(match=match)
+        hw.to_columnar()
+        columnar = hw.select(match=match)
+        self.assertTrue(columnar.columnar)
+        self.assertEqual(
+            list(columnar.data["detectors"]), list(plain.data["detectors"])
+        )
+        self.assertEqual(set(columnar.data["wafers"]), set(plain.data["wafers"]))
+        # Regex and wafer selections give the same detectors
+        for kwargs in [
+            dict(match={"band": "f0.*", "wafer": "01"}),
+            dict(tubes=["ST0"], match={"pol": ["A"]}),
+        ]:
+            hw = fake_hardware()
+            plain = hw.select(**kwargs)
+            hw.to_columnar()
+            columnar = hw.select(**kwargs)
+            self.assertEqual(
+                list(columnar.data["detectors"]), list(plain.data["detectors"])
+            )
+        # A whole wafer is a view of the original columns
+        wafer = hw.select(match={"wafer": "00"})
+        self.assertTrue(
+            np.shares_memory(
+                wafer.data["detectors"].column("quat"),
+                hw.data["detectors"].column("quat"),
+            )
+        )
+
+    def test_sim_columnar(self):
+        hw = sim_nominal()
+        sim_telescope_detectors(hw, "SAT3", tubes=["ST8"])
+        dets = hw.data["detectors"]
+        hwc = sim_nominal()
+        sim_telescope_detectors(hwc, "SAT3", tubes=["ST8"], columnar=True)
+        table = hwc.data["detectors"]
+        self.assertTrue(hwc.columnar)
+        self.assertEqual(list(table), list(dets))
+        np.testing.assert_array_equal(
+            table.column("quat"), np.array([x["quat"] for x in dets.values()])
+        )
+        self.assertEqual(
+            table.column("channel").tolist(), [x["channel"] for x in dets.values()]
+        )
+
+    def test_sim_parallel(self):
+        hw = sim_nominal()
+        sim_telescope_detectors(hw, "SAT3", tubes=["ST8"], columnar=True)
+        hwp = sim_nominal()
+        sim_telescope_detectors(hwp, "SAT3", tubes=["ST8"], columnar=True, nproc=2)
+        self.assertEqual(hwp.data["detectors"], hw.data["detectors"])
+
+    def test_sim_cache(self):
+        cache_dir = os.path.join(self.outdir, "cache")
+        hw = sim_nominal()
+        sim_telescope_detectors(hw, "SAT3", tubes=["ST8"], cache_dir=cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        hwc = sim_nominal()
+        sim_telescope_detectors(
+            hwc, "SAT3", tubes=["ST8"], columnar=True, cache_dir=cache_dir
+        )
+        self.assertIsInstance(hwc.data["detectors"].column("quat"), np.memmap)
+        self.assertEqual(
+            hwc.data["detectors"], DetectorTable.from_dict(hw.data["detectors"])
+        )
+        # A different configuration must not reuse the cached focalplane
+        hwc = sim_nominal()
+        hwc.data["tubes"]["ST8"]["platescale"] *= 1.01
+        sim_telescope_detectors(hwc, "SAT3", tubes=["ST8"], cache_dir=cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+    def test_boresight_angle(self):
+        hw = sim_nominal()
+        sim_telescope_detectors(hw, "SAT3", tubes=["ST8"], columnar=True)
+        quats = hw.data["detectors"].column("quat")[:100]
+        theta = boresight_angle(quats)
+        check = np.array([qa.to_iso_angles(x)[0] for x in quats])
+        np.testing.assert_allclose(theta, check, atol=1e-10)
@@ -0,0 +1,78 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+
+"""Run manifest tests.
+"""
+
+import os
+import shutil
+import tempfile
+import zlib
+
+from unittest import TestCase
+
+from ..manifest import RunManifest, checksum
+
+
+class ManifestTest(TestCase):
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def _product(self, mc, name, content):
+        path = os.path.join(self.outdir, "{:08}".format(mc))
+        os.makedirs(path, exist_ok=True)
+        fname = os.path.join(path, name)
+        with open(fname, "wb") as f:
+            f.write(content)
+        return fname
+
+    def test_checksum(self):
+        content = os.urandom(1000)
+        fname = self._product(0, "map.fits", content)
+        self.assertEqual(checksum(fname), "{:08x}".format(zlib.crc32(content)))
+
+    def test_record(self):
+        manifest = RunManifest(self.outdir)
+        self.assertFalse(manifest.exists())
+        self.assertEqual(manifest.read(), dict())
+
+        bmap = self._product(0, "bmap.fits", b"binned")
+        dmap = self._product(0, "map.fits", b"destriped")
+        fmap = self._product(1, "filtered.fits.gz", b"filtered")
+        entry = manifest.record(0, bmap)
+        self.assertEqual(entry["product"], os.path.join("00000000", "bmap.fits"))
+        self.assertEqual(entry["size"], 6)
+        manifest.record(1, fmap)
+
+        products = manifest.read()
+        self.assertEqual(sorted(products), [0, 1])
+        expected = [[bmap], [dmap]]
+        self.assertFalse(manifest.completed(products[0], expected))
+        manifest.record(0, dmap)
+        products = manifest.read()
+        self.assertTrue(manifest.completed(products[0], expected))
+        # Any alternative completes a product
+        expected = [[fmap[: -len(".gz")], fmap]]
+        self.assertTrue(manifest.completed(products[1], expected))
+        self.assertTrue(manifest.completed(products[1], []))
+
+        self.assertTrue(manifest.verify(products[0]["00000000/bmap.fits"]))
+        self._product(0, "bmap.fits", b"BINNED")
+        self.assertFalse(manifest.verify(products[0]["00000000/bmap.fits"]))
+        # The latest entry of a product wins
+        manifest.record(0, bmap)
+        self.assertTrue(manifest.verify(manifest.read()[0]["00000000/bmap.fits"]))
+
+    def test_truncated(self):
+        manifest = RunManifest(self.outdir)
+        manifest.record(0, self._product(0, "bmap.fits", b"binned"))
+        with open(manifest.path, "a") as f:
+            f.write('{"mc": 1, "prod')
+        products = manifest.read()
+        self.assertEqual(list(products), [0])
+        manifest.record(2, self._product(2, "bmap.fits", b"binned"))
+        products = manifest.read()
+        self.assertEqual(sorted(products), [0, 2])
@@ -0,0 +1,84 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+
+"""Noise parameter tests.
+"""
+
+from unittest import TestCase
+
+import numpy as np
+
+from ..hardware import sim_nominal, sim_telescope_detectors
+from ..noise import (
+    COMMON_MODE_INDEX,
+    common_mode_mixing,
+    common_mode_parameters,
+    noise_parameters,
+)
+
+
+class NoiseTest(TestCase):
+    def test_parameters(self):
+        hw = sim_nominal()
+        sim_telescope_detectors(hw, "SAT3", tubes=["ST7", "ST8"])
+        dets = hw.data["detectors"]
+        names = sorted(dets)
+        # Per-detector overrides of the band values
+        dets[names[3]]["NET"] = 1000.0
+        dets[names[7]]["fknee"] = 20.0
+        expected = dict()
+        hwindex = hw.index()
+        for name in names:
+            det = dets[name]
+            band = hw.data["bands"][det["band"]]
+            expected[name] = {
+                "NET": det.get("NET", band["NET"]) * 1e-6,
+                "fknee": det.get("fknee", band["fknee"]) * 1e-3,
+                "fmin": det.get("fmin", band["fmin"]) * 1e-3,
+                "tube": hwindex.tube(det["wafer"]),
+            }
+        params = noise_parameters(hw)
+        self.assertTrue(hw.columnar)
+        self.assertEqual(params["names"].tolist(), names)
+        for key in "NET", "fknee", "fmin":
+            np.testing.assert_allclose(
+                params[key], [expected[x][key] for x in names]
+            )
+        self.assertEqual(
+            params["tube"].tolist(), [expected[x]["tube"] for x in names]
+        )
+        self.assertEqual(set(params["tube"].tolist()), {"ST7", "ST8"})
+        self.assertAlmostEqual(params["NET"][3], 1e-3)
+        self.assertAlmostEqual(params["fknee"][7], 0.02)
+        np.testing.assert_array_equal(params["alpha"], 1)
+        np.testing.assert_array_equal(params["index"], np.arange(len(names)))
+
+        det_index = {x: 10 * i for i, x in enumerate(reversed(names))}
+        params = noise_parameters(hw, det_index)
+        self.assertEqual(params["index"].tolist(), [det_index[x] for x in names])
+
+    def test_common_modes(self):
+        all_tubes = ["LT0", "ST8", "ST9"]
+        params = common_mode_parameters("0.01,0.1,2,1e-4", all_tubes)
+        self.assertEqual(
+            params["names"].tolist(),
+            ["common_mode_LT0", "common_mode_ST8", "common_mode_ST9"],
+        )
+        self.assertEqual(params["index"].tolist(), [100000, 100001, 100002])
+        self.assertEqual(COMMON_MODE_INDEX, 100000)
+        np.testing.assert_array_equal(params["fknee"], 0.1)
+        np.testing.assert_array_equal(params["alpha"], 2)
+        np.testing.assert_array_equal(params["NET"], 1e-4)
+
+    def test_mixing(self):
+        tubes = np.array(["ST9", "ST8", "ST9", "LT0"])
+        all_tubes = ["LT0", "ST8", "ST9"]
+        mixing = common_mode_mixing(tubes, all_tubes)
+        self.assertEqual(mixing.shape, (4, 7))
+        expected = np.zeros((4, 7))
+        expected[np.arange(4), np.arange(4)] = 1
+        expected[np.arange(4), [6, 5, 6, 4]] = 1
+        np.testing.assert_array_equal(mixing.toarray(), expected)
+        for row in range(4):
+            cols = mixing.indices[mixing.indptr[row] : mixing.indptr[row + 1]]
+            self.assertTrue(np.all(np.diff(cols) > 0))
@@ -0,0 +1,71 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+
+"""Pair differencing tests.
+"""
+
+from unittest import TestCase
+
+import numpy as np
+
+from ..pairdiff import BLOCK_SIZE, merge_flags, pair_indices, sum_difference
+
+
+class PairDiffTest(TestCase):
+    def test_pairs(self):
+        dets = ["w00_000_A", "w00_000_B", "w00_001_B", "w00_001_A", "w00_002_C"]
+        self.assertEqual(
+            pair_indices(dets),
+            [("w00_000_A", "w00_000_B"), ("w00_001_A", "w00_001_B")],
+        )
+        with self.assertRaises(RuntimeError):
+            pair_indices(dets[:1])
+
+    def test_sum_difference(self):
+        np.random.seed(1234)
+        nsamp = 3 * BLOCK_SIZE + 17
+        signal = np.random.randn(2, nsamp)
+        weights = np.random.randn(2, nsamp, 3)
+        for a, b in [signal, weights]:
+            expected = [0.5 * (a + b), 0.5 * (a - b)]
+            sum_difference(a, b)
+            # Identical to the expression with temporaries
+            np.testing.assert_array_equal(a, expected[0])
+            np.testing.assert_array_equal(b, expected[1])
+
+    def test_scratch(self):
+        np.random.seed(1234)
+        nsamp = BLOCK_SIZE + 5
+        scratch = dict()
+        for dtype in np.float64, np.float32, np.float32:
+            a, b = np.random.randn(2, nsamp).astype(dtype)
+            expected = [0.5 * (a + b), 0.5 * (a - b)]
+            sum_difference(a, b, scratch)
+            np.testing.assert_array_equal(a, expected[0])
+            np.testing.assert_array_equal(b, expected[1])
+        # One buffer per dtype is kept and reused
+        self.assertEqual(sorted(x.name for x in scratch), ["float32", "float64"])
+        work = scratch[np.dtype(np.float32)]
+        sum_difference(a, b, scratch)
+        self.assertIs(scratch[np.dtype(np.float32)], work)
+
+    def test_contiguous(self):
+        signal = np.zeros((2, 100))
+        with self.assertRaises(RuntimeError):
+            sum_difference(signal[0, ::2], signal[1, ::2])
+        with self.assertRaises(RuntimeError):
+            sum_difference(signal[0], signal[1, :50])
+        flags = np.zeros((100, 2), dtype=np.uint8)
+        with self.assertRaises(RuntimeError):
+            merge_flags(flags[:, 0], flags[:, 1])
+
+    def test_flags(self):
+        nsamp = BLOCK_SIZE + 5
+        a = np.zeros(nsamp, dtype=np.uint8)
+        b = np.zeros(nsamp, dtype=np.uint8)
+        a[::3] = 1
+        b[::5] = 2
+        expected = a | b
+        merge_flags(a, b)
+        np.testing.assert_array_equal(a, expected)
+        np.testing.assert_array_equal(b, expected)
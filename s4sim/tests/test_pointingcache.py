@@ -0,0 +1,62 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+
+"""Pointing cache tests.
+"""
+
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+import numpy as np
+
+from ..pointingcache import PointingCache
+
+
+class PointingCacheTest(TestCase):
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+        np.random.seed(1234)
+        self.dets = ["w00_000_A", "w00_000_B"]
+        self.detquats = np.random.randn(2, 4)
+        self.boresight = np.random.randn(100, 4)
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def test_key(self):
+        args = ("CES-1", self.dets, self.detquats, self.boresight)
+        key = PointingCache.key(*args, nside=512)
+        self.assertEqual(key, PointingCache.key(*args, nside=512))
+        self.assertNotEqual(key, PointingCache.key(*args, nside=1024))
+        self.assertNotEqual(key, PointingCache.key("CES-2", *args[1:], nside=512))
+        self.assertNotEqual(
+            key, PointingCache.key("CES-1", self.dets[:1], *args[2:], nside=512)
+        )
+        boresight = self.boresight.copy()
+        boresight[50, 0] += 1e-12
+        self.assertNotEqual(
+            key,
+            PointingCache.key(*args[:3], boresight, nside=512),
+        )
+
+    def test_roundtrip(self):
+        cache = PointingCache(os.path.join(self.outdir, "pointing"))
+        key = PointingCache.key("CES-1", self.dets, self.detquats, self.boresight)
+        self.assertFalse(cache.has(key))
+        pixels = np.random.randint(0, 12 * 64**2, (2, 100)).astype(np.int32)
+        weights = np.random.randn(2, 100, 3).astype(np.float32)
+        submaps = np.unique(pixels // (12 * 4**2))
+        cache.write(key, pixels, weights, submaps)
+        self.assertTrue(cache.has(key))
+        self.assertEqual(len(os.listdir(cache.cache_dir)), 1)
+        pixels2, weights2, submaps2 = cache.read(key)
+        self.assertIsInstance(pixels2, np.memmap)
+        self.assertIsInstance(weights2, np.memmap)
+        np.testing.assert_array_equal(pixels2, pixels)
+        np.testing.assert_array_equal(weights2, weights)
+        np.testing.assert_array_equal(submaps2, submaps)
+        self.assertEqual(pixels2.dtype, np.int32)
+        self.assertEqual(weights2.dtype, np.float32)
@@ -0,0 +1,58 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+
+"""Precision check and map comparison tests.
+"""
+
+from argparse import Namespace
+from unittest import TestCase
+
+import numpy as np
+
+from ..precision import UNSEEN, check_precision_args, map_differences
+
+
+class PrecisionTest(TestCase):
+    def test_identical(self):
+        m = np.arange(30, dtype=np.float64).reshape(3, 10)
+        stats = map_differences(m, m.copy())
+        self.assertEqual(len(stats), 3)
+        for stat in stats:
+            self.assertEqual(stat["npix"], 10)
+            self.assertEqual(stat["rms_difference"], 0)
+            self.assertEqual(stat["relative"], 0)
+
+    def test_single_precision(self):
+        np.random.seed(12345)
+        reference = np.random.randn(3, 1000) * 1e-4 + 3.0
+        reference[:, :10] = UNSEEN
+        test = reference.astype(np.float32)
+        test[1, 500] = np.nan
+        stats = map_differences(reference, test)
+        for stat in stats:
+            self.assertEqual(stat["npix"], 989)
+            self.assertGreater(stat["rms_difference"], 0)
+            self.assertLess(stat["max_difference"], 3.0 * 2**-23)
+            self.assertLess(stat["relative"], 1e-7)
+
+        stats = map_differences(reference[0], test[0])
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]["npix"], 990)
+
+    def test_shape(self):
+        with self.assertRaises(RuntimeError):
+            map_differences(np.zeros((3, 10)), np.zeros((1, 10)))
+
+    def test_args(self):
+        options = dict(
+            apply_polyfilter=False, apply_groundfilter=False, checkpoint=False
+        )
+        check_precision_args(Namespace(single_precision_tod=True, **options))
+        for key in options:
+            args = Namespace(**options)
+            setattr(args, key, True)
+            args.single_precision_tod = False
+            check_precision_args(args)
+            args.single_precision_tod = True
+            with self.assertRaises(RuntimeError):
+                check_precision_args(args)
@@ -0,0 +1,90 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+
+"""Profiling trace tests.
+"""
+
+import os
+import shutil
+import tempfile
+import tracemalloc
+
+from unittest import TestCase
+
+import numpy as np
+
+from ..profiling import StageTrace, chrome_trace, read_trace, summarize
+
+
+class ProfilingTest(TestCase):
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def test_disabled(self):
+        trace = StageTrace()
+        with trace.stage("noise"):
+            pass
+        self.assertEqual(trace.records, [])
+
+    def test_stages(self):
+        trace = StageTrace()
+        was_tracing = tracemalloc.is_tracing()
+        trace.enable(3, allocations=True)
+        try:
+            with trace.stage("mc", mc=2):
+                with trace.stage("noise", mc=2):
+                    x = np.ones(1000000)
+                    del x
+        finally:
+            if not was_tracing:
+                tracemalloc.stop()
+        noise, mc = trace.records
+        self.assertEqual(noise["stage"], "noise")
+        self.assertEqual(noise["rank"], 3)
+        self.assertEqual(noise["mc"], 2)
+        self.assertEqual(noise["depth"], 1)
+        self.assertEqual(mc["depth"], 0)
+        self.assertGreaterEqual(noise["alloc_peak"], 8000000)
+        self.assertLess(abs(noise["alloc_net"]), 8000000)
+        self.assertGreaterEqual(mc["alloc_peak"], noise["alloc_peak"])
+        self.assertGreaterEqual(mc["peak_rss"], noise["peak_rss"])
+        self.assertGreaterEqual(mc["wall"], noise["wall"])
+
+        path = os.path.join(self.outdir, "profile.jsonl")
+        trace.write(path)
+        self.assertEqual(read_trace(path), trace.records)
+
+    def test_summarize(self):
+        records = list()
+        for rank, walls in enumerate([[1, 2], [3, 3], [2, 1]]):
+            for mc, wall in enumerate(walls):
+                records.append(
+                    {
+                        "rank": rank,
+                        "stage": "madam",
+                        "mc": mc,
+                        "start": 100.0 + mc * 10,
+                        "wall": wall,
+                        "cpu": wall / 2,
+                        "peak_rss": 1000 * (rank + 1),
+                    }
+                )
+        (summary,) = summarize(records)
+        self.assertEqual(summary["nproc"], 3)
+        self.assertEqual(summary["calls"], 6)
+        self.assertEqual(summary["wall_min"], 3)
+        self.assertEqual(summary["wall_max"], 6)
+        self.assertAlmostEqual(summary["imbalance"], 1.5)
+        self.assertEqual(summary["slowest_rank"], 1)
+        self.assertAlmostEqual(summary["cpu_fraction"], 0.5)
+        self.assertEqual(summary["peak_rss"], 3000)
+
+        trace = chrome_trace(records)
+        events = trace["traceEvents"]
+        self.assertEqual(len(events), 6)
+        self.assertEqual(events[1]["ts"], 10e6)
+        self.assertEqual(events[1]["tid"], 0)
+        self.assertEqual(events[1]["args"]["mc"], 1)
@@ -0,0 +1,56 @@
+# Copyright (c) 2020-2023 CMB-S4 Collaboration.
+# Full license can be found in the top level "LICENSE" file.
+
+"""Sky map cache tests.
+"""
+
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+import numpy as np
+
+from ..skycache import SkyCache
+
+
+class SkyCacheTest(TestCase):
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def test_key(self):
+        models = ["d0", "s0"]
+        key = SkyCache.key(models, 64, 93.0, 27.9, fwhm=0.1)
+        self.assertEqual(key, SkyCache.key(models, 64, 93, 27.9, fwhm=0.1))
+        self.assertNotEqual(key, SkyCache.key(models, 64, 93.0, 27.9))
+        self.assertNotEqual(key, SkyCache.key(models, 128, 93.0, 27.9, fwhm=0.1))
+        self.assertNotEqual(key, SkyCache.key(["d0"], 64, 93.0, 27.9, fwhm=0.1))
+        self.assertNotEqual(
+            key, SkyCache.key(models, 64, 93.0, 27.9, fwhm=0.1, pysm_version="3")
+        )
+
+    def test_submaps(self):
+        cache = SkyCache(os.path.join(self.outdir, "sky"))
+        nside = 16
+        npix = 12 * nside**2
+        skymap = np.random.randn(3, npix).astype(np.float32)
+        key = SkyCache.key(["d0"], nside, 145.0, 30.0)
+        self.assertFalse(cache.has(key))
+        cache.write(key, skymap)
+        self.assertTrue(cache.has(key))
+        self.assertEqual(
+            os.listdir(cache.cache_dir), [os.path.basename(cache.path(key))]
+        )
+        npix_submap = 12 * 4**2
+        local_submaps = np.array([0, 5, 15])
+        submaps = cache.read_submaps(key, local_submaps, npix_submap)
+        self.assertEqual(submaps.shape, (3, npix_submap, 3))
+        for i, sm in enumerate(local_submaps):
+            pixels = slice(sm * npix_submap, (sm + 1) * npix_submap)
+            np.testing.assert_array_equal(submaps[i], skymap[:, pixels].T)
+        with self.assertRaises(RuntimeError):
+            cache.read_submaps(key, local_submaps, 100)
@@ -26,6 +26,9 @@ setup_opts["entry_points"] = {
         "s4_hardware_plot = s4sim.scripts.s4_hardware_plot:main",
         "s4_hardware_trim = s4sim.scripts.s4_hardware_trim:main",
         "s4_hardware_info = s4sim.scripts.s4_hardware_info:main",
+        "s4_sim_status = s4sim.scripts.s4_sim_status:main",
+        "s4_profile_summary = s4sim.scripts.s4_profile_summary:main",
+        "s4_compare_maps = s4sim.scripts.s4_compare_maps:main",
     ]
 }
 